@@ -12,6 +12,7 @@
 #define FIRMWARE_VERSION "1.0.0"
 #define DHT_PIN 4
 #define DHT_TYPE DHT22
+#define BINARY_TELEMETRY 0  // 1 = publish MessagePack on telemetry/bin instead of JSON
 
 // Network Configuration
 const char* ssid = "YourWiFiSSID";
@@ -21,6 +22,7 @@ const int mqtt_port = 8883;  // MQTT over TLS
 
 // MQTT Topics
 const char* telemetry_topic = "devices/esp32_sensor_001/telemetry";
+const char* telemetry_bin_topic = "devices/esp32_sensor_001/telemetry/bin";
 const char* command_topic = "devices/esp32_sensor_001/commands";
 const char* status_topic = "devices/esp32_sensor_001/status";
 const char* ota_topic = "devices/esp32_sensor_001/ota";
@@ -228,6 +230,27 @@ void sendTelemetry() {
         return;
     }
     
+#if BINARY_TELEMETRY
+    // [temperature, humidity, wifi_rssi, free_heap, uptime]; the device id is in the topic
+    StaticJsonDocument<128> packed;
+    JsonArray fields = packed.to<JsonArray>();
+    fields.add(temperature);
+    fields.add(humidity);
+    fields.add(WiFi.RSSI());
+    fields.add(ESP.getFreeHeap());
+    fields.add(millis() / 1000);
+    
+    uint8_t buffer[64];
+    size_t length = serializeMsgPack(packed, buffer, sizeof(buffer));
+    
+    if (mqtt_client.publish(telemetry_bin_topic, buffer, length)) {
+        Serial.printf("Telemetry sent: %u bytes MessagePack\n", length);
+    } else {
+        Serial.println("Failed to send telemetry");
+    }
+    return;
+#endif
+    
     DynamicJsonDocument doc(512);
     doc["device_id"] = DEVICE_ID;
     doc["timestamp"] = millis();
@@ -5,39 +5,174 @@ Handles device management, data processing, and cloud connectivity
 """
 
 import asyncio
+import bisect
+import concurrent.futures
+import gzip
 import json
+import math
+import multiprocessing
+import os
+import re
 import sqlite3
 import logging
+import logging.handlers
 import ssl
 import time
+from collections import deque
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import aiohttp
+from aiohttp import web
 import paho.mqtt.client as mqtt
+from contextlib import asynccontextmanager, contextmanager
 from dataclasses import dataclass, asdict
+import random
 import signal
 import sys
+import threading
 import configparser
 import hashlib
-import jwt
+import queue
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip is used instead
+    zstandard = None
+
+try:
+    import msgspec
+except ImportError:  # optional, faster typed decoding of MQTT payloads
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:  # optional, faster generic JSON decoding
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional, binary telemetry also decodes with msgspec
+    msgpack = None
 
 # Configuration
 CONFIG_FILE = '/etc/iot-gateway/config.ini'
 DATABASE_FILE = '/var/lib/iot-gateway/gateway.db'
 LOG_FILE = '/var/log/iot-gateway/gateway.log'
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+SHARD_LOG_FORMAT = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+
 logger = logging.getLogger(__name__)
 
-@dataclass
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `burst` records per call site every `interval` seconds"""
+
+    def __init__(self, burst: int = 10, interval: float = 60.0, level: int = logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.level = level
+        # (pathname, lineno) -> [window start, records in window, suppressed in window]
+        self._sites: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level:
+            return True
+        # The call site, not the text: f-string messages differ on every call
+        key = (record.pathname, record.lineno)
+        now = record.created
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                self._sites[key] = [now, 1, 0]
+                return True
+            if now - site[0] >= self.interval:
+                suppressed = site[2]
+                site[:] = [now, 1, 0]
+            elif site[1] < self.burst:
+                site[1] += 1
+                return True
+            else:
+                site[2] += 1
+                self.suppressed += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+            record.args = None
+        return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread and never blocks the caller"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Bind %-style arguments now since they may change; timestamps and layout are formatted later
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Tracebacks cannot be pickled onto a shard worker's queue
+            record.exc_text = self.exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(config: configparser.ConfigParser, log_queue=None,
+                  listen: bool = True) -> Optional[logging.handlers.QueueListener]:
+    """Route all logging through a queue to a size-rotated file and stderr on a background thread.
+    Shard workers pass the supervisor's log_queue with listen=False and only enqueue."""
+    level_name = config.get('logging', 'level', fallback='INFO').upper()
+    level = logging.getLevelName(level_name)
+    unknown_level = not isinstance(level, int)
+    if unknown_level:
+        level = logging.INFO
+
+    sharded = log_queue is not None
+    if log_queue is None:
+        log_queue = queue.Queue(config.getint('logging', 'queue_size', fallback=10000))
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(
+        burst=config.getint('logging', 'rate_limit_burst', fallback=10),
+        interval=config.getfloat('logging', 'rate_limit_interval', fallback=60)
+    ))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+    if unknown_level:
+        logger.warning(f"Unknown log level {level_name}, using INFO")
+    if not listen:
+        return None
+
+    formatter = logging.Formatter(SHARD_LOG_FORMAT if sharded else LOG_FORMAT)
+    handlers: List[logging.Handler] = [logging.StreamHandler()]
+    log_file = config.get('logging', 'file', fallback=LOG_FILE)
+    try:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=config.getint('logging', 'max_size', fallback=10485760),
+            backupCount=config.getint('logging', 'backup_count', fallback=5)
+        ))
+    except OSError as e:
+        logger.error(f"Cannot open log file {log_file}, logging to stderr only: {e}")
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+@dataclass(slots=True)
 class DeviceInfo:
     device_id: str
     device_type: str
@@ -45,71 +180,2340 @@ class DeviceInfo:
     ip_address: str
     firmware_version: str
     capabilities: str
-    last_seen: datetime
+    last_seen: Optional[float]  # epoch seconds
     status: str = "online"
-    registration_time: Optional[datetime] = None
+    registration_time: Optional[float] = None
+
+def parse_version(version: Optional[str]) -> tuple:
+    """Comparable tuple from a firmware version such as '1.2.3'"""
+    return tuple(int(part) for part in re.findall(r'\d+', version or ''))
+
+class DeviceRegistry(dict):
+    """device_id -> DeviceInfo with shared descriptor strings and status/type/firmware/capability indexes.
+    Each device owns an integer slot, and an index maps a value to a bitset with one bit per slot."""
+
+    # Set bit positions of every byte value
+    BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+    def __init__(self):
+        super().__init__()
+        self.symbols: Dict[str, str] = {}
+        self.slots: Dict[str, int] = {}
+        self.slot_ids: List[str] = []
+        self.by_status: Dict[str, bytearray] = {}
+        self.by_type: Dict[str, bytearray] = {}
+        self.by_firmware: Dict[str, bytearray] = {}
+        self.by_capability: Dict[str, bytearray] = {}
+        self._capability_tokens: Dict[str, tuple] = {}
+
+    def intern(self, value: Optional[str]) -> Optional[str]:
+        """Canonical instance of a type, status, firmware or capability string"""
+        if value is None:
+            return None
+        return self.symbols.setdefault(value, value)
+
+    def capability_tokens(self, capabilities: Optional[str]) -> tuple:
+        """Individual capabilities of a comma-separated list, split once per distinct list"""
+        tokens = self._capability_tokens.get(capabilities)
+        if tokens is None:
+            tokens = tuple(
+                self.intern(token.strip()) for token in (capabilities or '').split(',') if token.strip()
+            )
+            self._capability_tokens[capabilities] = tokens
+        return tokens
+
+    @staticmethod
+    def _index(index: Dict[str, bytearray], key: Optional[str], slot: int):
+        bits = index.get(key)
+        if bits is None:
+            bits = index[key] = bytearray()
+        offset = slot >> 3
+        if offset >= len(bits):
+            bits.extend(bytes(offset + 1 - len(bits)))
+        bits[offset] |= 1 << (slot & 7)
+
+    @staticmethod
+    def _unindex(index: Dict[str, bytearray], key: Optional[str], slot: int):
+        bits = index.get(key)
+        offset = slot >> 3
+        if bits is not None and offset < len(bits):
+            bits[offset] &= ~(1 << (slot & 7)) & 0xFF
+
+    def add(self, device: DeviceInfo):
+        """Register or replace a device, sharing its descriptor strings with identical devices"""
+        previous = self.get(device.device_id)
+        if previous is not None:
+            self._unindex_device(previous)
+        
+        intern = self.intern
+        device.device_type = intern(device.device_type)
+        device.firmware_version = intern(device.firmware_version)
+        device.capabilities = intern(device.capabilities)
+        device.status = intern(device.status)
+        self[device.device_id] = device
+        
+        slot = self.slots.get(device.device_id)
+        if slot is None:
+            slot = self.slots[device.device_id] = len(self.slot_ids)
+            self.slot_ids.append(device.device_id)
+        self._index(self.by_status, device.status, slot)
+        self._index(self.by_type, device.device_type, slot)
+        self._index(self.by_firmware, device.firmware_version, slot)
+        for token in self.capability_tokens(device.capabilities):
+            self._index(self.by_capability, token, slot)
+
+    def _unindex_device(self, device: DeviceInfo):
+        slot = self.slots[device.device_id]
+        self._unindex(self.by_status, device.status, slot)
+        self._unindex(self.by_type, device.device_type, slot)
+        self._unindex(self.by_firmware, device.firmware_version, slot)
+        for token in self.capability_tokens(device.capabilities):
+            self._unindex(self.by_capability, token, slot)
+
+    def set_status(self, device: DeviceInfo, status: str):
+        """Change a device's status, keeping the status index current"""
+        slot = self.slots[device.device_id]
+        self._unindex(self.by_status, device.status, slot)
+        device.status = self.intern(status)
+        self._index(self.by_status, device.status, slot)
+
+    def status_counts(self) -> Dict[str, int]:
+        """Number of devices in each status"""
+        return {status: int.from_bytes(bits, 'little').bit_count() for status, bits in self.by_status.items()}
+
+    def find(self, status: Optional[str] = None, device_type: Optional[str] = None,
+             firmware: Optional[str] = None, capabilities: tuple = (),
+             firmware_below: Optional[str] = None, firmware_at_least: Optional[str] = None) -> List[DeviceInfo]:
+        """Devices matching every given criterion, in registration order, by ANDing index bitsets"""
+        candidates = []
+        if status is not None:
+            candidates.append(self.by_status.get(status, b''))
+        if device_type is not None:
+            candidates.append(self.by_type.get(device_type, b''))
+        if firmware is not None:
+            candidates.append(self.by_firmware.get(firmware, b''))
+        for capability in capabilities:
+            candidates.append(self.by_capability.get(capability, b''))
+        if firmware_below is not None or firmware_at_least is not None:
+            # Few distinct versions are in the field, so compare per version rather than per device
+            below = parse_version(firmware_below) if firmware_below is not None else None
+            at_least = parse_version(firmware_at_least) if firmware_at_least is not None else None
+            matching = 0
+            for version, bits in self.by_firmware.items():
+                parsed = parse_version(version)
+                if (below is None or parsed < below) and (at_least is None or parsed >= at_least):
+                    matching |= int.from_bytes(bits, 'little')
+            candidates.append(matching)
+        
+        if not candidates:
+            return list(self.values())
+        selected = -1
+        for bits in candidates:
+            selected &= bits if isinstance(bits, int) else int.from_bytes(bits, 'little')
+            if not selected:
+                return []
+        
+        devices = []
+        slot_ids = self.slot_ids
+        for offset, byte in enumerate(selected.to_bytes((selected.bit_length() + 7) // 8, 'little')):
+            if byte:
+                for bit in self.BITS[byte]:
+                    devices.append(self[slot_ids[offset * 8 + bit]])
+        return devices
+
+def format_timestamp(ts: Optional[float]) -> Optional[str]:
+    """ISO-8601 text for an epoch timestamp, as stored in the devices table"""
+    return datetime.fromtimestamp(ts).isoformat() if ts else None
+
+def parse_timestamp(value: Optional[str]) -> Optional[float]:
+    """Epoch seconds from the ISO-8601 text stored in the devices table"""
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+@dataclass
+class TelemetryData:
+    device_id: str
+    timestamp: datetime
+    temperature: Optional[float] = None
+    humidity: Optional[float] = None
+    wifi_rssi: Optional[int] = None
+    free_heap: Optional[int] = None
+    uptime: Optional[int] = None
+    custom_data: Optional[Dict] = None
+
+@dataclass(slots=True)
+class TelemetryPayload:
+    device_id: Optional[str] = None
+    temperature: Optional[float] = None
+    humidity: Optional[float] = None
+    wifi_rssi: Optional[int] = None
+    free_heap: Optional[int] = None
+    uptime: Optional[int] = None
+    custom_data: Optional[Dict] = None
+
+    @classmethod
+    def from_dict(cls, payload: Dict) -> 'TelemetryPayload':
+        return cls(
+            payload.get('device_id'), payload.get('temperature'), payload.get('humidity'),
+            payload.get('wifi_rssi'), payload.get('free_heap'), payload.get('uptime'),
+            payload.get('custom_data')
+        )
+
+class PayloadDecoder:
+    """Decodes raw MQTT payload bytes with the fastest available JSON and MessagePack libraries"""
+
+    # Positional fields of the binary telemetry array: [temperature, humidity, wifi_rssi, free_heap, uptime, custom_data?]
+    BINARY_FIELDS = 6
+
+    BACKENDS = ('auto', 'msgspec', 'orjson', 'json')
+
+    def __init__(self, backend: str = 'auto'):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown payload decoder: {backend}")
+        if backend == 'auto':
+            backend = 'msgspec' if msgspec else 'orjson' if orjson else 'json'
+        elif (backend == 'msgspec' and msgspec is None) or (backend == 'orjson' and orjson is None):
+            logger.warning(f"{backend} is not installed, falling back to the json module")
+            backend = 'json'
+        self.backend = backend
+
+        # MessagePack for devices/+/telemetry/bin, independent of the JSON backend
+        if msgspec:
+            self._unpack = msgspec.msgpack.Decoder().decode
+        elif msgpack:
+            self._unpack = lambda raw: msgpack.unpackb(raw, raw=False)
+        else:
+            self._unpack = None
+        
+        # decode(raw) -> dict is bound to the backend's own function to skip a call layer
+        self._telemetry = None
+        if backend == 'msgspec':
+            self._telemetry = msgspec.json.Decoder(TelemetryPayload)
+            self.decode = msgspec.json.Decoder().decode
+        elif backend == 'orjson':
+            self.decode = orjson.loads
+        else:
+            self.decode = self._decode_json
+
+    @staticmethod
+    def _decode_json(raw: bytes) -> Dict:
+        # Cheaper than json.loads(bytes), which sniffs the encoding first
+        return json.loads(raw.decode())
+
+    def decode_telemetry(self, raw: bytes) -> TelemetryPayload:
+        """Telemetry struct straight from payload bytes"""
+        if self._telemetry is not None:
+            try:
+                return self._telemetry.decode(raw)
+            except msgspec.ValidationError:
+                pass  # unexpected field types; take the lenient path below
+        return TelemetryPayload.from_dict(self.decode(raw))
+
+    @property
+    def binary(self) -> bool:
+        """Whether a MessagePack library is available for binary telemetry"""
+        return self._unpack is not None
+
+    def decode_binary_telemetry(self, raw: bytes, device_id: str) -> TelemetryPayload:
+        """Telemetry struct from a MessagePack array (or map) published on the binary topic"""
+        values = self._unpack(raw)
+        if isinstance(values, dict):
+            payload = TelemetryPayload.from_dict(values)
+            payload.device_id = payload.device_id or device_id
+            return payload
+        if not isinstance(values, (list, tuple)) or len(values) > self.BINARY_FIELDS:
+            raise ValueError("Binary telemetry must be an array of at most 6 fields")
+        return TelemetryPayload(device_id, *values)
+
+class TopicNode:
+    __slots__ = ('children', 'wildcard', 'handler', 'multi_handler')
+
+    def __init__(self):
+        self.children: Dict[str, 'TopicNode'] = {}
+        self.wildcard: Optional['TopicNode'] = None
+        self.handler = None
+        self.multi_handler = None
+
+class TopicRouter:
+    """MQTT topic filters compiled into a trie; wildcard segments are captured for the handler"""
+
+    def __init__(self):
+        self.root = TopicNode()
+        self.patterns: List[str] = []
+
+    def add(self, pattern: str, handler):
+        """Route topics matching an MQTT filter ('+' one level, trailing '#' the rest) to handler"""
+        segments = pattern.split('/')
+        node = self.root
+        for i, segment in enumerate(segments):
+            if segment == '#':
+                if i != len(segments) - 1:
+                    raise ValueError(f"'#' must be the last level of a topic filter: {pattern}")
+                node.multi_handler = handler
+                break
+            if segment == '+':
+                if node.wildcard is None:
+                    node.wildcard = TopicNode()
+                node = node.wildcard
+            elif '+' in segment or '#' in segment:
+                raise ValueError(f"Wildcards must occupy a whole topic level: {pattern}")
+            else:
+                node = node.children.setdefault(segment, TopicNode())
+        else:
+            node.handler = handler
+        self.patterns.append(pattern)
+
+    def remove(self, pattern: str) -> bool:
+        """Unroute an MQTT filter and prune the levels no other filter uses; False if it was not routed"""
+        segments = pattern.split('/')
+        multi = segments[-1] == '#'
+        if multi:
+            segments = segments[:-1]
+        path = [self.root]
+        for segment in segments:
+            node = path[-1].wildcard if segment == '+' else path[-1].children.get(segment)
+            if node is None:
+                return False
+            path.append(node)
+        
+        node = path[-1]
+        if (node.multi_handler if multi else node.handler) is None:
+            return False
+        if multi:
+            node.multi_handler = None
+        else:
+            node.handler = None
+        self.patterns.remove(pattern)
+        
+        for depth in range(len(segments), 0, -1):
+            node = path[depth]
+            if node.children or node.wildcard or node.handler is not None or node.multi_handler is not None:
+                break
+            if segments[depth - 1] == '+':
+                path[depth - 1].wildcard = None
+            else:
+                del path[depth - 1].children[segments[depth - 1]]
+        return True
+
+    def match(self, topic: str) -> Optional[tuple]:
+        """(handler, captured wildcard segments) for a topic, preferring literal levels, or None"""
+        segments = topic.split('/')
+        
+        # Fast path: follow literal levels, else '+', without backtracking
+        node = self.root
+        captures = []
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                child = node.wildcard
+                if child is None or (node is self.root and segment.startswith('$')):
+                    break
+                captures.append(segment)
+            node = child
+        else:
+            if node.handler is not None:
+                return node.handler, tuple(captures)
+        
+        # Dead end or '#' needed: full depth-first search
+        return self._match(self.root, segments, 0, ())
+
+    def _match(self, node: TopicNode, segments: List[str], i: int, captures: tuple) -> Optional[tuple]:
+        if i == len(segments):
+            if node.handler is not None:
+                return node.handler, captures
+            if node.multi_handler is not None:
+                return node.multi_handler, captures + ('',)
+            return None
+        
+        segment = segments[i]
+        child = node.children.get(segment)
+        if child is not None:
+            found = self._match(child, segments, i + 1, captures)
+            if found:
+                return found
+        # Wildcards never match system topics such as $SYS
+        if i == 0 and segment.startswith('$'):
+            return None
+        if node.wildcard is not None:
+            found = self._match(node.wildcard, segments, i + 1, captures + (segment,))
+            if found:
+                return found
+        if node.multi_handler is not None:
+            return node.multi_handler, captures + ('/'.join(segments[i:]),)
+        return None
+
+@dataclass(slots=True)
+class LatestReading:
+    timestamp: float
+    temperature: Optional[float] = None
+    humidity: Optional[float] = None
+    wifi_rssi: Optional[int] = None
+    free_heap: Optional[int] = None
+    uptime: Optional[int] = None
+
+    def as_dict(self) -> Dict:
+        # Cheaper than dataclasses.asdict on the read API's hot path
+        return {
+            'timestamp': self.timestamp,
+            'temperature': self.temperature,
+            'humidity': self.humidity,
+            'wifi_rssi': self.wifi_rssi,
+            'free_heap': self.free_heap,
+            'uptime': self.uptime,
+        }
+
+class Counter:
+    """Monotonic counter; inc() is a single attribute add"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class Histogram:
+    """Log-bucketed (HDR-style) histogram of seconds with a fixed ~19% relative bucket width"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    # Four buckets per power of two; observe() inlines these constants
+    OFFSET = 72     # bucket 0 ends at 2**(-71/4) s (~4.5 us)
+    BUCKETS = 100   # last finite bucket ends at 2**7 s, then +Inf
+    BOUNDS = tuple(2.0 ** (i / 4) for i in range(1 - OFFSET, 1 - OFFSET + BUCKETS))
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # One log2 call and no loop; constants are inlined because this runs per message.
+        # Rounding up keeps a value equal to a bound in that bucket, as Prometheus' le is inclusive
+        if value > 0.0:
+            index = math.ceil(math.log2(value) * 4.0) + 71
+            if index < 0:
+                index = 0
+            elif index > 100:
+                index = 100
+        else:
+            index = 0
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+class GatewayMetrics:
+    """Counters, histograms and scrape-time gauges rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.families: Dict[str, tuple] = {}
+        self.series: Dict[str, Dict[tuple, object]] = {}
+
+    def _series(self, kind: str, name: str, help_text: str, labels: tuple, factory):
+        self.families.setdefault(name, (kind, help_text))
+        series = self.series.setdefault(name, {})
+        metric = series.get(labels)
+        if metric is None:
+            metric = series[labels] = factory()
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> Counter:
+        """Counter for name and (key, value) label pairs; keep the object to skip lookups on hot paths"""
+        return self._series('counter', name, help_text, labels, Counter)
+
+    def histogram(self, name: str, help_text: str, labels: tuple = ()) -> Histogram:
+        """Histogram for name and label pairs"""
+        return self._series('histogram', name, help_text, labels, Histogram)
+
+    def gauge(self, name: str, help_text: str, func, kind: str = 'gauge'):
+        """Value read at scrape time; func returns a number or a {labels: number} dict.
+        Use kind='counter' for totals already kept by another component."""
+        self.families[name] = (kind, help_text)
+        self.series[name] = func
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        parts = []
+        for key, value in labels + extra:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        """Prometheus text exposition (version 0.0.4)"""
+        lines = []
+        for name, (kind, help_text) in self.families.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            series = self.series[name]
+            if callable(series):
+                try:
+                    value = series()
+                except Exception as e:
+                    logger.error(f"Error reading gauge {name}: {e}")
+                    continue
+                series = value if isinstance(value, dict) else {(): value}
+                for labels, gauge_value in series.items():
+                    lines.append(f'{name}{self._labels(labels)} {gauge_value}')
+            elif kind == 'counter':
+                for labels, counter in list(series.items()):
+                    lines.append(f'{name}{self._labels(labels)} {counter.value}')
+            else:
+                for labels, histogram in list(series.items()):
+                    cumulative = 0
+                    counts = list(histogram.counts)
+                    for bound, count in zip(Histogram.BOUNDS, counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{self._labels(labels, (("le", repr(bound)),))} {cumulative}')
+                    cumulative += counts[-1]
+                    lines.append(f'{name}_bucket{self._labels(labels, (("le", "+Inf"),))} {cumulative}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum}')
+                    lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+class GatewayDatabase:
+    """Single access layer for gateway.db: one shared writer connection and a pool of readers"""
+
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, db_file: str, synchronous: str = 'NORMAL', cache_size: int = -8192,
+                 mmap_size: int = 67108864, busy_timeout: int = 5000, readers: int = 4):
+        synchronous = synchronous.upper()
+        if synchronous not in self.SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Unknown synchronous level: {synchronous}")
+        self.db_file = db_file
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self.readers = readers
+
+        self._writer: Optional[sqlite3.Connection] = None
+        self._write_lock = threading.RLock()
+        self._idle_readers: List[sqlite3.Connection] = []
+        self._reader_lock = threading.Lock()
+        self._reader_slots = threading.BoundedSemaphore(readers)
+
+    def _configure(self, conn: sqlite3.Connection):
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA cache_size = {int(self.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+
+    def open(self):
+        """Open the writer connection and switch the file to WAL mode"""
+        with self._write_lock:
+            if self._writer:
+                return
+            conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout / 1000, check_same_thread=False)
+            mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            if mode.lower() != 'wal':
+                logger.warning(f"Database is in {mode} journal mode, WAL not available")
+            conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+            self._configure(conn)
+            self._writer = conn
+
+    @contextmanager
+    def writer(self):
+        """Exclusive use of the shared writer connection"""
+        with self._write_lock:
+            if self._writer is None:
+                self.open()
+            yield self._writer
+
+    def _checkout(self) -> sqlite3.Connection:
+        with self._reader_lock:
+            if self._idle_readers:
+                return self._idle_readers.pop()
+        conn = sqlite3.connect(
+            f'file:{self.db_file}?mode=ro', uri=True,
+            timeout=self.busy_timeout / 1000, check_same_thread=False
+        )
+        self._configure(conn)
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def _checkin(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._reader_lock:
+            self._idle_readers.append(conn)
+
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection, blocking while all of them are busy"""
+        with self._reader_slots:
+            conn = self._checkout()
+            try:
+                yield conn
+            finally:
+                self._checkin(conn)
+
+    @asynccontextmanager
+    async def async_reader(self):
+        """Borrow a read-only connection without blocking the event loop"""
+        await asyncio.to_thread(self._reader_slots.acquire)
+        try:
+            conn = await asyncio.to_thread(self._checkout)
+            try:
+                yield conn
+            finally:
+                self._checkin(conn)
+        finally:
+            self._reader_slots.release()
+
+    def close(self):
+        """Close every connection"""
+        with self._reader_lock:
+            while self._idle_readers:
+                self._idle_readers.pop().close()
+        with self._write_lock:
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+
+@dataclass(slots=True)
+class ArrivalStats:
+    last_arrival: float
+    mean: float = 0.0
+    var: float = 0.0
+    samples: int = 0
+
+    def update(self, now: float, alpha: float):
+        """Fold the gap since the previous check-in into the EWMA mean and variance"""
+        gap = now - self.last_arrival
+        self.last_arrival = now
+        if gap <= 0:
+            return
+        if self.samples == 0:
+            self.mean = gap
+        else:
+            diff = gap - self.mean
+            incr = alpha * diff
+            self.mean += incr
+            self.var = (1 - alpha) * (self.var + diff * incr)
+        self.samples += 1
+
+class DeviceDeadlines:
+    """Hashed timing wheel of device check-in deadlines with lazy rescheduling"""
+
+    def __init__(self, timeout: float = 300.0, tolerance: float = 5.0):
+        self.timeout = timeout
+        # Half-tolerance ticks, advanced every tick, keep detection lag under the tolerance
+        self.tick = tolerance / 2
+        self.slots: List[set] = [set() for _ in range(int(timeout / self.tick) + 2)]
+        self.deadlines: Dict[str, float] = {}
+        self.scheduled: Dict[str, int] = {}
+        self.current_tick = int(time.time() / self.tick)
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def _schedule(self, device_id: str, deadline: float, after_tick: int):
+        tick = max(math.ceil(deadline / self.tick), after_tick + 1)
+        self.scheduled[device_id] = tick
+        self.slots[tick % len(self.slots)].add(device_id)
+
+    def touch(self, device_id: str, now: float, timeout: Optional[float] = None):
+        """Set a device's deadline in O(1); a later deadline is corrected when the old entry fires"""
+        deadline = now + (timeout or self.timeout)
+        self.deadlines[device_id] = deadline
+        tick = self.scheduled.get(device_id)
+        if tick is None:
+            self._schedule(device_id, deadline, self.current_tick)
+        elif math.ceil(deadline / self.tick) < tick:
+            # A shorter timeout must not wait for the old, later entry
+            self.slots[tick % len(self.slots)].discard(device_id)
+            self._schedule(device_id, deadline, self.current_tick)
+
+    def discard(self, device_id: str):
+        """Stop watching a device"""
+        self.deadlines.pop(device_id, None)
+        tick = self.scheduled.pop(device_id, None)
+        if tick is not None:
+            self.slots[tick % len(self.slots)].discard(device_id)
+
+    def advance(self, now: float) -> List[str]:
+        """Move the wheel to now and return devices whose deadline has passed"""
+        target = int(now / self.tick)
+        expired = []
+        steps = min(target - self.current_tick, len(self.slots))
+        for step in range(1, steps + 1):
+            slot = self.slots[(self.current_tick + step) % len(self.slots)]
+            for device_id in list(slot):
+                if self.scheduled[device_id] > target:
+                    continue  # a later lap of the wheel
+                slot.discard(device_id)
+                del self.scheduled[device_id]
+                deadline = self.deadlines[device_id]
+                if deadline <= now:
+                    del self.deadlines[device_id]
+                    expired.append(device_id)
+                else:
+                    # Checked in since this entry was placed; re-file under the new deadline
+                    self._schedule(device_id, deadline, target)
+        self.current_tick = max(self.current_tick, target)
+        return expired
+
+class TelemetryPartitions:
+    """Routes telemetry rows to compact per-day or per-week tables behind a union view"""
+
+    SCHEMA_VERSION = 2
+    INTERVALS = ('day', 'week')
+    VIEW = 'telemetry'
+    COLUMNS = 'device_key, ts, temperature, humidity, wifi_rssi, free_heap, uptime, custom_data'
+    NAME_PATTERN = re.compile(r'^telemetry_(\d{8}|w\d{6})$')
+    MIGRATION_PREFIX = 'migrate_'
+
+    def __init__(self, interval: str = 'day'):
+        if interval not in self.INTERVALS:
+            raise ValueError(f"Unknown telemetry partition interval: {interval}")
+        self.interval = interval
+        # Replaced, never mutated: the event loop iterates it while the writer thread adds partitions
+        self.known: frozenset = frozenset()
+        self.device_keys: Dict[str, int] = {}
+        self.device_ids: Dict[int, str] = {}
+        self.pending_sources: List[str] = []
+        self._current: Optional[tuple] = None
+
+    def partition_for(self, timestamp: datetime) -> str:
+        """Name of the partition table holding a timestamp"""
+        current = self._current
+        if current and current[0] <= timestamp < current[1]:
+            return current[2]
+
+        if self.interval == 'day':
+            start = datetime(timestamp.year, timestamp.month, timestamp.day)
+            end = start + timedelta(days=1)
+            name = f"telemetry_{start:%Y%m%d}"
+        else:
+            year, week, _ = timestamp.isocalendar()
+            start = datetime.fromisocalendar(year, week, 1)
+            end = start + timedelta(weeks=1)
+            name = f"telemetry_w{year:04d}{week:02d}"
+        if timestamp.tzinfo is None:
+            self._current = (start, end, name)
+        return name
+
+    @staticmethod
+    def partition_start(name: str) -> datetime:
+        """Inclusive lower bound of a partition's time range"""
+        suffix = name[len('telemetry_'):]
+        if suffix.startswith('w'):
+            return datetime.fromisocalendar(int(suffix[1:5]), int(suffix[5:7]), 1)
+        return datetime.strptime(suffix, '%Y%m%d')
+
+    @classmethod
+    def partition_end(cls, name: str) -> datetime:
+        """Exclusive upper bound of a partition's time range"""
+        span = timedelta(weeks=1) if name.startswith('telemetry_w') else timedelta(days=1)
+        return cls.partition_start(name) + span
+
+    def key_for(self, conn: sqlite3.Connection, device_id: str) -> int:
+        """Integer surrogate key for a device_id, allocated on first use"""
+        key = self.device_keys.get(device_id)
+        if key is None:
+            conn.execute('INSERT OR IGNORE INTO device_keys (device_id) VALUES (?)', (device_id,))
+            key = conn.execute('SELECT device_key FROM device_keys WHERE device_id = ?', (device_id,)).fetchone()[0]
+            self.device_keys[device_id] = key
+            self.device_ids[key] = device_id
+        return key
+
+    def load(self, conn: sqlite3.Connection):
+        """Discover existing partition tables and device keys"""
+        rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'telemetry_%'").fetchall()
+        self.known = frozenset(row[0] for row in rows if self.NAME_PATTERN.match(row[0]))
+        self.device_keys = dict(conn.execute('SELECT device_id, device_key FROM device_keys').fetchall())
+        self.device_ids = {key: device_id for device_id, key in self.device_keys.items()}
+
+    def upgrade(self, conn: sqlite3.Connection):
+        """Move tables written by older schema versions aside for background migration"""
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (self.VIEW,)).fetchone()
+        if row and row[0] == 'view':
+            conn.execute(f'DROP VIEW {self.VIEW}')
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND (name = 'telemetry' OR name LIKE 'telemetry_%')"
+        )]
+        sources = [name for name in tables
+                   if name in ('telemetry', 'telemetry_legacy') or self.NAME_PATTERN.match(name)]
+        for name in sources:
+            target = self.MIGRATION_PREFIX + name
+            conn.execute(f'ALTER TABLE {name} RENAME TO {target}')
+            conn.execute(f'''
+                INSERT OR IGNORE INTO device_keys (device_id)
+                SELECT DISTINCT device_id FROM {target} WHERE device_id IS NOT NULL
+            ''')
+        conn.execute("DELETE FROM gateway_meta WHERE key = 'telemetry_legacy_until'")
+        conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        if sources:
+            logger.info(f"Telemetry schema upgraded to v{self.SCHEMA_VERSION}, migrating {len(sources)} tables in the background")
+
+    def migration_sources(self, conn: sqlite3.Connection) -> List[str]:
+        rows = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ORDER BY name",
+            (self.MIGRATION_PREFIX + 'telemetry%',)
+        ).fetchall()
+        self.pending_sources = [row[0] for row in rows]
+        return list(self.pending_sources)
+
+    @staticmethod
+    def source_select(source: str) -> str:
+        """SELECT converting a not yet migrated table to the compact column layout"""
+        return f'''
+            SELECT k.device_key AS device_key,
+                   CAST(ROUND((julianday(s.timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER) AS ts,
+                   s.temperature AS temperature, s.humidity AS humidity, s.wifi_rssi AS wifi_rssi,
+                   s.free_heap AS free_heap, s.uptime AS uptime, s.custom_data AS custom_data
+            FROM {source} s JOIN device_keys k ON k.device_id = s.device_id
+        '''
+
+    def range_select(self, start_ms: int, end_ms: int, device_key: Optional[int] = None) -> tuple:
+        """UNION ALL over only the partitions overlapping [start_ms, end_ms], with its parameters"""
+        where = 'ts BETWEEN ? AND ?'
+        params: tuple = (start_ms, end_ms)
+        if device_key is not None:
+            where = 'device_key = ? AND ' + where
+            params = (device_key,) + params
+
+        start = datetime.fromtimestamp(start_ms / 1000)
+        end = datetime.fromtimestamp(end_ms / 1000)
+        tables = [name for name in sorted(self.known)
+                  if self.partition_start(name) <= end and self.partition_end(name) > start]
+        # Rows not yet migrated are converted on the fly
+        tables.extend(f'({self.source_select(source)})' for source in self.pending_sources)
+        if not tables:
+            return f'SELECT {self.COLUMNS} FROM {self.VIEW} WHERE 0', ()
+
+        arms = [f'SELECT {self.COLUMNS} FROM {table} WHERE {where}' for table in tables]
+        return '\nUNION ALL\n'.join(arms), params * len(tables)
+
+    def ensure(self, conn: sqlite3.Connection, name: str) -> bool:
+        """Create a partition table if needed, returning True when it was created"""
+        if name in self.known:
+            return False
+        # Clustered on (device_key, ts) so per-device range scans read contiguous pages;
+        # seq keeps readings that share a millisecond apart
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {name} (
+                device_key INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                temperature REAL,
+                humidity REAL,
+                wifi_rssi INTEGER,
+                free_heap INTEGER,
+                uptime INTEGER,
+                custom_data TEXT,
+                PRIMARY KEY (device_key, ts, seq)
+            ) WITHOUT ROWID
+        ''')
+        self.known = self.known | {name}
+        return True
+
+    def rebuild_view(self, conn: sqlite3.Connection):
+        """Recreate the union view over all partitions and not yet migrated tables"""
+        arms = [f'SELECT {self.COLUMNS} FROM {name}' for name in sorted(self.known)]
+        arms.extend(self.source_select(source) for source in self.migration_sources(conn))
+        conn.execute(f'DROP VIEW IF EXISTS {self.VIEW}')
+        if arms:
+            union = '\nUNION ALL\n'.join(arms)
+        else:
+            union = f'SELECT {", ".join("NULL AS " + c for c in self.COLUMNS.split(", "))} WHERE 0'
+        conn.execute(f'CREATE VIEW {self.VIEW} AS {union}')
+
+    def migrate_chunk(self, conn: sqlite3.Connection, limit: int = 5000) -> int:
+        """Copy up to limit rows from the oldest migration source, returning the number moved"""
+        for source in self.migration_sources(conn):
+            rows = conn.execute(f'''
+                SELECT rowid, device_id, timestamp, temperature, humidity, wifi_rssi, free_heap, uptime, custom_data
+                FROM {source} ORDER BY rowid LIMIT ?
+            ''', (limit,)).fetchall()
+
+            with conn:
+                if not rows:
+                    conn.execute(f'DROP TABLE {source}')
+                    self.rebuild_view(conn)
+                    logger.info(f"Finished migrating {source}")
+                    continue
+
+                rows_by_partition: Dict[str, list] = {}
+                for rowid, device_id, timestamp, *values in rows:
+                    if not device_id or not timestamp:
+                        continue
+                    try:
+                        ts = datetime.fromisoformat(timestamp)
+                    except (TypeError, ValueError):
+                        continue
+                    # Negative source rowids keep legacy duplicates apart and clear of live sequence numbers
+                    rows_by_partition.setdefault(self.partition_for(ts), []).append(
+                        (self.key_for(conn, device_id), int(ts.timestamp() * 1000), *values, -rowid)
+                    )
+
+                self._copy_rows(conn, rows_by_partition)
+                conn.execute(f'DELETE FROM {source} WHERE rowid <= ?', (rows[-1][0],))
+            return len(rows)
+        return 0
+
+    def _copy_rows(self, conn: sqlite3.Connection, rows_by_partition: Dict[str, list]):
+        # Rows carry their own seq, so a repeated copy is ignored rather than duplicated
+        created = False
+        for table, table_rows in rows_by_partition.items():
+            created |= self.ensure(conn, table)
+            conn.executemany(TelemetryWriter.INSERT_SQL.format(
+                table=table, verb='INSERT OR IGNORE', seq='?9'
+            ), table_rows)
+        if created:
+            self.rebuild_view(conn)
+
+    def stored_span(self, conn: sqlite3.Connection, device_key: int) -> Optional[tuple]:
+        """(oldest, newest) stored timestamp of a device, or None when it has no rows"""
+        names = sorted(self.known, key=self.partition_start)
+        span = []
+        # Partitions are ordered by time, so each end stops at the first one holding the device
+        for aggregate, order in (('MIN', names), ('MAX', reversed(names))):
+            for name in order:
+                ts = conn.execute(
+                    f'SELECT {aggregate}(ts) FROM {name} WHERE device_key = ?', (device_key,)
+                ).fetchone()[0]
+                if ts is not None:
+                    span.append(ts)
+                    break
+            else:
+                return None
+        return tuple(span)
+
+    def drop_expired(self, conn: sqlite3.Connection, cutoff: datetime) -> List[str]:
+        """Drop every partition whose whole time range is older than the cutoff"""
+        expired = [name for name in self.known if self.partition_end(name) <= cutoff]
+        if not expired:
+            return []
+        with conn:
+            for name in expired:
+                conn.execute(f'DROP TABLE IF EXISTS {name}')
+            self.known = self.known.difference(expired)
+            self.rebuild_view(conn)
+        return sorted(expired)
+
+class TelemetryRollups:
+    """Incrementally maintained 1-minute, 15-minute and hourly aggregates of raw telemetry"""
+
+    # (name, bucket size in ms, source level or None for raw partitions)
+    LEVELS = (
+        ('1m', 60000, None),
+        ('15m', 900000, '1m'),
+        ('1h', 3600000, '15m'),
+    )
+    METRICS = ('temperature', 'humidity', 'wifi_rssi')
+
+    def __init__(self, partitions: TelemetryPartitions, retention_days: Dict[str, float],
+                 lateness: float = 60.0, max_step: float = 21600.0):
+        self.partitions = partitions
+        self.retention_days = retention_days
+        self.lateness_ms = int(lateness * 1000)
+        self.max_step_ms = int(max_step * 1000)
+        self.sizes = {name: size for name, size, _ in self.LEVELS}
+        self.watermarks: Dict[str, int] = {}
+        # (device_key, 1m bucket) of rows written behind the 1m watermark, recomputed on the next step
+        self.late: set = set()
+
+    def ensure_tables(self, conn: sqlite3.Connection):
+        """Create one aggregate table per level"""
+        metric_columns = ',\n'.join(
+            f'{m}_min REAL, {m}_max REAL, {m}_sum REAL, {m}_count INTEGER' for m in self.METRICS
+        )
+        for name, _, _ in self.LEVELS:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS rollup_{name} (
+                    device_key INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    count INTEGER,
+                    {metric_columns},
+                    PRIMARY KEY (device_key, bucket)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_rollup_{name}_bucket ON rollup_{name}(bucket)')
+
+    def load(self, conn: sqlite3.Connection):
+        """Read each level's watermark; buckets before it are complete"""
+        rows = conn.execute("SELECT key, value FROM gateway_meta WHERE key LIKE 'rollup_%_watermark'").fetchall()
+        self.watermarks = {key[len('rollup_'):-len('_watermark')]: int(value) for key, value in rows}
+
+    def _save_watermark(self, conn: sqlite3.Connection, level: str, value: int):
+        conn.execute(
+            'INSERT OR REPLACE INTO gateway_meta (key, value) VALUES (?, ?)',
+            (f'rollup_{level}_watermark', str(value))
+        )
+        self.watermarks[level] = value
+
+    def _initial_watermark(self, size: int, now_ms: int) -> int:
+        # Every level starts from the oldest raw partition
+        known = self.partitions.known
+        if not known:
+            return now_ms // size * size
+        oldest = min(self.partitions.partition_start(name) for name in known)
+        return int(oldest.timestamp() * 1000) // size * size
+
+    def note_written(self, rows: List[tuple]):
+        """Remember the completed buckets that freshly written (device_key, ts, ...) rows fall into"""
+        watermark = self.watermarks.get('1m')
+        if watermark is None:
+            return
+        size = self.sizes['1m']
+        for row in rows:
+            if row[1] < watermark:
+                self.late.add((row[0], row[1] // size * size))
+
+    def _aggregate(self, conn: sqlite3.Connection, level: str, size: int, source: Optional[str],
+                   start: int, end: int, device_key: Optional[int] = None):
+        # (Re)build the level's buckets in [start, end) from the level below
+        if source is None:
+            union, params = self.partitions.range_select(start, end - 1, device_key)
+            metrics = ', '.join(
+                f'MIN({m}), MAX({m}), SUM({m}), COUNT({m})' for m in self.METRICS
+            )
+            select = f'''
+                SELECT device_key, (ts / {size}) * {size} AS b, COUNT(*), {metrics}
+                FROM ({union}) GROUP BY device_key, b
+            '''
+        else:
+            where = 'bucket >= ? AND bucket < ?'
+            params = (start, end)
+            if device_key is not None:
+                where = 'device_key = ? AND ' + where
+                params = (device_key,) + params
+            metrics = ', '.join(
+                f'MIN({m}_min), MAX({m}_max), SUM({m}_sum), SUM({m}_count)' for m in self.METRICS
+            )
+            select = f'''
+                SELECT device_key, (bucket / {size}) * {size} AS b, SUM(count), {metrics}
+                FROM rollup_{source} WHERE {where} GROUP BY device_key, b
+            '''
+        conn.execute(f'INSERT OR REPLACE INTO rollup_{level} {select}', params)
+
+    def _recompute_late(self, conn: sqlite3.Connection):
+        # Each level redoes the buckets containing a late row that it has already passed
+        buckets = self.late
+        recomputed = 0
+        for level, size, source in self.LEVELS:
+            watermark = self.watermarks.get(level)
+            if watermark is None:
+                break
+            buckets = {(key, bucket // size * size) for key, bucket in buckets if bucket < watermark}
+            for device_key, bucket in buckets:
+                self._aggregate(conn, level, size, source, bucket, bucket + size, device_key)
+            recomputed += len(buckets)
+        logger.debug(f"Recomputed {recomputed} rollup buckets for late telemetry")
+
+    def step(self, conn: sqlite3.Connection, now_ms: int) -> bool:
+        """Advance every level by at most one bounded step, returning True while behind"""
+        # Old-layout rows would land behind the watermark, so wait for the migration
+        if self.partitions.pending_sources:
+            return False
+
+        behind = False
+        with conn:
+            if self.late:
+                self._recompute_late(conn)
+            for level, size, source in self.LEVELS:
+                if source is None:
+                    limit = (now_ms - self.lateness_ms) // size * size
+                else:
+                    limit = self.watermarks.get(source, 0) // size * size
+                start = self.watermarks.get(level)
+                if start is None:
+                    start = self._initial_watermark(size, now_ms)
+                end = min(limit, start + max(size, self.max_step_ms // size * size))
+                if end <= start:
+                    continue
+
+                self._aggregate(conn, level, size, source, start, end)
+                self._save_watermark(conn, level, end)
+                behind |= end < limit
+        # Cleared only once committed, so a failed step retries them
+        self.late.clear()
+        return behind
+
+    def drop_expired(self, conn: sqlite3.Connection, now: datetime) -> Dict[str, int]:
+        """Apply each level's retention, returning deleted rows per level"""
+        deleted = {}
+        with conn:
+            for level, _, _ in self.LEVELS:
+                cutoff = now - timedelta(days=self.retention_days[level])
+                cursor = conn.execute(
+                    f'DELETE FROM rollup_{level} WHERE bucket < ?', (int(cutoff.timestamp() * 1000),)
+                )
+                if cursor.rowcount > 0:
+                    deleted[level] = cursor.rowcount
+        return deleted
+
+    def choose_level(self, interval_ms: int, start_ms: int, now: datetime) -> Optional[str]:
+        """Coarsest level whose buckets divide the interval and whose retention covers the start"""
+        for level, size, _ in reversed(self.LEVELS):
+            if interval_ms % size or level not in self.watermarks:
+                continue
+            cutoff = now - timedelta(days=self.retention_days[level])
+            if start_ms >= int(cutoff.timestamp() * 1000):
+                return level
+        return None
+
+    def aggregate_select(self, level: Optional[str], interval_ms: int, start_ms: int, end_ms: int,
+                         device_key: Optional[int] = None) -> tuple:
+        """Bucketed aggregates from a rollup level, topped up with raw rows past its watermark"""
+        start_ms = start_ms // interval_ms * interval_ms
+        raw_start = start_ms
+        arms = []
+        params: tuple = ()
+
+        if level:
+            watermark = self.watermarks[level]
+            rollup_end = min(end_ms + 1, watermark)
+            columns = ', '.join(f'{m}_min, {m}_max, {m}_sum, {m}_count' for m in self.METRICS)
+            where = 'bucket >= ? AND bucket < ?'
+            rollup_params: tuple = (start_ms, rollup_end)
+            if device_key is not None:
+                where = 'device_key = ? AND ' + where
+                rollup_params = (device_key,) + rollup_params
+            arms.append(f'SELECT device_key, bucket, count, {columns} FROM rollup_{level} WHERE {where}')
+            params += rollup_params
+            raw_start = max(start_ms, watermark)
+
+        if raw_start <= end_ms:
+            union, raw_params = self.partitions.range_select(raw_start, end_ms, device_key)
+            # Raw rows are shaped as single-reading partial aggregates
+            columns = ', '.join(
+                f'{m} AS {m}_min, {m} AS {m}_max, {m} AS {m}_sum, {m} IS NOT NULL AS {m}_count'
+                for m in self.METRICS
+            )
+            arms.append(f'SELECT device_key, ts AS bucket, 1 AS count, {columns} FROM ({union})')
+            params += raw_params
+
+        metrics = ', '.join(
+            f'MIN({m}_min), MAX({m}_max), SUM({m}_sum) / SUM({m}_count)' for m in self.METRICS
+        )
+        union = '\nUNION ALL\n'.join(arms)
+        sql = f'''
+            SELECT device_key, (bucket / {interval_ms}) * {interval_ms} AS b, SUM(count), {metrics}
+            FROM ({union})
+            GROUP BY device_key, b
+            ORDER BY device_key, b
+        '''
+        return sql, params
+
+class RunningStats:
+    """Count, mean, variance, min and max of a stream; panes combine with Chan's parallel merge"""
+
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        # Welford's update keeps the variance stable without storing samples
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: 'RunningStats'):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def stddev(self) -> float:
+        """Population standard deviation"""
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+    def as_dict(self) -> Optional[Dict]:
+        if not self.count:
+            return None
+        return {'count': self.count, 'mean': self.mean, 'min': self.min, 'max': self.max, 'stddev': self.stddev}
+
+class WindowAggregator:
+    """Per-device tumbling and sliding window statistics, updated in O(1) per reading.
+    Readings land in panes one slide long; a window of k slides merges its k panes once, when it closes."""
+
+    FIELDS = ('temperature', 'humidity', 'wifi_rssi', 'free_heap')
+
+    def __init__(self, windows: List[tuple], fields: tuple = ('temperature', 'humidity'),
+                 lateness: float = 5.0, now: Optional[float] = None):
+        if not windows:
+            raise ValueError("No aggregation windows configured")
+        for size, slide in windows:
+            if slide <= 0 or size < slide or not math.isclose(size / slide, round(size / slide)):
+                raise ValueError(f"Window size {size:g}s must be a positive multiple of its slide {slide:g}s")
+        unknown = set(fields) - set(self.FIELDS)
+        if unknown or not fields:
+            raise ValueError(f"Cannot aggregate fields: {', '.join(sorted(unknown)) or 'none given'}")
+        self.windows = windows
+        self.fields = tuple(fields)
+        self.lateness = lateness
+
+        # Panes per slide length: pane index -> device_id -> RunningStats per field
+        self.panes: Dict[float, Dict[int, Dict[str, list]]] = {}
+        # Longest window, in panes, built from each slide length
+        self.spans: Dict[float, int] = {}
+        for size, slide in windows:
+            self.panes.setdefault(slide, {})
+            self.spans[slide] = max(self.spans.get(slide, 0), round(size / slide))
+        # Every window ending at or before pane index closed[slide] has been emitted
+        now = time.time() if now is None else now
+        self.closed = {slide: self._close_index(slide, now) for slide in self.panes}
+
+        self.late = 0
+        self.emitted = 0
+
+    @staticmethod
+    def parse_windows(spec: str) -> List[tuple]:
+        """'60, 300/60' -> [(60, 60), (300, 60)]: tumbling, or size/slide for sliding windows, in seconds"""
+        windows = []
+        for item in spec.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            size, _, slide = item.partition('/')
+            try:
+                windows.append((float(size), float(slide or size)))
+            except ValueError:
+                raise ValueError(f"Invalid aggregation window: {item}")
+        return windows
+
+    def _close_index(self, slide: float, now: float) -> int:
+        return int((now - self.lateness) // slide)
+
+    def add(self, telemetry: TelemetryData):
+        """Fold one reading into its pane of every slide length that still has an open window over it"""
+        values = [getattr(telemetry, field) for field in self.fields]
+        ts = telemetry.timestamp.timestamp()
+        device_id = telemetry.device_id
+        late = False
+        for slide, panes in self.panes.items():
+            index = int(ts // slide)
+            closed = self.closed[slide]
+            # A pane behind the close index still feeds the longer windows of this slide that are open
+            if index < closed:
+                late = True
+                if index <= closed - self.spans[slide]:
+                    continue
+            devices = panes.get(index)
+            if devices is None:
+                devices = panes[index] = {}
+            stats = devices.get(device_id)
+            if stats is None:
+                stats = devices[device_id] = [RunningStats() for _ in self.fields]
+            for stat, value in zip(stats, values):
+                if isinstance(value, (int, float)):
+                    stat.add(value)
+        if late:
+            self.late += 1
+
+    def next_close(self) -> float:
+        """Wall-clock time at which the next window can be emitted"""
+        return min((closed + 1) * slide + self.lateness for slide, closed in self.closed.items())
+
+    def emit(self, now: float) -> List[Dict]:
+        """Summaries of every window that closed by now, oldest first, releasing panes no longer needed"""
+        summaries = []
+        for slide, panes in self.panes.items():
+            close = self._close_index(slide, now)
+            for end in range(self.closed[slide] + 1, close + 1):
+                for size, window_slide in self.windows:
+                    if window_slide == slide:
+                        summaries.extend(self._summarize(panes, size, slide, end))
+            if close > self.closed[slide]:
+                self.closed[slide] = close
+                keep_from = close - self.spans[slide] + 1
+                for index in [index for index in panes if index < keep_from]:
+                    del panes[index]
+        self.emitted += len(summaries)
+        return summaries
+
+    def _summarize(self, panes: Dict[int, Dict[str, list]], size: float, slide: float, end: int) -> List[Dict]:
+        span = round(size / slide)
+        if span == 1:
+            merged = panes.get(end - 1, {})
+        else:
+            merged = {}
+            for index in range(end - span, end):
+                for device_id, stats in panes.get(index, {}).items():
+                    target = merged.get(device_id)
+                    if target is None:
+                        target = merged[device_id] = [RunningStats() for _ in self.fields]
+                    for into, pane in zip(target, stats):
+                        into.merge(pane)
+
+        end_ms = round(end * slide * 1000)
+        summaries = []
+        for device_id, stats in merged.items():
+            summary = {
+                'device_id': device_id,
+                'start': end_ms - round(size * 1000),
+                'end': end_ms,
+                'window': size,
+                'slide': slide,
+                'count': max(stat.count for stat in stats),
+            }
+            for field, stat in zip(self.fields, stats):
+                summary[field] = stat.as_dict()
+            summaries.append(summary)
+        return summaries
+
+    def ensure_table(self, conn: sqlite3.Connection):
+        """Create the table of emitted window summaries"""
+        field_columns = ',\n'.join(
+            f'{f}_count INTEGER, {f}_mean REAL, {f}_min REAL, {f}_max REAL, {f}_stddev REAL' for f in self.FIELDS
+        )
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS telemetry_windows (
+                device_key INTEGER NOT NULL,
+                size_ms INTEGER NOT NULL,
+                slide_ms INTEGER NOT NULL,
+                start_ms INTEGER NOT NULL,
+                count INTEGER,
+                {field_columns},
+                PRIMARY KEY (device_key, size_ms, slide_ms, start_ms)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_windows_start ON telemetry_windows(start_ms)')
+
+    def store(self, conn: sqlite3.Connection, summaries: List[Dict], key_for) -> int:
+        """Write summaries on the writer thread; key_for maps a device id to its device_key"""
+        columns = ['device_key', 'size_ms', 'slide_ms', 'start_ms', 'count']
+        for field in self.fields:
+            columns.extend(f'{field}_{stat}' for stat in ('count', 'mean', 'min', 'max', 'stddev'))
+        rows = []
+        for summary in summaries:
+            row = [key_for(conn, summary['device_id']), round(summary['window'] * 1000),
+                   round(summary['slide'] * 1000), summary['start'], summary['count']]
+            for field in self.fields:
+                stats = summary[field]
+                row.extend((stats['count'], stats['mean'], stats['min'], stats['max'], stats['stddev'])
+                           if stats else (0, None, None, None, None))
+            rows.append(row)
+        with conn:
+            conn.executemany(
+                f'INSERT OR REPLACE INTO telemetry_windows ({", ".join(columns)}) '
+                f'VALUES ({", ".join("?" * len(columns))})', rows
+            )
+        return len(rows)
+
+    @staticmethod
+    def drop_expired(conn: sqlite3.Connection, cutoff_ms: int) -> int:
+        with conn:
+            return conn.execute('DELETE FROM telemetry_windows WHERE start_ms < ?', (cutoff_ms,)).rowcount
+
+    def open_panes(self) -> int:
+        return sum(len(devices) for panes in self.panes.values() for devices in panes.values())
+
+class TelemetryWriter:
+    """Long-lived SQLite writer that batches telemetry inserts on its own thread"""
+
+    INSERT_SQL = '''
+        {verb} INTO {table}
+        (device_key, ts, seq, temperature, humidity, wifi_rssi, free_heap, uptime, custom_data)
+        VALUES (?1, ?2, {seq}, ?3, ?4, ?5, ?6, ?7, ?8)
+    '''
+    # Next free sequence number for the row's (device_key, ts); never negative, those belong to migrated rows.
+    # Only rows inside the time span already stored for their device need it
+    NEXT_SEQ = '(SELECT MAX(IFNULL(MAX(seq) + 1, 0), 0) FROM {table} WHERE device_key = ?1 AND ts = ?2)'
+
+    def __init__(self, db: GatewayDatabase, partitions: TelemetryPartitions,
+                 batch_size: int = 500, flush_interval: float = 1.0,
+                 metrics: Optional[GatewayMetrics] = None,
+                 rollups: Optional['TelemetryRollups'] = None):
+        self.db = db
+        self.partitions = partitions
+        self.rollups = rollups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._buffer: List[TelemetryData] = []
+        self._tasks: List[tuple] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        # device_key -> [oldest, newest] ts written, never narrower than what is stored; writer thread only
+        self._spans: Dict[int, list] = {}
+
+        self.batches = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.flush_seconds = metrics.histogram(
+            'gateway_db_flush_seconds', 'Duration of telemetry batch commits'
+        ) if metrics else None
+        self.flush_errors = metrics.counter(
+            'gateway_db_flush_errors_total', 'Telemetry batches that failed to commit'
+        ) if metrics else None
+
+    def start(self):
+        """Start the background writer thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='telemetry-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """Flush pending records and stop the writer thread"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        stats = self.get_stats()
+        logger.info(
+            f"Telemetry writer stopped: {stats['rows_written']} rows in {stats['batches']} batches, "
+            f"avg batch {stats['avg_batch_size']:.1f}, avg flush {stats['avg_flush_ms']:.2f} ms, "
+            f"max flush {stats['max_flush_ms']:.2f} ms"
+        )
+
+    def add(self, telemetry: TelemetryData):
+        """Queue a telemetry record for the next batch"""
+        with self._cond:
+            self._buffer.append(telemetry)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def add_many(self, records: List[TelemetryData]):
+        """Queue several records together; they are committed in the same transaction"""
+        with self._cond:
+            self._buffer.extend(records)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def call(self, func, *args) -> concurrent.futures.Future:
+        """Run func(conn, *args) on the writer thread after the pending batch"""
+        future = concurrent.futures.Future()
+        with self._cond:
+            self._tasks.append((func, args, future))
+            self._cond.notify()
+        return future
+
+    def pending(self) -> int:
+        """Number of records waiting to be flushed"""
+        with self._cond:
+            return len(self._buffer)
+
+    def get_stats(self) -> Dict:
+        """Batch size and flush latency statistics for tuning"""
+        return {
+            'batches': self.batches,
+            'rows_written': self.rows_written,
+            'errors': self.errors,
+            'pending': self.pending(),
+            'last_batch_size': self.last_batch_size,
+            'avg_batch_size': self.rows_written / self.batches if self.batches else 0.0,
+            'last_flush_ms': self.last_flush_ms,
+            'avg_flush_ms': self.total_flush_ms / self.batches if self.batches else 0.0,
+            'max_flush_ms': self.max_flush_ms,
+        }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._running and len(self._buffer) < self.batch_size and not self._tasks:
+                    self._cond.wait(self.flush_interval)
+                batch, self._buffer = self._buffer, []
+                tasks, self._tasks = self._tasks, []
+                stopping = not self._running
+
+            if batch:
+                with self.db.writer() as conn:
+                    self._write_batch(conn, batch)
+            for func, args, future in tasks:
+                try:
+                    with self.db.writer() as conn:
+                        future.set_result(func(conn, *args))
+                except Exception as e:
+                    future.set_exception(e)
+            if stopping:
+                break
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[TelemetryData]):
+        started = time.perf_counter()
+        try:
+            with conn:
+                # Route each row to the partition covering its timestamp. A row outside the span
+                # already written for its device cannot collide and takes seq 0; rows inside it,
+                # including repeats within this batch, look up the next free seq on insert
+                rows_by_partition: Dict[str, list] = {}
+                inside_by_partition: Dict[str, list] = {}
+                partition_for = self.partitions.partition_for
+                key_for = self.partitions.key_for
+                spans = self._spans
+                for t in batch:
+                    key = key_for(conn, t.device_id)
+                    ts = int(t.timestamp.timestamp() * 1000)
+                    row = (
+                        key, ts, t.temperature, t.humidity, t.wifi_rssi, t.free_heap, t.uptime,
+                        json.dumps(t.custom_data, separators=(',', ':')) if t.custom_data else None, 0
+                    )
+                    span = spans.get(key)
+                    if span is None:
+                        stored = self.partitions.stored_span(conn, key)
+                        span = spans[key] = list(stored) if stored else [math.inf, -math.inf]
+                    if span[0] <= ts <= span[1]:
+                        inside_by_partition.setdefault(partition_for(t.timestamp), []).append(row[:8])
+                        continue
+                    rows_by_partition.setdefault(partition_for(t.timestamp), []).append(row)
+                    # Widened before the commit: a rolled back batch only sends more rows to the lookup
+                    if ts < span[0]:
+                        span[0] = ts
+                    if ts > span[1]:
+                        span[1] = ts
+
+                created = False
+                for table, rows in rows_by_partition.items():
+                    created |= self.partitions.ensure(conn, table)
+                    conn.executemany(self.INSERT_SQL.format(table=table, verb='INSERT', seq='?9'), rows)
+                # After the rows above, so a repeat sees the reading it repeats
+                for table, rows in inside_by_partition.items():
+                    created |= self.partitions.ensure(conn, table)
+                    conn.executemany(self.INSERT_SQL.format(
+                        table=table, verb='INSERT', seq=self.NEXT_SEQ.format(table=table)
+                    ), rows)
+                if created:
+                    self.partitions.rebuild_view(conn)
+        except Exception as e:
+            self.errors += 1
+            if self.flush_errors:
+                self.flush_errors.inc()
+            logger.error(f"Error writing telemetry batch of {len(batch)} rows: {e}")
+            return
+        # Readings older than the rollup watermark (batched or delayed) reopen their buckets
+        if self.rollups:
+            for partitions in (rows_by_partition, inside_by_partition):
+                for rows in partitions.values():
+                    self.rollups.note_written(rows)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.batches += 1
+        self.rows_written += len(batch)
+        self.last_batch_size = len(batch)
+        self.last_flush_ms = elapsed_ms
+        self.total_flush_ms += elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        if self.flush_seconds:
+            self.flush_seconds.observe(elapsed_ms / 1000)
+        logger.debug(f"Flushed {len(batch)} telemetry rows in {elapsed_ms:.2f} ms")
+
+class IngestQueue:
+    """Bounded queue bridging raw MQTT messages from paho's network thread into asyncio"""
+
+    POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, maxsize: int = 10000, policy: str = 'drop_oldest'):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown ingest backpressure policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+
+        # The bound is enforced by the producer under the lock, not by the loop
+        self._items: deque = deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ready: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._in_progress = 0
+        self.closed = False
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Attach the queue to the event loop running the consumer"""
+        self.loop = loop
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self.closed = False
+
+    def close(self):
+        """Stop accepting new messages"""
+        with self._lock:
+            self.closed = True
+            self._not_full.notify_all()
+
+    def put_threadsafe(self, item: tuple):
+        """Enqueue a message from a foreign thread, applying the backpressure policy"""
+        with self._lock:
+            if not self.closed and len(self._items) >= self.maxsize:
+                if self.policy == 'block':
+                    # Block the network thread until the consumer frees a slot
+                    while not self.closed and len(self._items) >= self.maxsize:
+                        self._not_full.wait(1.0)
+                elif self.policy == 'drop_newest':
+                    self._record_drop()
+                    return
+                else:
+                    self._items.popleft()
+                    self._record_drop()
+            if self.closed or not self.loop:
+                self._record_drop()
+                return
+
+            self._items.append(item)
+            self.enqueued += 1
+            depth = len(self._items)
+            if depth > self.max_depth:
+                self.max_depth = depth
+        # Only the transition from empty needs to wake the consumer
+        if depth == 1:
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    def _record_drop(self):
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning(f"Ingest queue full ({self.policy}), {self.dropped} messages dropped so far")
+
+    async def get(self) -> tuple:
+        """Wait for the next raw message"""
+        while True:
+            with self._lock:
+                if self._items:
+                    item = self._items.popleft()
+                    self._not_full.notify()
+                    self._in_progress += 1
+                    return item
+                self._ready.clear()
+            await self._ready.wait()
+
+    def task_done(self):
+        self._in_progress -= 1
+        if not self._in_progress:
+            self._idle.set()
+
+    async def join(self):
+        """Wait until every queued message has been processed"""
+        while self._idle and (self._items or self._in_progress):
+            self._idle.clear()
+            await self._idle.wait()
+
+    def depth(self) -> int:
+        return len(self._items)
+
+    def get_stats(self) -> Dict:
+        """Queue depth and drop counters"""
+        return {
+            'depth': self.depth(),
+            'max_depth': self.max_depth,
+            'capacity': self.maxsize,
+            'policy': self.policy,
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+        }
+
+class CloudOutbox:
+    """On-disk store-and-forward queue for cloud uploads that could not be delivered"""
+
+    def __init__(self, db: GatewayDatabase):
+        self.db = db
+        self.pending = self.count_pending()
+
+    def add(self, records: List[bytes]):
+        """Persist undelivered records"""
+        created_at = datetime.now().isoformat()
+        with self.db.writer() as conn, conn:
+            conn.executemany(
+                'INSERT INTO cloud_outbox (created_at, record) VALUES (?, ?)',
+                [(created_at, record.decode()) for record in records]
+            )
+        self.pending += len(records)
+
+    def claim(self, limit: int, exclude: set) -> List[tuple]:
+        """Oldest unacknowledged records, skipping ids already in flight"""
+        with self.db.reader() as conn:
+            rows = conn.execute(
+                'SELECT id, record FROM cloud_outbox WHERE acked_at IS NULL ORDER BY id LIMIT ?',
+                (limit + len(exclude),)
+            ).fetchall()
+        return [row for row in rows if row[0] not in exclude][:limit]
+
+    def ack(self, ids: List[int]):
+        """Mark records as acknowledged by the cloud"""
+        acked_at = datetime.now().isoformat()
+        with self.db.writer() as conn, conn:
+            cursor = conn.executemany(
+                'UPDATE cloud_outbox SET acked_at = ? WHERE id = ? AND acked_at IS NULL',
+                [(acked_at, record_id) for record_id in ids]
+            )
+        # Only rows that were still pending; a repeated ack must not drift the counter
+        self.pending = max(0, self.pending - cursor.rowcount)
+
+    def count_pending(self) -> int:
+        with self.db.reader() as conn:
+            return conn.execute('SELECT COUNT(*) FROM cloud_outbox WHERE acked_at IS NULL').fetchone()[0]
+
+    def prune(self, acked_before: datetime) -> int:
+        """Delete acknowledged records older than the cutoff"""
+        with self.db.writer() as conn, conn:
+            cursor = conn.execute(
+                'DELETE FROM cloud_outbox WHERE acked_at IS NOT NULL AND acked_at < ?',
+                (acked_before.isoformat(),)
+            )
+        return cursor.rowcount
+
+class CloudForwarder:
+    """Batches gateway messages and uploads them compressed over one pooled HTTP session"""
+
+    COMPRESSIONS = ('gzip', 'zstd', 'none')
+
+    def __init__(self, api_url: str, api_token: str, gateway_id: str,
+                 sync_interval: float = 300.0, max_batch_records: int = 1000,
+                 max_batch_bytes: int = 262144, compression: str = 'gzip',
+                 compression_level: int = 6, connection_limit: int = 4,
+                 keepalive_timeout: float = 60.0, request_timeout: float = 30.0,
+                 queue_size: int = 100000, outbox: Optional[CloudOutbox] = None,
+                 drain_batch_records: int = 5000, drain_concurrency: int = 2,
+                 drain_rate: float = 2000.0, retry_initial: float = 5.0,
+                 retry_max: float = 300.0, metrics: Optional[GatewayMetrics] = None):
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"Unknown cloud compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            logger.warning("zstandard is not installed, falling back to gzip compression")
+            compression = 'gzip'
+
+        self.api_url = api_url.rstrip('/')
+        self.api_token = api_token
+        self.gateway_id = gateway_id
+        self.sync_interval = sync_interval
+        self.max_batch_records = max_batch_records
+        self.max_batch_bytes = max_batch_bytes
+        self.compression = compression
+        self.compression_level = compression_level
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.queue_size = queue_size
+        self.outbox = outbox
+        self.drain_batch_records = drain_batch_records
+        self.drain_concurrency = drain_concurrency
+        self.drain_rate = drain_rate
+        self.retry_initial = retry_initial
+        self.retry_max = retry_max
+        self.metrics = metrics
+        self.post_seconds = metrics.histogram(
+            'gateway_cloud_post_seconds', 'Cloud API POST latency, including failed attempts'
+        ) if metrics else None
+
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_needed: Optional[asyncio.Event] = None
+        self._send_slots: Optional[asyncio.Semaphore] = None
+        self._in_flight: set = set()
+        # Records of live uploads that are neither acknowledged nor handed to the outbox yet
+        self._unsent: Dict[asyncio.Task, List[bytes]] = {}
+        self._drain_task: Optional[asyncio.Task] = None
+        self._drain_wakeup: Optional[asyncio.Event] = None
+        self._drain_slots: Optional[asyncio.Semaphore] = None
+        self._claimed: set = set()
+        self._drain_next = 0.0
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._zstd = zstandard.ZstdCompressor(level=compression_level) if compression == 'zstd' else None
+
+        # Records are serialized once on submit and joined into the batch on flush.
+        # Until a batch is uploaded or spilled it lives only in memory: a crash or power
+        # loss can lose up to sync_interval of records, which is accepted since the
+        # telemetry itself is already committed to the local database.
+        self._batch: deque = deque()
+        self._batch_bytes = 0
+
+        self.batches_sent = 0
+        self.records_sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.bytes_raw = 0
+        self.bytes_sent = 0
+        self.total_latency_ms = 0.0
+        self.last_batch_size = 0
+        self.last_compression_ratio = 0.0
+        self.spilled = 0
+        self.drained = 0
+
+    async def start(self):
+        """Open the pooled session and start the batch flush task"""
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._flush_needed = asyncio.Event()
+        self._send_slots = asyncio.Semaphore(self.connection_limit)
+        self._drain_wakeup = asyncio.Event()
+        self._drain_slots = asyncio.Semaphore(self.drain_concurrency)
+
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            headers={'Authorization': f"Bearer {self.api_token}"}
+        )
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        if self.outbox:
+            self._drain_task = asyncio.create_task(self._drain_loop())
+            if self.outbox.pending:
+                logger.info(f"Cloud outbox has {self.outbox.pending} undelivered records")
+                self._drain_wakeup.set()
+        logger.info(
+            f"Cloud forwarder started ({self.connection_limit} connections to {self.api_url}, "
+            f"sync every {self.sync_interval:g}s, {self.compression} compression)"
+        )
+
+    async def stop(self, timeout: float = 10.0):
+        """Upload what is buffered, then close the session; what misses the timeout goes to the outbox"""
+        if not self.session:
+            return
+        for task in (self._flush_task, self._drain_task):
+            if task:
+                task.cancel()
+        self._flush_task = None
+        self._drain_task = None
+        try:
+            await asyncio.wait_for(self.flush(), timeout=timeout)
+            if self._in_flight:
+                await asyncio.wait_for(asyncio.gather(*self._in_flight), timeout=timeout)
+        except asyncio.TimeoutError:
+            in_flight = list(self._in_flight)
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+            self._spill_unsent()
+        await self.session.close()
+        self.session = None
+
+    def _spill_unsent(self):
+        # Cancelled uploads keep their records in _unsent; replayed outbox rows are still stored
+        records = [record for records in self._unsent.values() for record in records]
+        records.extend(self._batch)
+        self._unsent.clear()
+        self._batch.clear()
+        self._batch_bytes = 0
+        if not records:
+            return
+        if self.outbox:
+            try:
+                self.outbox.add(records)
+                self.spilled += len(records)
+                logger.warning(f"Cloud forwarder stopped with {len(records)} records unsent, kept in the outbox")
+                return
+            except Exception as e:
+                logger.error(f"Error writing {len(records)} records to cloud outbox: {e}")
+        self.dropped += len(records)
+        logger.warning(f"Cloud forwarder stopped with {len(records)} records unsent, dropped")
+
+    def submit(self, payload: Dict):
+        """Add a message to the upload batch; safe to call from any thread"""
+        self.submit_raw(json.dumps(payload, separators=(',', ':')).encode())
+
+    def submit_raw(self, record: bytes):
+        """Add an already JSON-encoded message to the upload batch"""
+        if not self.loop:
+            self._record_drop()
+            return
+        if threading.get_ident() == self._loop_thread_id:
+            self._append(record)
+        else:
+            self.loop.call_soon_threadsafe(self._append, record)
+
+    def _append(self, record: bytes):
+        if len(self._batch) >= self.queue_size:
+            self._batch_bytes -= len(self._batch.popleft()) + 1
+            self._record_drop()
+        self._batch.append(record)
+        self._batch_bytes += len(record) + 1
+        if len(self._batch) >= self.max_batch_records or self._batch_bytes >= self.max_batch_bytes:
+            self._flush_needed.set()
+
+    def _record_drop(self):
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logger.warning(f"Cloud upload buffer full, {self.dropped} records dropped so far")
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.sync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Cut batches from the buffer and start uploading them"""
+        while self._batch:
+            # Bound the number of concurrent uploads to the connection pool size
+            await self._send_slots.acquire()
+            if not self._batch:
+                self._send_slots.release()
+                break
+
+            records = []
+            size = 0
+            while self._batch and len(records) < self.max_batch_records and size < self.max_batch_bytes:
+                record = self._batch.popleft()
+                records.append(record)
+                size += len(record) + 1
+            self._batch_bytes -= size
+
+            task = asyncio.create_task(self._send_batch(records))
+            self._in_flight.add(task)
+            self._unsent[task] = records
+            task.add_done_callback(self._send_done)
+
+    def _send_done(self, task: asyncio.Task):
+        self._in_flight.discard(task)
+        # A cancelled upload's records stay behind for stop() to spill
+        if not task.cancelled():
+            self._unsent.pop(task, None)
+
+    def encode_batch(self, records: List[bytes]) -> bytes:
+        """Build the JSON batch envelope around pre-serialized records"""
+        header = json.dumps({
+            'gateway_id': self.gateway_id,
+            'message_type': 'batch',
+            'timestamp': datetime.now().isoformat(),
+            'count': len(records)
+        }, separators=(',', ':')).encode()
+        return header[:-1] + b',"data":[' + b','.join(records) + b']}'
+
+    def compress(self, body: bytes) -> bytes:
+        """Compress a request body with the configured codec"""
+        if self.compression == 'gzip':
+            return gzip.compress(body, compresslevel=self.compression_level)
+        if self.compression == 'zstd':
+            return self._zstd.compress(body)
+        return body
+
+    async def _send_batch(self, records: List[bytes]):
+        task = asyncio.current_task()
+        try:
+            # While the uplink is backing off, go straight to the outbox
+            if time.monotonic() < self._retry_at:
+                self._unsent.pop(task, None)
+                await self._spill(records)
+            elif await self._upload(records):
+                self._unsent.pop(task, None)
+                self._on_upload_success()
+            else:
+                self._on_upload_failure()
+                # The outbox write runs to completion on its thread even if this task is cancelled
+                self._unsent.pop(task, None)
+                await self._spill(records)
+        finally:
+            self._send_slots.release()
+
+    async def _upload(self, records: List[bytes]) -> bool:
+        body = self.encode_batch(records)
+        compressed = self.compress(body)
+        headers = {'Content-Type': 'application/json'}
+        if self.compression != 'none':
+            headers['Content-Encoding'] = self.compression
+
+        started = time.perf_counter()
+        if not await self._post(compressed, headers):
+            self.failed += 1
+            return False
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        ratio = len(body) / len(compressed) if compressed else 0.0
+        self.batches_sent += 1
+        self.records_sent += len(records)
+        self.bytes_raw += len(body)
+        self.bytes_sent += len(compressed)
+        self.total_latency_ms += elapsed_ms
+        self.last_batch_size = len(records)
+        self.last_compression_ratio = ratio
+        logger.debug(
+            f"Uploaded batch of {len(records)} records: {len(body)} -> {len(compressed)} bytes "
+            f"(ratio {ratio:.1f}x, saved {len(body) - len(compressed)} bytes) in {elapsed_ms:.1f} ms"
+        )
+        return True
+
+    def _on_upload_success(self):
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        if self.outbox and self.outbox.pending:
+            self._drain_wakeup.set()
+
+    def _on_upload_failure(self):
+        self._backoff = min(self._backoff * 2, self.retry_max) if self._backoff else self.retry_initial
+        self._retry_at = time.monotonic() + self._backoff * random.uniform(0.5, 1.0)
+        logger.warning(f"Cloud uplink unavailable, retrying in {self._backoff:.0f}s")
+
+    async def _spill(self, records: List[bytes]):
+        if not self.outbox:
+            self.dropped += len(records)
+            return
+        try:
+            await asyncio.to_thread(self.outbox.add, records)
+            self.spilled += len(records)
+            self._drain_wakeup.set()
+        except Exception as e:
+            self.dropped += len(records)
+            logger.error(f"Error writing {len(records)} records to cloud outbox: {e}")
+
+    async def _drain_loop(self):
+        """Replay the outbox in large batches once the uplink is back"""
+        while True:
+            await self._drain_wakeup.wait()
+
+            delay = self._retry_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            await self._drain_slots.acquire()
+            try:
+                rows = await asyncio.to_thread(self.outbox.claim, self.drain_batch_records, self._claimed)
+            except Exception as e:
+                self._drain_slots.release()
+                logger.error(f"Error reading cloud outbox: {e}")
+                self._on_upload_failure()
+                continue
+            if not rows:
+                self._drain_slots.release()
+                self._drain_wakeup.clear()
+                continue
+
+            # Pace the replay so catching up never starves live uploads
+            now = time.monotonic()
+            wait = self._drain_next - now
+            self._drain_next = max(now, self._drain_next) + len(rows) / self.drain_rate
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            ids = [row[0] for row in rows]
+            self._claimed.update(ids)
+            task = asyncio.create_task(self._drain_batch(ids, [row[1].encode() for row in rows]))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _drain_batch(self, ids: List[int], records: List[bytes]):
+        try:
+            if time.monotonic() >= self._retry_at and await self._upload(records):
+                await asyncio.to_thread(self.outbox.ack, ids)
+                self.drained += len(ids)
+                self._on_upload_success()
+                if not self.outbox.pending:
+                    logger.info(f"Cloud outbox drained ({self.drained} records replayed)")
+            else:
+                if time.monotonic() >= self._retry_at:
+                    self._on_upload_failure()
+        except Exception as e:
+            logger.error(f"Error replaying cloud outbox: {e}")
+        finally:
+            self._claimed.difference_update(ids)
+            self._drain_slots.release()
+            self._drain_wakeup.set()
+
+    async def _post(self, body: bytes, headers: Dict) -> bool:
+        started = time.perf_counter()
+        code = 'error'
+        try:
+            async with self.session.post(self.api_url + '/api/v1/gateway/data',
+                                         data=body, headers=headers) as response:
+                await response.read()
+                code = str(response.status)
+                if response.status == 200:
+                    return True
+                logger.warning(f"Cloud API error: {response.status}")
+        except Exception as e:
+            logger.error(f"Error sending to cloud API: {e}")
+        finally:
+            if self.metrics:
+                self.post_seconds.observe(time.perf_counter() - started)
+                self.metrics.counter(
+                    'gateway_cloud_posts_total', 'Cloud API POSTs by HTTP status code', (('code', code),)
+                ).inc()
+        return False
 
-@dataclass
-class TelemetryData:
-    device_id: str
-    timestamp: datetime
-    temperature: Optional[float] = None
-    humidity: Optional[float] = None
-    wifi_rssi: Optional[int] = None
-    free_heap: Optional[int] = None
-    uptime: Optional[int] = None
-    custom_data: Optional[Dict] = None
+    def get_stats(self) -> Dict:
+        """Upload counters, compression ratio and bytes saved"""
+        return {
+            'buffered': len(self._batch),
+            'in_flight': len(self._in_flight),
+            'batches_sent': self.batches_sent,
+            'records_sent': self.records_sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'last_batch_size': self.last_batch_size,
+            'last_compression_ratio': self.last_compression_ratio,
+            'compression_ratio': self.bytes_raw / self.bytes_sent if self.bytes_sent else 0.0,
+            'bytes_raw': self.bytes_raw,
+            'bytes_sent': self.bytes_sent,
+            'bytes_saved': self.bytes_raw - self.bytes_sent,
+            'avg_latency_ms': self.total_latency_ms / self.batches_sent if self.batches_sent else 0.0,
+            'spilled': self.spilled,
+            'drained': self.drained,
+            'outbox_pending': self.outbox.pending if self.outbox else 0,
+            'backoff_seconds': self._backoff,
+        }
+
+def shard_path(path: str, shard: int) -> str:
+    """Per-shard variant of a file name: gateway.db -> gateway.shard2.db"""
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.shard{shard}{ext}'
+
+class ShardRing:
+    """Consistent hash of device ids onto shards; changing the shard count moves ~1/n of the devices"""
+
+    def __init__(self, shards: int, replicas: int = 160):
+        self.shards = shards
+        points = sorted(
+            (self.hash(f'shard-{shard}-{replica}'), shard)
+            for shard in range(shards) for replica in range(replicas)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+    def shard_for(self, device_id: str) -> int:
+        index = bisect.bisect(self._points, self.hash(device_id))
+        return self._owners[index % len(self._owners)]
 
 class EdgeGateway:
-    def __init__(self, config_file: str = CONFIG_FILE):
+    # Status values devices report that mean the same as a registry status
+    STATUS_ALIASES = {'alive': 'online'}
+    # Selectors accepted by find_devices
+    TARGET_KEYS = ('status', 'type', 'firmware', 'capability', 'firmware_lt', 'firmware_gte')
+    # Messages handled back to back before the ingest worker lets other tasks run
+    INGEST_YIELD_EVERY = 100
+    # Topic filters per SUBSCRIBE packet when a shard subscribes its devices
+    SUBSCRIBE_BATCH = 1000
+    # Also created by the shard supervisor when it moves devices into a new shard's database
+    DEVICES_TABLE = '''
+        CREATE TABLE IF NOT EXISTS devices (
+            device_id TEXT PRIMARY KEY,
+            device_type TEXT,
+            mac_address TEXT,
+            ip_address TEXT,
+            firmware_version TEXT,
+            capabilities TEXT,
+            status TEXT,
+            last_seen TIMESTAMP,
+            registration_time TIMESTAMP
+        )
+    '''
+
+    def __init__(self, config_file: str = CONFIG_FILE, shard: int = 0, shard_count: int = 1):
         self.config = configparser.ConfigParser()
         self.config.read(config_file)
+        self.metrics = GatewayMetrics()
+        # As one of several shard workers, only devices hashed to this shard are handled.
+        # The shard subscribes to those devices' topics alone, so the broker splits the ingest
+        self.shard = shard
+        self.ring = ShardRing(shard_count) if shard_count > 1 else None
+        self.db_file = self.config.get('database', 'file', fallback=DATABASE_FILE)
+        if self.ring:
+            self.db_file = shard_path(self.db_file, shard)
+        self.db = GatewayDatabase(
+            self.db_file,
+            synchronous=self.config.get('database', 'synchronous', fallback='NORMAL'),
+            cache_size=self.config.getint('database', 'cache_size', fallback=-8192),
+            mmap_size=self.config.getint('database', 'mmap_size', fallback=67108864),
+            busy_timeout=self.config.getint('database', 'busy_timeout', fallback=5000),
+            readers=self.config.getint('database', 'reader_connections', fallback=4)
+        )
         
-        self.devices: Dict[str, DeviceInfo] = {}
+        self.devices = DeviceRegistry()
+        # Devices whose last_seen changed since the last coalesced flush
+        self.dirty_devices: set = set()
+        # Expected next check-in of every device not known to be offline
+        self.deadlines = DeviceDeadlines(
+            timeout=self.config.getfloat('devices', 'offline_timeout', fallback=300),
+            tolerance=self.config.getfloat('devices', 'offline_tolerance', fallback=5)
+        )
+        # Learned check-in cadence, which sets each device's own deadline
+        self.arrivals: Dict[str, ArrivalStats] = {}
+        self.arrival_alpha = self.config.getfloat('devices', 'arrival_alpha', fallback=0.2)
+        self.arrival_min_samples = self.config.getint('devices', 'arrival_min_samples', fallback=5)
+        self.missed_checkins = self.config.getfloat('devices', 'missed_checkins', fallback=3)
+        self.deviation_factor = self.config.getfloat('devices', 'deviation_factor', fallback=4)
+        self.min_offline_timeout = self.config.getfloat('devices', 'min_offline_timeout', fallback=15)
+        self.max_offline_timeout = self.config.getfloat('devices', 'max_offline_timeout', fallback=3600)
+        self.latest: Dict[str, LatestReading] = {}
+        self._latest_version = 0
+        self._latest_body: Optional[tuple] = None
         self.mqtt_client = None
+        self.api_runner: Optional[web.AppRunner] = None
+
         self.cloud_client = None
         self.running = False
         
+        self.partitions = TelemetryPartitions(
+            self.config.get('database', 'partition_interval', fallback='day')
+        )
+        
+        self.rollups = TelemetryRollups(
+            self.partitions,
+            {
+                level: self.config.getfloat('rollups', f'retention_{level}_days', fallback=default)
+                for level, default in (('1m', 7), ('15m', 90), ('1h', 365))
+            },
+            lateness=self.config.getfloat('rollups', 'lateness', fallback=60),
+            max_step=self.config.getfloat('rollups', 'max_step', fallback=21600)
+        )
+        
+        # Streaming per-device window statistics, emitted to storage and the cloud as windows close
+        self.windows: Optional[WindowAggregator] = None
+        if self.config.getboolean('aggregation', 'enabled', fallback=False):
+            self.windows = WindowAggregator(
+                WindowAggregator.parse_windows(self.config.get('aggregation', 'windows', fallback='60')),
+                fields=tuple(
+                    field.strip()
+                    for field in self.config.get('aggregation', 'fields', fallback='temperature, humidity').split(',')
+                    if field.strip()
+                ),
+                lateness=self.config.getfloat('aggregation', 'lateness', fallback=5)
+            )
+        self.store_windows = self.config.getboolean('aggregation', 'store', fallback=True)
+        self.forward_windows = self.config.getboolean('aggregation', 'forward', fallback=True)
+        # With summaries going to the cloud, raw readings can stay local
+        self.forward_raw_telemetry = not self.windows or self.config.getboolean('aggregation', 'forward_raw', fallback=True)
+        
         # Initialize database
         self.init_database()
         
+        # Batched telemetry writer
+        self.telemetry_writer = TelemetryWriter(
+            self.db,
+            self.partitions,
+            batch_size=self.config.getint('database', 'batch_size', fallback=500),
+            flush_interval=self.config.getfloat('database', 'flush_interval', fallback=1.0),
+            metrics=self.metrics,
+            rollups=self.rollups
+        )
+        
+        # Raw MQTT messages are handed from paho's thread to asyncio consumers
+        self.ingest_queue = IngestQueue(
+            maxsize=self.config.getint('ingest', 'queue_size', fallback=10000),
+            policy=self.config.get('ingest', 'backpressure', fallback='drop_oldest')
+        )
+        self.ingest_worker_task: Optional[asyncio.Task] = None
+        self.background_tasks: List[asyncio.Task] = []
+        self.decoder = PayloadDecoder(self.config.get('ingest', 'decoder', fallback='auto'))
+        self.max_batch_readings = self.config.getint('ingest', 'max_batch_readings', fallback=1000)
+        self.batch_duplicates = 0
+        self.router = TopicRouter()
+        self.setup_routes()
+        if not self.decoder.binary:
+            logger.warning("No MessagePack library installed, devices/+/telemetry/bin is not subscribed")
+        
+        # Cloud forwarding over a pooled HTTP session
+        cloud_url = self.config.get('cloud', 'api_url', fallback='')
+        if self.config.getboolean('cloud', 'enabled', fallback=False) and cloud_url:
+            self.cloud_client = CloudForwarder(
+                cloud_url,
+                self.config.get('cloud', 'api_token', fallback=''),
+                self.config.get('gateway', 'id', fallback='gateway_001'),
+                sync_interval=self.config.getfloat('cloud', 'sync_interval', fallback=300),
+                max_batch_records=self.config.getint('cloud', 'max_batch_records', fallback=1000),
+                max_batch_bytes=self.config.getint('cloud', 'max_batch_bytes', fallback=262144),
+                compression=self.config.get('cloud', 'compression', fallback='gzip'),
+                compression_level=self.config.getint('cloud', 'compression_level', fallback=6),
+                connection_limit=self.config.getint('cloud', 'connection_limit', fallback=4),
+                keepalive_timeout=self.config.getfloat('cloud', 'keepalive_timeout', fallback=60.0),
+                request_timeout=self.config.getfloat('cloud', 'request_timeout', fallback=30.0),
+                outbox=CloudOutbox(self.db),
+                drain_batch_records=self.config.getint('cloud', 'drain_batch_records', fallback=5000),
+                drain_concurrency=self.config.getint('cloud', 'drain_concurrency', fallback=2),
+                drain_rate=self.config.getfloat('cloud', 'drain_rate', fallback=2000.0),
+                retry_initial=self.config.getfloat('cloud', 'retry_initial', fallback=5.0),
+                retry_max=self.config.getfloat('cloud', 'retry_max', fallback=300.0),
+                metrics=self.metrics
+            )
+        
         # Load existing devices
         self.load_devices()
+        self.setup_metrics()
 
     def init_database(self):
         """Initialize SQLite database for local data storage"""
         try:
-            conn = sqlite3.connect(DATABASE_FILE)
+            with self.db.writer() as conn:
+                self._create_schema(conn)
+            logger.info(
+                f"Database initialized successfully (WAL, synchronous={self.db.synchronous}, "
+                f"{self.db.readers} readers)"
+            )
+            
+        except Exception as e:
+            logger.error(f"Database initialization failed: {e}")
+            raise
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        """Create or upgrade every gateway table in one transaction"""
+        try:
             cursor = conn.cursor()
             
             # Devices table
+            cursor.execute(self.DEVICES_TABLE)
+            
+            # Gateway bookkeeping
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS gateway_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+            
+            # Integer surrogate keys for device ids in telemetry rows
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS devices (
-                    device_id TEXT PRIMARY KEY,
-                    device_type TEXT,
-                    mac_address TEXT,
-                    ip_address TEXT,
-                    firmware_version TEXT,
-                    capabilities TEXT,
-                    status TEXT,
-                    last_seen TIMESTAMP,
-                    registration_time TIMESTAMP
+                CREATE TABLE IF NOT EXISTS device_keys (
+                    device_key INTEGER PRIMARY KEY,
+                    device_id TEXT NOT NULL UNIQUE
                 )
             ''')
             
-            # Telemetry data table
+            # Telemetry data is split into time partitions behind the telemetry view
+            self.partitions.upgrade(conn)
+            self.partitions.load(conn)
+            self.partitions.ensure(conn, self.partitions.partition_for(datetime.now()))
+            self.partitions.rebuild_view(conn)
+            
+            # Downsampled aggregates for long-term history
+            self.rollups.ensure_tables(conn)
+            self.rollups.load(conn)
+            
+            # Streaming window summaries
+            if self.windows:
+                self.windows.ensure_table(conn)
+            
+            # Cloud uploads awaiting acknowledgement
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS telemetry (
+                CREATE TABLE IF NOT EXISTS cloud_outbox (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    device_id TEXT,
-                    timestamp TIMESTAMP,
-                    temperature REAL,
-                    humidity REAL,
-                    wifi_rssi INTEGER,
-                    free_heap INTEGER,
-                    uptime INTEGER,
-                    custom_data TEXT,
-                    FOREIGN KEY (device_id) REFERENCES devices (device_id)
+                    created_at TIMESTAMP,
+                    record TEXT,
+                    acked_at TIMESTAMP
                 )
             ''')
             
@@ -128,42 +2532,44 @@ class EdgeGateway:
             ''')
             
             # Create indexes
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_device_time ON telemetry(device_id, timestamp)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_commands_device_status ON commands(device_id, status)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_cloud_outbox_pending ON cloud_outbox(id) WHERE acked_at IS NULL')
             
             conn.commit()
-            conn.close()
-            logger.info("Database initialized successfully")
             
-        except Exception as e:
-            logger.error(f"Database initialization failed: {e}")
+        except Exception:
+            conn.rollback()
             raise
 
     def load_devices(self):
         """Load existing devices from database"""
         try:
-            conn = sqlite3.connect(DATABASE_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT * FROM devices')
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                device = DeviceInfo(
-                    device_id=row[0],
-                    device_type=row[1],
-                    mac_address=row[2],
-                    ip_address=row[3],
-                    firmware_version=row[4],
-                    capabilities=row[5],
-                    status=row[6],
-                    last_seen=datetime.fromisoformat(row[7]) if row[7] else None,
-                    registration_time=datetime.fromisoformat(row[8]) if row[8] else None
-                )
-                self.devices[device.device_id] = device
+            foreign = 0
+            with self.db.reader() as conn:
+                # Stream rows straight into the registry, one pass with no intermediate list
+                for row in conn.execute('SELECT * FROM devices'):
+                    if not self.owns(row[0]):
+                        # Left behind by a change of the shard count; the supervisor moves these on start
+                        foreign += 1
+                        continue
+                    device = DeviceInfo(
+                        device_id=row[0],
+                        device_type=row[1],
+                        mac_address=row[2],
+                        ip_address=row[3],
+                        firmware_version=row[4],
+                        capabilities=row[5],
+                        status=row[6],
+                        last_seen=parse_timestamp(row[7]),
+                        registration_time=parse_timestamp(row[8])
+                    )
+                    self.devices.add(device)
+                    if device.status != 'offline' and device.last_seen:
+                        self.deadlines.touch(device.device_id, device.last_seen)
             
-            conn.close()
             logger.info(f"Loaded {len(self.devices)} devices from database")
+            if foreign:
+                logger.warning(f"Skipped {foreign} devices that belong to other shards")
             
         except Exception as e:
             logger.error(f"Failed to load devices: {e}")
@@ -193,10 +2599,8 @@ class EdgeGateway:
         if rc == 0:
             logger.info("Connected to MQTT broker")
             
-            # Subscribe to device topics
-            client.subscribe("devices/+/telemetry")
-            client.subscribe("devices/+/status")
-            client.subscribe("devices/registration")
+            # Subscribe to every routed device topic, or as a shard only to those of its devices
+            self.subscribe(client, self.subscription_topics())
             
         else:
             logger.error(f"Failed to connect to MQTT broker: {rc}")
@@ -206,23 +2610,143 @@ class EdgeGateway:
         logger.warning(f"Disconnected from MQTT broker: {rc}")
 
     def on_mqtt_message(self, client, userdata, msg):
-        """Handle incoming MQTT messages"""
+        """Hand incoming MQTT messages to the ingest queue (runs on paho's thread)"""
         try:
-            topic = msg.topic
-            payload = json.loads(msg.payload.decode())
+            self.ingest_queue.put_threadsafe((msg.topic, msg.payload, time.time()))
+        except Exception as e:
+            logger.error(f"Error queueing MQTT message: {e}")
+
+    def owns(self, device_id: str) -> bool:
+        """Whether device_id is handled by this shard"""
+        return self.ring is None or self.ring.shard_for(device_id) == self.shard
+
+    def subscription_topics(self) -> List[str]:
+        """Every routed filter; a shard swaps the per-device wildcards for its own devices' topics.
+        Devices are then only heard from once they registered with their shard, as the firmware does on connect."""
+        if not self.ring:
+            return list(self.router.patterns)
+        topics = [pattern for pattern in self.router.patterns if '+' not in pattern]
+        for device_id in self.devices:
+            topics.extend(self.device_topics(device_id))
+        return topics
+
+    def device_topics(self, device_id: str) -> List[str]:
+        """The per-device routes as exact topics of one device"""
+        if not device_id or any(char in device_id for char in '/+#\0'):
+            # Not a single topic level, and the broker would reject a filter built from it
+            return []
+        return [pattern.replace('+', device_id) for pattern in self.router.patterns if '+' in pattern]
+
+    def subscribe(self, client, topics: List[str]):
+        """Subscribe at QoS 0 in batches, so a large fleet does not make one oversized packet"""
+        for start in range(0, len(topics), self.SUBSCRIBE_BATCH):
+            client.subscribe([(topic, 0) for topic in topics[start:start + self.SUBSCRIBE_BATCH]])
+
+    async def ingest_worker(self):
+        """Consume raw MQTT messages from the ingest queue"""
+        handled = 0
+        while True:
+            topic, payload, receive_time = await self.ingest_queue.get()
+            try:
+                self.process_message(topic, payload, receive_time)
+            finally:
+                self.ingest_queue.task_done()
+            handled += 1
+            if handled % self.INGEST_YIELD_EVERY == 0:
+                # get() does not suspend while messages are queued, so under sustained load
+                # timers, flushes and the API would never run without this
+                await asyncio.sleep(0)
+
+    def process_message(self, topic: str, raw_payload: bytes, receive_time: float):
+        """Decode and route a single MQTT message"""
+        try:
+            received_at = datetime.fromtimestamp(receive_time)
             
-            logger.debug(f"Received message on {topic}: {payload}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Received message on {topic}: {raw_payload!r}")
             
-            if topic.startswith("devices/") and topic.endswith("/telemetry"):
-                self.handle_telemetry(payload)
-            elif topic.startswith("devices/") and topic.endswith("/status"):
-                self.handle_status_update(payload)
-            elif topic == "devices/registration":
-                self.handle_device_registration(payload)
+            route = self.router.match(topic)
+            if route is None:
+                self.unrouted_messages.inc()
+                logger.debug(f"No handler for topic {topic}")
+                return
+            (handler, messages, errors), captures = route
+            messages.inc()
+            try:
+                handler(raw_payload, received_at, *captures)
+            except Exception:
+                errors.inc()
+                raise
+            self.ingest_latency.observe(time.time() - receive_time)
                 
         except Exception as e:
             logger.error(f"Error processing MQTT message: {e}")
 
+    def setup_routes(self):
+        """Register a handler for each MQTT topic the gateway consumes"""
+        self.unrouted_messages = self.metrics.counter(
+            'gateway_messages_unrouted_total', 'MQTT messages on topics without a handler'
+        )
+        self.ingest_latency = self.metrics.histogram(
+            'gateway_ingest_latency_seconds', 'Time from MQTT receipt to handled, including queueing'
+        )
+        self.add_route('devices/+/telemetry', 'telemetry', self.route_telemetry)
+        self.add_route('devices/+/telemetry/batch', 'telemetry_batch', self.route_telemetry_batch)
+        if self.decoder.binary:
+            self.add_route('devices/+/telemetry/bin', 'telemetry_bin', self.route_binary_telemetry)
+        self.add_route('devices/+/status', 'status', self.route_status)
+        self.add_route('devices/registration', 'registration', self.route_registration)
+
+    def add_route(self, pattern: str, topic_type: str, handler):
+        """Route a topic filter to handler with its own message and error counters"""
+        labels = (('type', topic_type),)
+        self.router.add(pattern, (
+            handler,
+            self.metrics.counter('gateway_messages_total', 'MQTT messages received by topic type', labels),
+            self.metrics.counter('gateway_message_errors_total',
+                                 'MQTT messages that failed to decode or process', labels),
+        ))
+
+    def route_telemetry(self, raw_payload: bytes, received_at: datetime, device_id: str):
+        payload = self.decoder.decode_telemetry(raw_payload)
+        if not payload.device_id:
+            # The id comes from the topic, so the bytes forwarded to the cloud need it too
+            payload.device_id = device_id
+            raw_payload = self.splice_device_id(raw_payload, device_id)
+        self.handle_telemetry(payload, received_at, raw_payload)
+
+    @staticmethod
+    def splice_device_id(raw: bytes, device_id: str) -> Optional[bytes]:
+        """A JSON object payload with a leading device_id member, or None when it must be re-encoded"""
+        body = raw.strip()
+        # A null or empty id (or one nested deeper) would leave a duplicate key
+        if not body.startswith(b'{') or b'"device_id"' in body:
+            return None
+        rest = body[1:].lstrip()
+        return (b'{"device_id":' + json.dumps(device_id).encode()
+                + (b'' if rest.startswith(b'}') else b',') + rest)
+
+    def route_telemetry_batch(self, raw_payload: bytes, received_at: datetime, device_id: str):
+        payload = self.decoder.decode(raw_payload)
+        if not payload.get('device_id'):
+            payload['device_id'] = device_id
+        self.handle_telemetry_batch(payload, received_at)
+
+    def route_binary_telemetry(self, raw_payload: bytes, received_at: datetime, device_id: str):
+        # Compact encoding; the device id comes from the topic
+        self.handle_telemetry(self.decoder.decode_binary_telemetry(raw_payload, device_id), received_at)
+
+    def route_status(self, raw_payload: bytes, received_at: datetime, device_id: str):
+        payload = self.decoder.decode(raw_payload)
+        if not payload.get('device_id'):
+            payload['device_id'] = device_id
+        self.handle_status_update(payload, received_at)
+
+    def route_registration(self, raw_payload: bytes, received_at: datetime):
+        payload = self.decoder.decode(raw_payload)
+        if self.owns(str(payload.get('device_id', ''))):
+            self.handle_device_registration(payload)
+
     def handle_device_registration(self, payload: Dict):
         """Handle new device registration"""
         try:
@@ -235,14 +2759,20 @@ class EdgeGateway:
                 ip_address=payload.get('ip_address', ''),
                 firmware_version=payload.get('firmware_version', ''),
                 capabilities=payload.get('capabilities', ''),
-                last_seen=datetime.now(),
+                last_seen=time.time(),
                 status='online',
-                registration_time=datetime.now()
+                registration_time=time.time()
             )
             
             # Save to database
             self.save_device(device)
-            self.devices[device_id] = device
+            known = device_id in self.devices
+            self.devices.add(device)
+            self.dirty_devices.discard(device_id)
+            self.deadlines.touch(device_id, device.last_seen)
+            if self.ring and not known:
+                # A shard only receives the topics of devices it subscribed to
+                self.subscribe(self.mqtt_client, self.device_topics(device_id))
             
             logger.info(f"Registered new device: {device_id}")
             
@@ -258,123 +2788,592 @@ class EdgeGateway:
         except Exception as e:
             logger.error(f"Error handling device registration: {e}")
 
-    def handle_telemetry(self, payload: Dict):
-        """Process telemetry data"""
+    def handle_telemetry(self, payload, received_at: Optional[datetime] = None, raw: Optional[bytes] = None):
+        """Process telemetry data from a decoded TelemetryPayload (or plain dict) and its raw bytes"""
         try:
-            device_id = payload.get('device_id')
+            message = payload if isinstance(payload, TelemetryPayload) else TelemetryPayload.from_dict(payload)
+            device_id = message.device_id
             if not device_id:
                 logger.warning("Telemetry message missing device_id")
                 return
             
+            received_at = received_at or datetime.now()
+            
             # Update device last seen
-            if device_id in self.devices:
-                self.devices[device_id].last_seen = datetime.now()
-                self.devices[device_id].status = 'online'
+            self.touch_device(device_id, 'online', received_at)
             
             # Create telemetry record
             telemetry = TelemetryData(
                 device_id=device_id,
-                timestamp=datetime.now(),
-                temperature=payload.get('temperature'),
-                humidity=payload.get('humidity'),
-                wifi_rssi=payload.get('wifi_rssi'),
-                free_heap=payload.get('free_heap'),
-                uptime=payload.get('uptime'),
-                custom_data=payload.get('custom_data')
+                timestamp=received_at,
+                temperature=message.temperature,
+                humidity=message.humidity,
+                wifi_rssi=message.wifi_rssi,
+                free_heap=message.free_heap,
+                uptime=message.uptime,
+                custom_data=message.custom_data
             )
             
             # Save to database
             self.save_telemetry(telemetry)
             
+            # Keep the latest snapshot for the local read API
+            self.update_latest(telemetry)
+            
+            if self.windows:
+                self.windows.add(telemetry)
+            
             # Forward to cloud if connected
-            if self.cloud_client:
-                self.forward_to_cloud('telemetry', payload)
+            if self.cloud_client and self.forward_raw_telemetry:
+                if raw is not None:
+                    self.forward_raw_to_cloud('telemetry', raw)
+                else:
+                    self.forward_to_cloud('telemetry', payload if isinstance(payload, dict) else asdict(payload))
             
             logger.debug(f"Processed telemetry from {device_id}")
             
         except Exception as e:
             logger.error(f"Error handling telemetry: {e}")
 
-    def handle_status_update(self, payload: Dict):
+    def handle_telemetry_batch(self, payload: Dict, received_at: Optional[datetime] = None):
+        """Expand a batched telemetry envelope into one row per reading"""
+        try:
+            device_id = payload.get('device_id')
+            readings = payload.get('readings')
+            if not device_id or not isinstance(readings, list):
+                logger.warning("Telemetry batch missing device_id or readings")
+                return
+            if len(readings) > self.max_batch_readings:
+                logger.warning(f"Telemetry batch from {device_id} has {len(readings)} readings, limit is {self.max_batch_readings}")
+                return
+            
+            # Every reading needs its device-side time ('t', device millis)
+            readings = [r for r in readings if isinstance(r, dict) and isinstance(r.get('t'), (int, float))]
+            if not readings:
+                return
+            if any(readings[i]['t'] < readings[i - 1]['t'] for i in range(1, len(readings))):
+                readings.sort(key=lambda r: r['t'])
+            # A reading repeated with every field equal is a resend and is dropped;
+            # readings that only share a 't' are all kept and told apart by seq in storage
+            unique = []
+            same_t = []
+            for reading in readings:
+                if same_t and same_t[0]['t'] != reading['t']:
+                    same_t = []
+                if reading not in same_t:
+                    same_t.append(reading)
+                    unique.append(reading)
+            if len(unique) < len(readings):
+                self.batch_duplicates += len(readings) - len(unique)
+                logger.debug(f"Dropped {len(readings) - len(unique)} duplicate readings from {device_id}")
+                readings = unique
+            
+            received_at = received_at or datetime.now()
+            self.touch_device(device_id, 'online', received_at)
+            
+            # Anchor the device clock: the envelope timestamp is the device time at publish
+            sent_ms = payload.get('timestamp')
+            if not isinstance(sent_ms, (int, float)):
+                sent_ms = readings[-1]['t']
+            
+            records = []
+            for reading in readings:
+                records.append(TelemetryData(
+                    device_id=device_id,
+                    timestamp=received_at - timedelta(milliseconds=max(sent_ms - reading['t'], 0)),
+                    temperature=reading.get('temperature'),
+                    humidity=reading.get('humidity'),
+                    wifi_rssi=reading.get('wifi_rssi'),
+                    free_heap=reading.get('free_heap'),
+                    uptime=reading.get('uptime'),
+                    custom_data=reading.get('custom_data')
+                ))
+            
+            # One buffer append, so the whole batch lands in one storage transaction
+            self.telemetry_writer.add_many(records)
+            self.update_latest(records[-1])
+            
+            if self.windows:
+                for record in records:
+                    self.windows.add(record)
+            
+            if self.cloud_client and self.forward_raw_telemetry:
+                for reading in readings:
+                    # Same shape as a single telemetry message from the device
+                    message = {key: value for key, value in reading.items() if key != 't'}
+                    message['device_id'] = device_id
+                    message['timestamp'] = reading['t']
+                    self.forward_to_cloud('telemetry', message)
+            
+            logger.debug(f"Processed batch of {len(records)} readings from {device_id}")
+            
+        except Exception as e:
+            logger.error(f"Error handling telemetry batch: {e}")
+
+    def update_latest(self, telemetry: TelemetryData):
+        """Replace a device's snapshot for the local read API"""
+        self.latest[telemetry.device_id] = LatestReading(
+            telemetry.timestamp.timestamp(), telemetry.temperature, telemetry.humidity,
+            telemetry.wifi_rssi, telemetry.free_heap, telemetry.uptime
+        )
+        self._latest_version += 1
+
+    def handle_status_update(self, payload: Dict, received_at: Optional[datetime] = None):
         """Handle device status updates"""
         try:
             device_id = payload.get('device_id')
-            status = payload.get('status', 'unknown')
+            status = payload.get('status')
+            status = self.STATUS_ALIASES.get(status, status) if isinstance(status, str) else None
             
-            if device_id in self.devices:
-                self.devices[device_id].status = status
-                self.devices[device_id].last_seen = datetime.now()
-                
-                # Update database
-                self.update_device_status(device_id, status)
-                
+            if self.touch_device(device_id, status, received_at or datetime.now()):
                 logger.info(f"Device {device_id} status: {status}")
             
         except Exception as e:
             logger.error(f"Error handling status update: {e}")
 
-    def save_device(self, device: DeviceInfo):
-        """Save device to database"""
+    def touch_device(self, device_id: str, status: Optional[str], seen_at: datetime) -> bool:
+        """Record a sign of life, leaving the status alone when it is None; returns True when it changed"""
+        device = self.devices.get(device_id)
+        if device is None:
+            return False
+        
+        now = seen_at.timestamp()
+        stats = self.arrivals.get(device_id)
+        if stats is None or device.status == 'offline':
+            # The gap spanning an outage says nothing about the device's cadence
+            if stats is None:
+                self.arrivals[device_id] = ArrivalStats(now)
+            else:
+                stats.last_arrival = now
+        else:
+            stats.update(now, self.arrival_alpha)
+        
+        device.last_seen = now
+        if status == 'offline':
+            self.deadlines.discard(device_id)
+        else:
+            self.deadlines.touch(device_id, now, self.offline_timeout(device_id))
+        if status is None or device.status == status:
+            # Heartbeats only move last_seen, which is persisted by the periodic flush
+            self.dirty_devices.add(device_id)
+            return False
+        
+        self.devices.set_status(device, status)
+        self.update_device_status(device_id, status)
+        return True
+
+    def offline_timeout(self, device_id: str) -> float:
+        """Silence after which a device counts as offline, learned from its check-in cadence"""
+        stats = self.arrivals.get(device_id)
+        if stats is None or stats.samples < self.arrival_min_samples:
+            return self.deadlines.timeout
+        timeout = max(
+            self.missed_checkins * stats.mean,
+            stats.mean + self.deviation_factor * math.sqrt(stats.var)
+        )
+        return min(max(timeout, self.min_offline_timeout), self.max_offline_timeout)
+
+    def setup_metrics(self):
+        """Register gauges sampled from gateway state at scrape time"""
+        metrics = self.metrics
+        metrics.gauge('gateway_devices', 'Known devices by status', lambda: {
+            (('status', status),): count for status, count in self.devices.status_counts().items()
+        })
+        metrics.gauge('gateway_ingest_queue_depth', 'MQTT messages waiting for an ingest worker',
+                      self.ingest_queue.depth)
+        metrics.gauge('gateway_ingest_enqueued_total', 'MQTT messages accepted into the ingest queue',
+                      lambda: self.ingest_queue.enqueued, kind='counter')
+        metrics.gauge('gateway_ingest_dropped_total', 'MQTT messages dropped by ingest backpressure',
+                      lambda: self.ingest_queue.dropped, kind='counter')
+        metrics.gauge('gateway_batch_duplicate_readings_total', 'Batched readings dropped as exact resends',
+                      lambda: self.batch_duplicates, kind='counter')
+        metrics.gauge('gateway_db_pending_rows', 'Telemetry rows waiting for the next batch commit',
+                      self.telemetry_writer.pending)
+        metrics.gauge('gateway_db_rows_written_total', 'Telemetry rows committed',
+                      lambda: self.telemetry_writer.rows_written, kind='counter')
+        if self.cloud_client:
+            cloud = self.cloud_client
+            metrics.gauge('gateway_cloud_buffered_records', 'Records waiting for the next cloud batch',
+                          lambda: len(cloud._batch))
+            metrics.gauge('gateway_cloud_outbox_pending', 'Undelivered records in the on-disk outbox',
+                          lambda: cloud.outbox.pending if cloud.outbox else 0)
+            metrics.gauge('gateway_cloud_dropped_total', 'Cloud records dropped without being stored',
+                          lambda: cloud.dropped, kind='counter')
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, DeferredQueueHandler):
+                metrics.gauge('gateway_log_records_dropped_total', 'Log records dropped because the log queue was full',
+                              lambda: handler.dropped, kind='counter')
+                metrics.gauge('gateway_log_records_suppressed_total', 'Repeated warnings and errors rate-limited away',
+                              lambda: sum(f.suppressed for f in handler.filters if isinstance(f, RateLimitFilter)),
+                              kind='counter')
+                break
+        if self.windows:
+            windows = self.windows
+            metrics.gauge('gateway_windows_emitted_total', 'Per-device window summaries emitted',
+                          lambda: windows.emitted, kind='counter')
+            metrics.gauge('gateway_windows_late_readings_total', 'Readings that arrived after their window closed',
+                          lambda: windows.late, kind='counter')
+            metrics.gauge('gateway_windows_open_panes', 'Per-device panes held for open windows', windows.open_panes)
+        self.loop_lag = metrics.histogram('gateway_event_loop_lag_seconds',
+                                          'Extra delay of a timer wakeup on the asyncio loop')
+
+    def get_latest_readings(self) -> Dict[str, Dict]:
+        """Latest reading of every device, served from memory"""
+        return {device_id: reading.as_dict() for device_id, reading in self.latest.items()}
+
+    def setup_api(self) -> web.Application:
+        """Build the local HTTP read API"""
+        app = web.Application()
+        app.router.add_get('/api/v1/latest', self.api_latest)
+        app.router.add_get('/api/v1/latest/{device_id}', self.api_latest_device)
+        app.router.add_get('/api/v1/devices', self.api_devices)
+        app.router.add_post('/api/v1/commands', self.api_group_command)
+        app.router.add_get('/api/v1/telemetry', self.api_telemetry)
+        app.router.add_get('/api/v1/telemetry/aggregate', self.api_telemetry_aggregate)
+        app.router.add_get('/metrics', self.api_metrics)
+        return app
+
+    async def start_api(self):
+        """Serve the local read API on [api] host and port"""
+        host = self.config.get('api', 'host', fallback='127.0.0.1')
+        port = self.config.getint('api', 'port', fallback=8080)
+        if self.ring:
+            # Shard APIs are private; the supervisor serves the merged view on [api] port
+            host = '127.0.0.1'
+            port = self.config.getint('cluster', 'worker_api_port', fallback=8180) + self.shard
+        self.api_runner = web.AppRunner(self.setup_api(), access_log=None)
+        await self.api_runner.setup()
+        await web.TCPSite(self.api_runner, host, port).start()
+        logger.info(f"Local API listening on {host}:{port}")
+
+    async def api_metrics(self, request: web.Request) -> web.Response:
+        """Prometheus scrape endpoint"""
+        return web.Response(body=self.metrics.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def api_latest(self, request: web.Request) -> web.Response:
+        """GET /api/v1/latest - latest reading for all devices"""
+        # Re-encode only when a reading has arrived since the last request
+        cached = self._latest_body
+        if not cached or cached[0] != self._latest_version:
+            cached = (self._latest_version, json.dumps(self.get_latest_readings()).encode())
+            self._latest_body = cached
+        return web.Response(body=cached[1], content_type='application/json')
+
+    async def api_latest_device(self, request: web.Request) -> web.Response:
+        """GET /api/v1/latest/{device_id} - latest reading for one device"""
+        reading = self.latest.get(request.match_info['device_id'])
+        if reading is None:
+            raise web.HTTPNotFound(text='Unknown device')
+        return web.json_response(reading.as_dict())
+
+    @staticmethod
+    def parse_time_param(value: Optional[str], default: datetime) -> int:
+        """Epoch milliseconds from an epoch-ms or ISO-8601 query parameter"""
+        if not value:
+            return int(default.timestamp() * 1000)
+        if value.isdigit():
+            return int(value)
         try:
-            conn = sqlite3.connect(DATABASE_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            return int(datetime.fromisoformat(value).timestamp() * 1000)
+        except ValueError:
+            raise web.HTTPBadRequest(text=f'Invalid time: {value}')
+
+    def parse_range(self, request: web.Request) -> tuple:
+        """(device_key, start_ms, end_ms) from query parameters; device_key is None for all devices"""
+        now = datetime.now()
+        end_ms = self.parse_time_param(request.query.get('end'), now)
+        start_ms = self.parse_time_param(request.query.get('start'), now - timedelta(hours=1))
+        if start_ms > end_ms:
+            raise web.HTTPBadRequest(text='start is after end')
+
+        device_key = None
+        device_id = request.query.get('device_id')
+        if device_id:
+            device_key = self.partitions.device_keys.get(device_id)
+            if device_key is None:
+                raise web.HTTPNotFound(text='Unknown device')
+        return device_key, start_ms, end_ms
+
+    async def stream_query(self, request: web.Request, sql: str, params: tuple, row_to_dict) -> web.StreamResponse:
+        """Stream query results as a JSON array without holding the full result"""
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        if 'resolution' in request:
+            response.headers['X-Resolution'] = request['resolution']
+        chunk_size = self.config.getint('api', 'stream_chunk_rows', fallback=500)
+
+        def first_chunk(conn: sqlite3.Connection) -> tuple:
+            cursor = conn.execute(sql, params)
+            return cursor, cursor.fetchmany(chunk_size)
+
+        async with self.db.async_reader() as conn:
+            # Run the query before the headers go out, so a failing one still gets an error status
+            try:
+                cursor, rows = await asyncio.to_thread(first_chunk, conn)
+            except sqlite3.Error as e:
+                logger.error(f"Error running API query: {e}")
+                raise web.HTTPInternalServerError(text='Query failed')
+            try:
+                await response.prepare(request)
+                separator = b'['
+                while rows:
+                    body = b','.join(json.dumps(row_to_dict(row)).encode() for row in rows)
+                    await response.write(separator + body)
+                    separator = b','
+                    rows = await asyncio.to_thread(cursor.fetchmany, chunk_size)
+            finally:
+                cursor.close()
+        await response.write(b'[]' if separator == b'[' else b']')
+        await response.write_eof()
+        return response
+
+    def find_devices(self, criteria) -> List[DeviceInfo]:
+        """Devices matching status, type, firmware, firmware_lt/firmware_gte and capability criteria"""
+        capabilities = criteria.get('capability', ())
+        if hasattr(criteria, 'getall'):
+            capabilities = criteria.getall('capability', [])
+        elif isinstance(capabilities, str):
+            capabilities = [capabilities]
+        return self.devices.find(
+            status=criteria.get('status'),
+            device_type=criteria.get('type'),
+            firmware=criteria.get('firmware'),
+            capabilities=tuple(capabilities),
+            firmware_below=criteria.get('firmware_lt'),
+            firmware_at_least=criteria.get('firmware_gte')
+        )
+
+    def device_to_dict(self, device: DeviceInfo) -> Dict:
+        """API representation of a device with its learned liveness parameters"""
+        info = asdict(device)
+        info['last_seen'] = format_timestamp(device.last_seen)
+        info['registration_time'] = format_timestamp(device.registration_time)
+        stats = self.arrivals.get(device.device_id)
+        timeout = self.offline_timeout(device.device_id)
+        info['liveness'] = {
+            'mean_interval': stats.mean if stats and stats.samples else None,
+            'interval_stddev': math.sqrt(stats.var) if stats and stats.samples else None,
+            'samples': stats.samples if stats else 0,
+            'offline_timeout': timeout,
+            # Worst case from last check-in until the device is reported offline
+            'detection_latency': timeout + self.deadlines.tick * 2,
+            'deadline': self.deadlines.deadlines.get(device.device_id),
+        }
+        return info
+
+    async def api_devices(self, request: web.Request) -> web.StreamResponse:
+        """GET /api/v1/devices - registered devices, optionally filtered by indexed attributes"""
+        devices = self.find_devices(request.query)
+        chunk_size = self.config.getint('api', 'stream_chunk_rows', fallback=500)
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        await response.prepare(request)
+
+        # Encoded a chunk at a time, so the full document is never held in memory
+        separator = b'['
+        for start in range(0, len(devices), chunk_size):
+            body = b','.join(
+                json.dumps(self.device_to_dict(device)).encode() for device in devices[start:start + chunk_size]
+            )
+            await response.write(separator + body)
+            separator = b','
+        await response.write(b'[]' if separator == b'[' else b']')
+        await response.write_eof()
+        return response
+
+    async def api_telemetry(self, request: web.Request) -> web.StreamResponse:
+        """GET /api/v1/telemetry?device_id=&start=&end= - raw readings in a time range"""
+        device_key, start_ms, end_ms = self.parse_range(request)
+        union, params = self.partitions.range_select(start_ms, end_ms, device_key)
+        sql = f'SELECT * FROM ({union}) ORDER BY device_key, ts'
+        device_ids = self.partitions.device_ids
+
+        def row_to_dict(row):
+            return {
+                'device_id': device_ids.get(row[0]),
+                'ts': row[1],
+                'temperature': row[2],
+                'humidity': row[3],
+                'wifi_rssi': row[4],
+                'free_heap': row[5],
+                'uptime': row[6],
+                'custom_data': json.loads(row[7]) if row[7] else None,
+            }
+
+        return await self.stream_query(request, sql, params, row_to_dict)
+
+    async def api_telemetry_aggregate(self, request: web.Request) -> web.StreamResponse:
+        """GET /api/v1/telemetry/aggregate?device_id=&start=&end=&interval= - bucketed min/max/avg/count"""
+        # Buckets are aligned to multiples of the interval since the epoch
+        device_key, start_ms, end_ms = self.parse_range(request)
+        try:
+            interval = float(request.query.get('interval', '60'))
+        except ValueError:
+            raise web.HTTPBadRequest(text='Invalid interval')
+        if not math.isfinite(interval) or interval <= 0:
+            raise web.HTTPBadRequest(text='interval must be a positive number of seconds')
+        interval_ms = int(interval * 1000)
+        if interval_ms <= 0:
+            raise web.HTTPBadRequest(text='interval must be at least 1 ms')
+
+        # Read the coarsest rollup that can answer the request
+        level = self.rollups.choose_level(interval_ms, start_ms, datetime.now())
+        sql, params = self.rollups.aggregate_select(level, interval_ms, start_ms, end_ms, device_key)
+        request['resolution'] = level or 'raw'
+        device_ids = self.partitions.device_ids
+
+        def row_to_dict(row):
+            return {
+                'device_id': device_ids.get(row[0]),
+                'bucket': row[1],
+                'count': row[2],
+                'temperature': {'min': row[3], 'max': row[4], 'avg': row[5]},
+                'humidity': {'min': row[6], 'max': row[7], 'avg': row[8]},
+                'wifi_rssi': {'min': row[9], 'max': row[10], 'avg': row[11]},
+            }
+
+        return await self.stream_query(request, sql, params, row_to_dict)
+
+    async def api_group_command(self, request: web.Request) -> web.Response:
+        """POST /api/v1/commands - send one command to every device matching a target filter"""
+        try:
+            body = await request.json()
+            command = body['command']
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest(text='Expected a JSON object with a command')
+        target = body.get('target') or {}
+        parameters = body.get('parameters') or {}
+        if not isinstance(target, dict) or not isinstance(parameters, dict):
+            raise web.HTTPBadRequest(text='target and parameters must be objects')
+        # A typo or an empty target would otherwise match, and command, the whole fleet
+        unknown = sorted(set(target) - set(self.TARGET_KEYS))
+        if unknown:
+            raise web.HTTPBadRequest(text=f"Unknown target keys: {', '.join(unknown)}")
+        criteria = []
+        for key, value in target.items():
+            values = value if key == 'capability' and isinstance(value, list) else [value]
+            if not all(isinstance(v, str) for v in values):
+                raise web.HTTPBadRequest(text=f'target {key} must be a string')
+            criteria.extend(values)
+        if not any(criteria):
+            raise web.HTTPBadRequest(text='target needs at least one non-empty criterion')
+        
+        device_ids = [device.device_id for device in self.find_devices(target)]
+        sent = self.send_group_command(command, parameters, device_ids)
+        return web.json_response({'command': command, 'count': len(sent), 'devices': sent})
+
+    def send_group_command(self, command: str, parameters: Dict, device_ids: List[str]) -> List[str]:
+        """Publish a command to each device and record it in the commands table"""
+        if not self.mqtt_client or not device_ids:
+            return []
+        
+        message = json.dumps({"command": command, **parameters})
+        sent = []
+        for device_id in device_ids:
+            if self.mqtt_client.publish(f"devices/{device_id}/commands", message).rc == mqtt.MQTT_ERR_SUCCESS:
+                sent.append(device_id)
+        
+        parameters_json = json.dumps(parameters)
+        self.write_in_background(
+            'recording group command', self._write_commands,
+            [(device_id, command, parameters_json, 'sent') for device_id in sent]
+        )
+        
+        logger.info(f"Sent {command} to {len(sent)} of {len(device_ids)} devices")
+        return sent
+
+    def write_in_background(self, action: str, func, *args):
+        """Queue func(conn, *args) on the writer thread, logging a failure instead of waiting for it"""
+        def done(future: concurrent.futures.Future):
+            error = future.exception()
+            if error:
+                logger.error(f"Error {action}: {error}")
+        
+        try:
+            self.telemetry_writer.call(func, *args).add_done_callback(done)
+        except Exception as e:
+            logger.error(f"Error {action}: {e}")
+
+    @staticmethod
+    def _write_commands(conn: sqlite3.Connection, rows: List[tuple]):
+        with conn:
+            conn.executemany(
+                'INSERT INTO commands (device_id, command, parameters, status, executed_at) '
+                'VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)', rows
+            )
+
+    @staticmethod
+    def _write_device(conn: sqlite3.Connection, row: tuple):
+        with conn:
+            conn.execute('''
                 INSERT OR REPLACE INTO devices 
                 (device_id, device_type, mac_address, ip_address, firmware_version, 
                  capabilities, status, last_seen, registration_time)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                device.device_id, device.device_type, device.mac_address,
-                device.ip_address, device.firmware_version, device.capabilities,
-                device.status, device.last_seen.isoformat() if device.last_seen else None,
-                device.registration_time.isoformat() if device.registration_time else None
-            ))
-            
-            conn.commit()
-            conn.close()
-            
-        except Exception as e:
-            logger.error(f"Error saving device: {e}")
+            ''', row)
+
+    @staticmethod
+    def _write_statuses(conn: sqlite3.Connection, rows: List[tuple]):
+        with conn:
+            conn.executemany('UPDATE devices SET status = ?, last_seen = ? WHERE device_id = ?', rows)
+
+    def save_device(self, device: DeviceInfo):
+        """Save device to database on the writer thread"""
+        self.write_in_background('saving device', self._write_device, (
+            device.device_id, device.device_type, device.mac_address,
+            device.ip_address, device.firmware_version, device.capabilities,
+            device.status, format_timestamp(device.last_seen),
+            format_timestamp(device.registration_time)
+        ))
 
     def save_telemetry(self, telemetry: TelemetryData):
-        """Save telemetry data to database"""
+        """Queue telemetry data for the batched database writer"""
         try:
-            conn = sqlite3.connect(DATABASE_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO telemetry 
-                (device_id, timestamp, temperature, humidity, wifi_rssi, free_heap, uptime, custom_data)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                telemetry.device_id, telemetry.timestamp.isoformat(),
-                telemetry.temperature, telemetry.humidity, telemetry.wifi_rssi,
-                telemetry.free_heap, telemetry.uptime,
-                json.dumps(telemetry.custom_data) if telemetry.custom_data else None
-            ))
-            
-            conn.commit()
-            conn.close()
+            self.telemetry_writer.add(telemetry)
             
         except Exception as e:
             logger.error(f"Error saving telemetry: {e}")
 
     def update_device_status(self, device_id: str, status: str):
-        """Update device status in database"""
+        """Update device status in database on the writer thread"""
+        self.update_device_statuses([(device_id, status)])
+
+    def update_device_statuses(self, changes: List[tuple]):
+        """Persist several (device_id, status) changes in one transaction"""
+        rows = []
+        for device_id, status in changes:
+            device = self.devices.get(device_id)
+            last_seen = device.last_seen if device and device.last_seen else time.time()
+            rows.append((status, format_timestamp(last_seen), device_id))
+            self.dirty_devices.discard(device_id)
+        if rows:
+            self.write_in_background('updating device status', self._write_statuses, rows)
+
+    @staticmethod
+    def _write_last_seen(conn: sqlite3.Connection, rows: List[tuple]) -> int:
+        with conn:
+            # MAX keeps a newer value written by an immediate status update
+            conn.executemany(
+                'UPDATE devices SET last_seen = MAX(IFNULL(last_seen, \'\'), ?) WHERE device_id = ?', rows
+            )
+        return len(rows)
+
+    async def flush_device_state(self):
+        """Persist last_seen of every dirty device in a single executemany"""
+        if not self.dirty_devices:
+            return
+        dirty, self.dirty_devices = self.dirty_devices, set()
+        rows = [
+            (format_timestamp(self.devices[device_id].last_seen), device_id)
+            for device_id in dirty
+            if device_id in self.devices and self.devices[device_id].last_seen
+        ]
         try:
-            conn = sqlite3.connect(DATABASE_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                UPDATE devices SET status = ?, last_seen = ? WHERE device_id = ?
-            ''', (status, datetime.now().isoformat(), device_id))
-            
-            conn.commit()
-            conn.close()
-            
+            written = await asyncio.wrap_future(self.telemetry_writer.call(self._write_last_seen, rows))
+            logger.debug(f"Flushed last_seen for {written} devices")
         except Exception as e:
-            logger.error(f"Error updating device status: {e}")
+            # Retry these devices on the next flush
+            self.dirty_devices |= dirty
+            logger.error(f"Error flushing device state: {e}")
 
     def forward_to_cloud(self, message_type: str, payload: Dict):
         """Forward messages to cloud platform"""
@@ -383,53 +3382,61 @@ class EdgeGateway:
                 return
             
             cloud_payload = {
-                'gateway_id': self.config.get('gateway', 'id', fallback='gateway_001'),
                 'message_type': message_type,
                 'timestamp': datetime.now().isoformat(),
                 'data': payload
             }
             
-            # Send to cloud via HTTP API
-            asyncio.create_task(self.send_to_cloud_api(cloud_payload))
+            # Batched with other messages; the forwarder adds the gateway_id envelope
+            self.cloud_client.submit(cloud_payload)
+            
+        except Exception as e:
+            logger.error(f"Error forwarding to cloud: {e}")
+
+    def forward_raw_to_cloud(self, message_type: str, raw: bytes):
+        """Forward a device's JSON payload to the cloud as-is, without re-encoding it"""
+        try:
+            # Same record shape as forward_to_cloud, spliced around the original bytes
+            self.cloud_client.submit_raw(
+                b'{"message_type":"' + message_type.encode() + b'","timestamp":"'
+                + datetime.now().isoformat().encode() + b'","data":' + raw.strip() + b'}'
+            )
             
         except Exception as e:
             logger.error(f"Error forwarding to cloud: {e}")
 
-    async def send_to_cloud_api(self, payload: Dict):
-        """Send data to cloud via HTTP API"""
+    async def emit_windows(self, now: float):
+        """Store and forward the summaries of every window that has closed"""
         try:
-            cloud_url = self.config.get('cloud', 'api_url', fallback='')
-            if not cloud_url:
+            summaries = self.windows.emit(now)
+            if not summaries:
                 return
             
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f"Bearer {self.config.get('cloud', 'api_token', fallback='')}"
-            }
+            if self.cloud_client and self.forward_windows:
+                for summary in summaries:
+                    self.forward_to_cloud('telemetry_window', summary)
+            
+            if self.store_windows:
+                await asyncio.wrap_future(
+                    self.telemetry_writer.call(self.windows.store, summaries, self.partitions.key_for)
+                )
+            
+            logger.debug(f"Emitted {len(summaries)} telemetry window summaries")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(cloud_url + '/api/v1/gateway/data', 
-                                      json=payload, headers=headers) as response:
-                    if response.status == 200:
-                        logger.debug("Data sent to cloud successfully")
-                    else:
-                        logger.warning(f"Cloud API error: {response.status}")
-                        
         except Exception as e:
-            logger.error(f"Error sending to cloud API: {e}")
+            logger.error(f"Error emitting telemetry windows: {e}")
 
     def check_device_health(self):
-        """Check device health and mark offline devices"""
+        """Mark devices offline whose check-in deadline has passed"""
         try:
-            offline_threshold = timedelta(minutes=5)
-            current_time = datetime.now()
-            
-            for device_id, device in self.devices.items():
-                if device.last_seen and (current_time - device.last_seen) > offline_threshold:
-                    if device.status != 'offline':
-                        device.status = 'offline'
-                        self.update_device_status(device_id, 'offline')
-                        logger.warning(f"Device {device_id} marked as offline")
+            offline = []
+            for device_id in self.deadlines.advance(time.time()):
+                device = self.devices.get(device_id)
+                if device and device.status != 'offline':
+                    self.devices.set_status(device, 'offline')
+                    offline.append((device_id, 'offline'))
+                    logger.warning(f"Device {device_id} marked as offline")
+            self.update_device_statuses(offline)
             
         except Exception as e:
             logger.error(f"Error checking device health: {e}")
@@ -440,17 +3447,38 @@ class EdgeGateway:
             retention_days = self.config.getint('database', 'retention_days', fallback=30)
             cutoff_date = datetime.now() - timedelta(days=retention_days)
             
-            conn = sqlite3.connect(DATABASE_FILE)
-            cursor = conn.cursor()
+            # Expired partitions are dropped whole on the writer's connection
+            dropped = await asyncio.wrap_future(
+                self.telemetry_writer.call(self.partitions.drop_expired, cutoff_date)
+            )
             
-            cursor.execute('DELETE FROM telemetry WHERE timestamp < ?', (cutoff_date.isoformat(),))
-            deleted_rows = cursor.rowcount
+            if dropped:
+                logger.info(f"Dropped {len(dropped)} expired telemetry partitions: {', '.join(dropped)}")
             
-            conn.commit()
-            conn.close()
+            # Each rollup level has its own retention
+            deleted = await asyncio.wrap_future(
+                self.telemetry_writer.call(self.rollups.drop_expired, datetime.now())
+            )
+            for level, rows in deleted.items():
+                logger.info(f"Cleaned up {rows} expired {level} rollup rows")
             
-            if deleted_rows > 0:
-                logger.info(f"Cleaned up {deleted_rows} old telemetry records")
+            if self.windows:
+                window_days = self.config.getfloat('aggregation', 'retention_days', fallback=30)
+                cutoff_ms = int((time.time() - window_days * 86400) * 1000)
+                rows = await asyncio.wrap_future(
+                    self.telemetry_writer.call(self.windows.drop_expired, cutoff_ms)
+                )
+                if rows:
+                    logger.info(f"Cleaned up {rows} expired telemetry window rows")
+            
+            # Acknowledged outbox records are only kept for auditing
+            if self.cloud_client and self.cloud_client.outbox:
+                ack_retention = self.config.getfloat('cloud', 'outbox_ack_retention_hours', fallback=24)
+                pruned = await asyncio.to_thread(
+                    self.cloud_client.outbox.prune, datetime.now() - timedelta(hours=ack_retention)
+                )
+                if pruned > 0:
+                    logger.info(f"Pruned {pruned} acknowledged cloud outbox records")
                 
         except Exception as e:
             logger.error(f"Error cleaning up old data: {e}")
@@ -460,6 +3488,25 @@ class EdgeGateway:
         self.running = True
         logger.info("Starting IoT Edge Gateway...")
         
+        # Start batched telemetry writer
+        self.telemetry_writer.start()
+        
+        # Start the ingest consumer before any message can arrive. Handlers never
+        # await, so a second consumer on the same loop would add no concurrency.
+        self.ingest_queue.bind(asyncio.get_running_loop())
+        self.ingest_worker_task = asyncio.create_task(self.ingest_worker())
+        
+        # Open the pooled cloud session
+        if self.cloud_client:
+            await self.cloud_client.start()
+        
+        # Local read API
+        if self.config.getboolean('api', 'enabled', fallback=True):
+            try:
+                await self.start_api()
+            except OSError as e:
+                logger.error(f"Failed to start local API: {e}")
+        
         # Setup MQTT
         self.setup_mqtt()
         
@@ -472,11 +3519,16 @@ class EdgeGateway:
             self.mqtt_client.loop_start()
         except Exception as e:
             logger.error(f"Failed to connect to MQTT broker: {e}")
+            # Unwind the writer, ingest consumer, cloud session and API started above
+            await self.stop()
             return
         
         # Start background tasks
-        health_check_task = asyncio.create_task(self.health_check_loop())
-        cleanup_task = asyncio.create_task(self.cleanup_loop())
+        loops = [self.health_check_loop, self.device_flush_loop, self.cleanup_loop,
+                 self.migration_loop, self.loop_lag_loop]
+        if self.windows:
+            loops.append(self.aggregation_loop)
+        self.background_tasks = [asyncio.create_task(loop()) for loop in loops]
         
         logger.info("IoT Edge Gateway started successfully")
         
@@ -493,24 +3545,427 @@ class EdgeGateway:
         """Background task for device health checking"""
         while self.running:
             self.check_device_health()
-            await asyncio.sleep(60)  # Check every minute
+            await asyncio.sleep(self.deadlines.tick)
+
+    async def aggregation_loop(self):
+        """Background task emitting window summaries as each window closes"""
+        while self.running:
+            await asyncio.sleep(max(self.windows.next_close() - time.time(), 0.05))
+            await self.emit_windows(time.time())
+
+    async def loop_lag_loop(self):
+        """Background task measuring how late the event loop runs a timer"""
+        interval = self.config.getfloat('metrics', 'loop_lag_interval', fallback=0.5)
+        loop = asyncio.get_running_loop()
+        while self.running:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(loop.time() - started - interval, 0.0))
+
+    async def device_flush_loop(self):
+        """Background task coalescing last_seen writes"""
+        flush_interval = self.config.getfloat('database', 'device_flush_interval', fallback=30)
+        while self.running:
+            await asyncio.sleep(flush_interval)
+            await self.flush_device_state()
 
     async def cleanup_loop(self):
-        """Background task for data cleanup"""
+        """Background task for rollups and data cleanup"""
+        rollup_interval = self.config.getfloat('rollups', 'interval', fallback=60)
+        last_cleanup = None
+        while self.running:
+            await self.update_rollups()
+            if last_cleanup is None or time.monotonic() - last_cleanup >= 3600:
+                await self.cleanup_old_data()  # Clean up every hour
+                last_cleanup = time.monotonic()
+            await asyncio.sleep(rollup_interval)
+
+    async def update_rollups(self):
+        """Bring every rollup level up to date, one bounded step at a time"""
+        try:
+            while self.running:
+                now_ms = int(time.time() * 1000)
+                behind = await asyncio.wrap_future(self.telemetry_writer.call(self.rollups.step, now_ms))
+                if not behind:
+                    break
+                # Yield between catch-up steps so live inserts are not held up
+                await asyncio.sleep(0.05)
+        except Exception as e:
+            logger.error(f"Error updating rollups: {e}")
+
+    async def migration_loop(self):
+        """Background task moving telemetry from older schema versions into compact partitions"""
+        chunk_size = self.config.getint('database', 'migration_chunk', fallback=5000)
+        migrated = 0
         while self.running:
-            await self.cleanup_old_data()
-            await asyncio.sleep(3600)  # Clean up every hour
+            try:
+                moved = await asyncio.wrap_future(
+                    self.telemetry_writer.call(self.partitions.migrate_chunk, chunk_size)
+                )
+            except Exception as e:
+                logger.error(f"Error migrating telemetry: {e}")
+                return
+            if not moved:
+                break
+            migrated += moved
+            # Short pause between chunks keeps live ingest flowing
+            await asyncio.sleep(0.05)
+        if migrated:
+            logger.info(f"Telemetry migration complete: {migrated} rows moved")
 
     async def stop(self):
         """Stop the gateway service"""
         self.running = False
         
+        # Stop the background loops before the writer and database they use go away
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        self.background_tasks = []
+        
+        # Refuse new messages so a blocked network thread can exit
+        self.ingest_queue.close()
+        
         if self.mqtt_client:
             self.mqtt_client.loop_stop()
             self.mqtt_client.disconnect()
         
+        # Drain messages already queued, then stop the consumer
+        if self.ingest_worker_task:
+            try:
+                await asyncio.wait_for(self.ingest_queue.join(), timeout=10)
+            except asyncio.TimeoutError:
+                logger.warning(f"Ingest queue not drained on shutdown: {self.ingest_queue.depth()} messages left")
+            self.ingest_worker_task.cancel()
+            self.ingest_worker_task = None
+        
+        # Windows that have ended are emitted without waiting out the lateness allowance
+        if self.windows:
+            await self.emit_windows(time.time() + self.windows.lateness)
+        
+        if self.cloud_client:
+            await self.cloud_client.stop()
+        
+        if self.api_runner:
+            await self.api_runner.cleanup()
+            self.api_runner = None
+        
+        # Flush buffered telemetry and device state before exiting
+        await self.flush_device_state()
+        self.telemetry_writer.stop()
+        self.db.close()
+        
         logger.info("IoT Edge Gateway stopped")
 
+class ShardSupervisor:
+    """Runs one EdgeGateway process per shard and serves their merged local API.
+    Each shard subscribes to its own devices' topics, so ingest, storage and device state are all split."""
+
+    def __init__(self, config_file: str, config: configparser.ConfigParser, workers: int,
+                 context, log_queue):
+        self.config_file = config_file
+        self.config = config
+        self.workers = workers
+        self.ring = ShardRing(workers)
+        self.context = context
+        self.log_queue = log_queue
+        self.worker_api_port = config.getint('cluster', 'worker_api_port', fallback=8180)
+        self.restart_delay = config.getfloat('cluster', 'restart_delay', fallback=5)
+        self.stop_timeout = config.getfloat('cluster', 'stop_timeout', fallback=30)
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.restart_at: Dict[int, float] = {}
+        self.restarts = [0] * workers
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.api_runner: Optional[web.AppRunner] = None
+        self.running = False
+
+    def rebalance(self) -> int:
+        """Move device rows into the database of the shard that owns them under the current shard count.
+        Runs before any worker starts; returns the number of devices moved."""
+        db_file = self.config.get('database', 'file', fallback=DATABASE_FILE)
+        stem, ext = os.path.splitext(db_file)
+        name = re.compile(re.escape(os.path.basename(stem)) + r'\.shard(\d+)' + re.escape(ext) + '$')
+        try:
+            names = os.listdir(os.path.dirname(db_file) or '.')
+        except OSError:
+            return 0
+        # Shards beyond the current count hand over all of their devices
+        sources = sorted(int(match.group(1)) for match in map(name.match, names) if match)
+
+        moved = 0
+        for source in sources:
+            db = GatewayDatabase(shard_path(db_file, source))
+            try:
+                with db.writer() as conn:
+                    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'devices'").fetchone():
+                        continue
+                    rows = conn.execute('SELECT * FROM devices').fetchall()
+                by_owner: Dict[int, List[tuple]] = {}
+                for row in rows:
+                    owner = self.ring.shard_for(row[0])
+                    if owner != source:
+                        by_owner.setdefault(owner, []).append(row)
+
+                for owner, owned in by_owner.items():
+                    target = GatewayDatabase(shard_path(db_file, owner))
+                    try:
+                        # A device that already registered with its new shard keeps the fresher row.
+                        # Copied before it is deleted, so the next start finishes an interrupted move
+                        with target.writer() as conn, conn:
+                            conn.execute(EdgeGateway.DEVICES_TABLE)
+                            conn.executemany('''
+                                INSERT INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT (device_id) DO UPDATE SET
+                                    device_type = excluded.device_type, mac_address = excluded.mac_address,
+                                    ip_address = excluded.ip_address, firmware_version = excluded.firmware_version,
+                                    capabilities = excluded.capabilities, status = excluded.status,
+                                    last_seen = excluded.last_seen, registration_time = excluded.registration_time
+                                WHERE excluded.last_seen > devices.last_seen
+                            ''', owned)
+                    finally:
+                        target.close()
+                    with db.writer() as conn, conn:
+                        conn.executemany('DELETE FROM devices WHERE device_id = ?', [(row[0],) for row in owned])
+                    moved += len(owned)
+            finally:
+                db.close()
+        return moved
+
+    def spawn(self, shard: int):
+        """Start the worker process for one shard"""
+        process = self.context.Process(
+            target=run_shard, args=(self.config_file, shard, self.workers, self.log_queue),
+            name=f'gateway-shard-{shard}'
+        )
+        process.start()
+        self.processes[shard] = process
+        logger.info(f"Started shard {shard}/{self.workers} (pid {process.pid})")
+
+    def check_workers(self):
+        """Restart shard workers that exited, after restart_delay"""
+        now = time.monotonic()
+        for shard, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            restart_at = self.restart_at.get(shard)
+            if restart_at is None:
+                logger.error(f"Shard {shard} exited with code {process.exitcode}, "
+                             f"restarting in {self.restart_delay:.0f}s")
+                self.restart_at[shard] = now + self.restart_delay
+            elif now >= restart_at:
+                del self.restart_at[shard]
+                self.restarts[shard] += 1
+                self.spawn(shard)
+
+    def shard_url(self, shard: int, request: web.Request) -> str:
+        return f'http://127.0.0.1:{self.worker_api_port + shard}{request.rel_url}'
+
+    async def fetch(self, shard: int, request: web.Request, body: bytes = b'') -> tuple:
+        """(status, body) of one shard for the request; an unreachable shard gives 503"""
+        try:
+            async with self.session.request(request.method, self.shard_url(shard, request), data=body or None,
+                                            headers={'Content-Type': request.content_type}) as response:
+                return response.status, await response.read()
+        except aiohttp.ClientError as e:
+            logger.error(f"Shard {shard} API unavailable: {e}")
+            return 503, b'Shard unavailable'
+
+    async def fan_out(self, request: web.Request) -> List[tuple]:
+        """(status, body) from every shard for the same request"""
+        body = await request.read()
+        return await asyncio.gather(*(self.fetch(shard, request, body) for shard in range(self.workers)))
+
+    @staticmethod
+    def first_error(results: List[tuple]) -> web.Response:
+        # A client error is the same on every shard; otherwise report that nothing matched
+        for status, body in results:
+            if status not in (200, 404):
+                return web.Response(status=status, body=body, content_type='text/plain')
+        return web.Response(status=404, body=results[0][1] if results else b'', content_type='text/plain')
+
+    def setup_api(self) -> web.Application:
+        """The shard API routes, each answered by merging every shard's response"""
+        app = web.Application()
+        app.router.add_get('/api/v1/latest', self.api_latest)
+        app.router.add_get('/api/v1/latest/{device_id}', self.api_device)
+        app.router.add_get('/api/v1/devices', self.api_concat)
+        app.router.add_post('/api/v1/commands', self.api_group_command)
+        app.router.add_get('/api/v1/telemetry', self.api_concat)
+        app.router.add_get('/api/v1/telemetry/aggregate', self.api_concat)
+        app.router.add_get('/metrics', self.api_metrics)
+        return app
+
+    async def api_latest(self, request: web.Request) -> web.Response:
+        """Union of every shard's latest readings"""
+        merged = {}
+        for status, body in await self.fan_out(request):
+            if status == 200:
+                merged.update(json.loads(body))
+        return web.json_response(merged)
+
+    async def api_device(self, request: web.Request) -> web.Response:
+        """The answer of the shard that owns the device"""
+        status, body = await self.fetch(self.ring.shard_for(request.match_info['device_id']), request)
+        return web.Response(status=status, body=body,
+                            content_type='application/json' if status == 200 else 'text/plain')
+
+    async def api_group_command(self, request: web.Request) -> web.Response:
+        """Every shard commands its own matching devices"""
+        results = await self.fan_out(request)
+        merged = None
+        for status, body in results:
+            if status != 200:
+                continue
+            result = json.loads(body)
+            if merged is None:
+                merged = result
+            else:
+                merged['count'] += result['count']
+                merged['devices'].extend(result['devices'])
+        return web.json_response(merged) if merged else self.first_error(results)
+
+    async def api_concat(self, request: web.Request) -> web.StreamResponse:
+        """Stream the JSON arrays of all shards, one shard after another, as one array"""
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        results = []
+        wrote = False
+        for shard in range(self.workers):
+            try:
+                async with self.session.get(self.shard_url(shard, request)) as upstream:
+                    if upstream.status != 200:
+                        results.append((upstream.status, await upstream.read()))
+                        continue
+                    if not response.prepared:
+                        if 'X-Resolution' in upstream.headers:
+                            response.headers['X-Resolution'] = upstream.headers['X-Resolution']
+                        await response.prepare(request)
+                    # Drop each shard's enclosing brackets; the last byte is held back until the next chunk
+                    separator = b',' if wrote else b'['
+                    opened = False
+                    tail = b''
+                    async for chunk in upstream.content.iter_any():
+                        data = tail + chunk
+                        if not opened:
+                            data = data[1:]
+                            opened = True
+                        data, tail = data[:-1], data[-1:]
+                        if data:
+                            await response.write(separator + data)
+                            separator = b''
+                            wrote = True
+            except aiohttp.ClientError as e:
+                logger.error(f"Shard {shard} API unavailable: {e}")
+                results.append((503, b'Shard unavailable'))
+        if not response.prepared:
+            return self.first_error(results)
+        await response.write(b']' if wrote else b'[]')
+        await response.write_eof()
+        return response
+
+    async def api_metrics(self, request: web.Request) -> web.Response:
+        """Every shard's metrics with a shard label, grouped into one family each"""
+        families: Dict[str, list] = {}
+        for shard, (status, body) in enumerate(await self.fan_out(request)):
+            if status != 200:
+                continue
+            name = None
+            for line in body.decode().splitlines():
+                if line.startswith('# '):
+                    _, kind, name, _ = line.split(' ', 3)
+                    family = families.setdefault(name, [None, None, []])
+                    family[0 if kind == 'HELP' else 1] = line
+                elif line:
+                    series, _, value = line.rpartition(' ')
+                    if series.endswith('}'):
+                        series = f'{series[:-1]},shard="{shard}"}}'
+                    else:
+                        series = f'{series}{{shard="{shard}"}}'
+                    families[name][2].append(f'{series} {value}')
+
+        lines = [
+            '# HELP gateway_shard_restarts_total Shard worker restarts after an unexpected exit',
+            '# TYPE gateway_shard_restarts_total counter',
+        ]
+        lines.extend(f'gateway_shard_restarts_total{{shard="{shard}"}} {count}'
+                     for shard, count in enumerate(self.restarts))
+        for help_line, type_line, samples in families.values():
+            lines.append(help_line)
+            lines.append(type_line)
+            lines.extend(samples)
+        return web.Response(body=('\n'.join(lines) + '\n').encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def start(self):
+        """Start every shard and serve the merged API until stopped"""
+        self.running = True
+        logger.info(f"Starting IoT Edge Gateway with {self.workers} shard workers...")
+        try:
+            moved = self.rebalance()
+            if moved:
+                logger.info(f"Moved {moved} devices to the shards that now own them")
+        except Exception as e:
+            logger.error(f"Failed to move devices between shards: {e}")
+        for shard in range(self.workers):
+            self.spawn(shard)
+
+        if self.config.getboolean('api', 'enabled', fallback=True):
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.config.getfloat('cluster', 'api_timeout', fallback=60))
+            )
+            host = self.config.get('api', 'host', fallback='127.0.0.1')
+            port = self.config.getint('api', 'port', fallback=8080)
+            try:
+                self.api_runner = web.AppRunner(self.setup_api(), access_log=None)
+                await self.api_runner.setup()
+                await web.TCPSite(self.api_runner, host, port).start()
+                logger.info(f"Merged local API listening on {host}:{port}")
+            except OSError as e:
+                logger.error(f"Failed to start local API: {e}")
+
+        try:
+            while self.running:
+                await asyncio.sleep(1)
+                self.check_workers()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """Ask every shard to stop, waiting up to stop_timeout before killing it"""
+        self.running = False
+        if self.api_runner:
+            await self.api_runner.cleanup()
+            self.api_runner = None
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+        processes = [process for process in self.processes if process and process.is_alive()]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.join, self.stop_timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in {self.stop_timeout:.0f}s, killing it")
+                process.kill()
+                process.join()
+        logger.info("Shard supervisor stopped")
+
+def run_shard(config_file: str, shard: int, shard_count: int, log_queue):
+    """Entry point of a shard worker process"""
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    setup_logging(config, log_queue, listen=False)
+
+    gateway = EdgeGateway(config_file, shard=shard, shard_count=shard_count)
+
+    def request_stop(signum, frame):
+        gateway.running = False
+
+    # Ctrl-C reaches the whole process group; only the supervisor acts on it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, request_stop)
+    asyncio.run(gateway.start())
+
 def signal_handler(signum, frame):
     """Handle shutdown signals"""
     logger.info(f"Received signal {signum}")
@@ -518,16 +3973,33 @@ def signal_handler(signum, frame):
 
 def main():
     """Main entry point"""
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    workers = config.getint('cluster', 'workers', fallback=1)
+    
+    if workers > 1:
+        # Shard workers log through the supervisor so one process owns the rotating file
+        context = multiprocessing.get_context('spawn')
+        log_queue = context.Queue(config.getint('logging', 'queue_size', fallback=10000))
+        log_listener = setup_logging(config, log_queue)
+    else:
+        log_listener = setup_logging(config)
+    
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     
-    gateway = EdgeGateway()
-    
     try:
+        if workers > 1:
+            gateway = ShardSupervisor(CONFIG_FILE, config, workers, context, log_queue)
+        else:
+            gateway = EdgeGateway()
         asyncio.run(gateway.start())
     except Exception as e:
         logger.error(f"Gateway failed to start: {e}")
         sys.exit(1)
+    finally:
+        # Write out whatever is still queued
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
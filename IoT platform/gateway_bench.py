@@ -0,0 +1,931 @@
+#!/usr/bin/env python3
+"""
+IoT Edge Gateway Benchmarks
+Measures storage and ingest performance of the gateway on the target hardware
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import Gateway_Rasp as gateway
+
+LEGACY_SCHEMA = '''
+    CREATE TABLE telemetry (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        device_id TEXT,
+        timestamp TIMESTAMP,
+        temperature REAL,
+        humidity REAL,
+        wifi_rssi INTEGER,
+        free_heap INTEGER,
+        uptime INTEGER,
+        custom_data TEXT
+    );
+    CREATE INDEX idx_telemetry_device_time ON telemetry(device_id, timestamp);
+'''
+
+
+@dataclass
+class LegacyDeviceInfo:
+    """DeviceInfo as it was before the compact registry"""
+    device_id: str
+    device_type: str
+    mac_address: str
+    ip_address: str
+    firmware_version: str
+    capabilities: str
+    last_seen: datetime
+    status: str = "online"
+    registration_time: Optional[datetime] = None
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples: List[float]) -> Dict:
+    """Mean and tail latencies in milliseconds"""
+    return {
+        'mean_ms': statistics.fmean(samples) if samples else 0.0,
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+    }
+
+
+def write_config(workdir: str, **sections) -> str:
+    """Write a scratch config.ini pointing the gateway at a benchmark database"""
+    path = os.path.join(workdir, 'config.ini')
+    with open(path, 'w') as f:
+        for section, values in sections.items():
+            f.write(f'[{section}]\n')
+            for key, value in values.items():
+                f.write(f'{key} = {value}\n')
+    return path
+
+
+def synthetic_readings(devices: int, rows: int, days: int):
+    """ESP32-shaped readings spread evenly over the last few days"""
+    now = datetime.now()
+    step = timedelta(days=days) / max(1, rows // devices)
+    for i in range(rows):
+        device = i % devices
+        yield gateway.TelemetryData(
+            device_id=f'esp32_sensor_{device:04d}',
+            timestamp=now - step * (i // devices) - timedelta(milliseconds=device),
+            temperature=20 + random.random() * 5,
+            humidity=40 + random.random() * 10,
+            wifi_rssi=random.randint(-80, -40),
+            free_heap=random.randint(150000, 250000),
+            uptime=i // devices * 30
+        )
+
+
+def registration_payloads(devices: int):
+    """Registration messages as decoded from MQTT, each with its own string objects"""
+    types = ['esp32_sensor', 'esp32_relay', 'esp8266_sensor']
+    firmware = ['1.0.0', '1.0.3', '1.1.0']
+    for i in range(devices):
+        yield json.loads(json.dumps({
+            'device_id': f'esp32_{i:06d}',
+            'device_type': types[i % len(types)],
+            'mac_address': ':'.join(f'{(i >> shift) & 0xff:02X}' for shift in (0, 8, 16, 24, 32, 40)),
+            'ip_address': f'10.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff}',
+            'firmware_version': firmware[i % len(firmware)],
+            'capabilities': 'temperature,humidity,wifi_rssi',
+            'status': 'online',
+        }))
+
+
+def measure_registry(devices: int, build) -> int:
+    """Bytes still held after registering freshly decoded payloads with build()"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = build(registration_payloads(devices))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del registry
+    return used
+
+
+def build_legacy(payloads) -> Dict:
+    registry = {}
+    for p in payloads:
+        registry[p['device_id']] = LegacyDeviceInfo(
+            device_id=p['device_id'], device_type=p['device_type'], mac_address=p['mac_address'],
+            ip_address=p['ip_address'], firmware_version=p['firmware_version'],
+            capabilities=p['capabilities'], last_seen=datetime.now(), status=p['status'],
+            registration_time=datetime.now()
+        )
+    return registry
+
+
+def build_compact(payloads) -> Dict:
+    registry = gateway.DeviceRegistry()
+    for p in payloads:
+        registry.add(gateway.DeviceInfo(
+            device_id=p['device_id'], device_type=p['device_type'], mac_address=p['mac_address'],
+            ip_address=p['ip_address'], firmware_version=p['firmware_version'],
+            capabilities=p['capabilities'], last_seen=time.time(), status=p['status'],
+            registration_time=time.time()
+        ))
+    return registry
+
+
+def build_unindexed(payloads) -> Dict:
+    # The compact registry without its lookup indexes, to price them separately
+    registry = build_compact(payloads)
+    for index in (registry.slots, registry.slot_ids,
+                  registry.by_status, registry.by_type, registry.by_firmware, registry.by_capability):
+        index.clear()
+    return registry
+
+
+def range_queries(conn: sqlite3.Connection, sql: str, params: List[tuple]) -> Dict:
+    latencies = []
+    for args in params:
+        started = time.perf_counter()
+        conn.execute(sql, args).fetchall()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return summarize(latencies)
+
+
+def bench_schema(args) -> Dict:
+    """Disk footprint and range-query latency of the legacy and compact telemetry layouts"""
+    workdir = tempfile.mkdtemp(prefix='gateway-bench-')
+    readings = list(synthetic_readings(args.devices, args.rows, args.days))
+    now = datetime.now()
+    windows = []
+    for _ in range(args.queries):
+        device_id = f'esp32_sensor_{random.randrange(args.devices):04d}'
+        end = now - timedelta(seconds=random.uniform(0, args.days * 86400 - 3600))
+        windows.append((device_id, end - timedelta(hours=1), end))
+
+    # Legacy layout: one table, ISO-8601 text timestamps and text device ids
+    legacy_file = os.path.join(workdir, 'legacy.db')
+    conn = sqlite3.connect(legacy_file)
+    conn.executescript(LEGACY_SCHEMA)
+    started = time.perf_counter()
+    with conn:
+        conn.executemany(
+            'INSERT INTO telemetry (device_id, timestamp, temperature, humidity, wifi_rssi, free_heap, uptime, custom_data) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(t.device_id, t.timestamp.isoformat(), t.temperature, t.humidity, t.wifi_rssi,
+              t.free_heap, t.uptime, None) for t in readings]
+        )
+    legacy_insert = time.perf_counter() - started
+    conn.execute('VACUUM')
+    legacy = {
+        'file_bytes': os.path.getsize(legacy_file),
+        'insert_rows_per_s': len(readings) / legacy_insert,
+        'range_query': range_queries(
+            conn,
+            'SELECT * FROM telemetry WHERE device_id = ? AND timestamp BETWEEN ? AND ?',
+            [(d, start.isoformat(), end.isoformat()) for d, start, end in windows]
+        ),
+    }
+    conn.close()
+
+    # Compact layout written through the gateway's own telemetry writer
+    compact_file = os.path.join(workdir, 'compact.db')
+    config = write_config(workdir, database={'file': compact_file, 'batch_size': 5000})
+    gw = gateway.EdgeGateway(config)
+    started = time.perf_counter()
+    gw.telemetry_writer.start()
+    for t in readings:
+        gw.telemetry_writer.add(t)
+    gw.telemetry_writer.stop(timeout=600)
+    gw.db.close()
+    compact_insert = time.perf_counter() - started
+    conn = sqlite3.connect(compact_file)
+    conn.execute('VACUUM')
+    keys = gw.partitions.device_keys
+    compact = {
+        'file_bytes': os.path.getsize(compact_file),
+        'insert_rows_per_s': len(readings) / compact_insert,
+        'range_query': range_queries(
+            conn,
+            'SELECT * FROM telemetry WHERE device_key = ? AND ts BETWEEN ? AND ?',
+            [(keys[d], int(start.timestamp() * 1000), int(end.timestamp() * 1000)) for d, start, end in windows]
+        ),
+    }
+    conn.close()
+
+    # Online migration of the legacy file into the compact layout
+    config = write_config(workdir, database={'file': legacy_file})
+    started = time.perf_counter()
+    gw = gateway.EdgeGateway(config)
+    gw.running = True
+    gw.telemetry_writer.start()
+    asyncio.run(gw.migration_loop())
+    gw.telemetry_writer.stop()
+    gw.db.close()
+    migration_seconds = time.perf_counter() - started
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'rows': len(readings),
+        'devices': args.devices,
+        'legacy': legacy,
+        'compact': compact,
+        'size_reduction': 1 - compact['file_bytes'] / legacy['file_bytes'],
+        'migration_rows_per_s': len(readings) / migration_seconds,
+    }
+
+
+def bench_sync(args) -> Dict:
+    """Batched ingest throughput and single-row commit latency for each synchronous level"""
+    workdir = tempfile.mkdtemp(prefix='gateway-bench-', dir=args.dir)
+    readings = list(synthetic_readings(args.devices, args.rows, 1))
+    results = {}
+    for level in args.levels:
+        db_file = os.path.join(workdir, f'sync_{level.lower()}.db')
+        config = write_config(workdir, database={
+            'file': db_file, 'synchronous': level, 'batch_size': args.batch_size
+        })
+        gw = gateway.EdgeGateway(config)
+
+        # Bulk ingest through the telemetry writer, one transaction per batch
+        started = time.perf_counter()
+        gw.telemetry_writer.start()
+        for t in readings:
+            gw.telemetry_writer.add(t)
+        gw.telemetry_writer.stop(timeout=600)
+        bulk_seconds = time.perf_counter() - started
+
+        # One reading per transaction, the worst case for an SD card
+        latencies = []
+        with gw.db.writer() as conn:
+            for t in readings[:args.commits]:
+                started = time.perf_counter()
+                with conn:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO devices (device_id, device_type, firmware_version, capabilities, '
+                        'status, last_seen) VALUES (?, ?, ?, ?, ?, ?)',
+                        (t.device_id, 'esp32', '1.0', '[]', 'online', t.timestamp.isoformat())
+                    )
+                latencies.append((time.perf_counter() - started) * 1000)
+        gw.db.close()
+
+        results[level] = {
+            'bulk_rows_per_s': len(readings) / bulk_seconds,
+            'single_commit': summarize(latencies),
+        }
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'rows': len(readings),
+        'batch_size': args.batch_size,
+        'commits': args.commits,
+        'directory': args.dir or tempfile.gettempdir(),
+        'levels': results,
+    }
+
+
+def bench_registry(args) -> Dict:
+    """Memory per device of the legacy and compact registries, and load_devices startup time"""
+    workdir = tempfile.mkdtemp(prefix='gateway-bench-')
+    results = {}
+    for devices in args.devices:
+        legacy_bytes = measure_registry(devices, build_legacy)
+        compact_bytes = measure_registry(devices, build_compact)
+        unindexed_bytes = measure_registry(devices, build_unindexed)
+        payloads = list(registration_payloads(devices))
+
+        # Startup: load the same devices from the devices table
+        config = write_config(workdir, database={'file': os.path.join(workdir, f'registry_{devices}.db')})
+        gw = gateway.EdgeGateway(config)
+        with gw.db.writer() as conn, conn:
+            conn.executemany(
+                'INSERT INTO devices (device_id, device_type, mac_address, ip_address, firmware_version, '
+                'capabilities, status, last_seen, registration_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(p['device_id'], p['device_type'], p['mac_address'], p['ip_address'], p['firmware_version'],
+                  p['capabilities'], 'online', datetime.now().isoformat(), datetime.now().isoformat())
+                 for p in payloads]
+            )
+        gw.devices = gateway.DeviceRegistry()
+        started = time.perf_counter()
+        gw.load_devices()
+        load_seconds = time.perf_counter() - started
+        gw.db.close()
+
+        results[devices] = {
+            'legacy_bytes_per_device': legacy_bytes / devices,
+            'compact_bytes_per_device': compact_bytes / devices,
+            'index_bytes_per_device': (compact_bytes - unindexed_bytes) / devices,
+            'legacy_total_mb': legacy_bytes / 2 ** 20,
+            'compact_total_mb': compact_bytes / 2 ** 20,
+            'reduction': 1 - compact_bytes / legacy_bytes,
+            'load_devices_s': load_seconds,
+            'load_devices_us_per_device': load_seconds / devices * 1e6,
+        }
+    shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def telemetry_payloads(count: int) -> List[bytes]:
+    """Telemetry messages as serialized by the ESP32 firmware's sendTelemetry"""
+    payloads = []
+    for i in range(count):
+        payloads.append(json.dumps({
+            'device_id': f'esp32_sensor_{i % 1000:04d}',
+            'timestamp': 1000 * i,
+            'temperature': round(20 + random.random() * 5, 2),
+            'humidity': round(40 + random.random() * 10, 2),
+            'wifi_rssi': random.randint(-80, -40),
+            'free_heap': random.randint(150000, 250000),
+            'uptime': i,
+            'firmware_version': '1.0.0',
+        }).encode())
+    return payloads
+
+
+def binary_payloads(payloads: List[bytes]) -> List[bytes]:
+    """The same readings as positional MessagePack arrays for devices/+/telemetry/bin"""
+    pack = gateway.msgspec.msgpack.encode if gateway.msgspec else gateway.msgpack.packb
+    packed = []
+    for raw in payloads:
+        p = json.loads(raw)
+        packed.append(pack([p['temperature'], p['humidity'], p['wifi_rssi'], p['free_heap'], p['uptime']]))
+    return packed
+
+
+def decode_legacy(raw: bytes) -> gateway.TelemetryPayload:
+    """The previous path: str decode, json.loads, then field-by-field dict lookups"""
+    payload = json.loads(raw.decode())
+    return gateway.TelemetryPayload(
+        device_id=payload.get('device_id'), temperature=payload.get('temperature'),
+        humidity=payload.get('humidity'), wifi_rssi=payload.get('wifi_rssi'),
+        free_heap=payload.get('free_heap'), uptime=payload.get('uptime'),
+        custom_data=payload.get('custom_data')
+    )
+
+
+def bench_decode(args) -> Dict:
+    """Per-message CPU cost of decoding ESP32 telemetry into a TelemetryPayload"""
+    payloads = telemetry_payloads(args.messages)
+    decoders = {'legacy': (decode_legacy, payloads)}
+    for backend in gateway.PayloadDecoder.BACKENDS[1:]:
+        decoder = gateway.PayloadDecoder(backend)
+        if decoder.backend == backend:
+            decoders[backend] = (decoder.decode_telemetry, payloads)
+    decoder = gateway.PayloadDecoder()
+    if decoder.binary:
+        decoders['msgpack_bin'] = (
+            lambda raw: decoder.decode_binary_telemetry(raw, 'esp32_sensor_0000'), binary_payloads(payloads)
+        )
+
+    results = {}
+    for name, (decode, messages) in decoders.items():
+        best = None
+        for _ in range(args.repeat):
+            started = time.process_time_ns()
+            for raw in messages:
+                decode(raw)
+            elapsed = time.process_time_ns() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {
+            'avg_payload_bytes': statistics.fmean(len(raw) for raw in messages),
+            'cpu_ns_per_message': best / len(messages),
+            'messages_per_cpu_s': len(messages) / best * 1e9,
+        }
+    for name, result in results.items():
+        result['speedup_vs_legacy'] = results['legacy']['cpu_ns_per_message'] / result['cpu_ns_per_message']
+
+    return {
+        'messages': len(payloads),
+        'decoders': results,
+    }
+
+
+def route_chain(topic: str, handlers: int):
+    """The previous startswith/endswith dispatch, extended with one branch per extra handler"""
+    if topic.startswith("devices/") and topic.endswith("/telemetry"):
+        return 'telemetry'
+    for k in range(handlers):
+        if topic.startswith("devices/") and topic.endswith(f"/sensors/s{k}"):
+            return k
+    if topic.startswith("devices/") and topic.endswith("/status"):
+        return 'status'
+    if topic == "devices/registration":
+        return 'registration'
+    return None
+
+
+def bench_route(args) -> Dict:
+    """Topic dispatch cost as the number of registered handlers grows"""
+    topics = [f'devices/esp32_sensor_{i % 1000:04d}/telemetry' for i in range(args.messages // 2)]
+    topics += [f'devices/esp32_sensor_{i % 1000:04d}/status' for i in range(args.messages // 2)]
+    random.shuffle(topics)
+
+    results = {}
+    for handlers in args.handlers:
+        router = gateway.TopicRouter()
+        router.add('devices/+/telemetry', 'telemetry')
+        for k in range(handlers):
+            router.add(f'devices/+/sensors/s{k}', k)
+        router.add('devices/+/status', 'status')
+        router.add('devices/registration', 'registration')
+
+        timings = {}
+        for name, route in (('trie', router.match), ('chain', lambda topic: route_chain(topic, handlers))):
+            started = time.process_time_ns()
+            for topic in topics:
+                route(topic)
+            timings[f'{name}_ns_per_message'] = (time.process_time_ns() - started) / len(topics)
+        results[handlers] = timings
+    return {'messages': len(topics), 'handlers': results}
+
+
+class VirtualDevice:
+    """One ESP32 speaking the MQTT protocol of Edge_device_esp.ino"""
+
+    FIRMWARE_VERSION = '1.0.0'
+
+    def __init__(self, index: int, started: float):
+        self.device_id = f'esp32_sensor_{index:06d}'
+        self.mac_address = ':'.join(f'{(index >> shift) & 0xff:02X}' for shift in (40, 32, 24, 16, 8, 0))
+        self.ip_address = f'10.{index >> 16 & 0xff}.{index >> 8 & 0xff}.{index & 0xff}'
+        self.booted = started - random.uniform(0, 3600)
+
+    def millis(self) -> int:
+        return int((time.time() - self.booted) * 1000)
+
+    def status(self, status: str) -> tuple:
+        """sendStatus()"""
+        return f'devices/{self.device_id}/status', json.dumps({
+            'device_id': self.device_id, 'timestamp': self.millis(),
+            'status': status, 'firmware_version': self.FIRMWARE_VERSION,
+        })
+
+    def registration(self) -> tuple:
+        """registerDevice()"""
+        return 'devices/registration', json.dumps({
+            'device_id': self.device_id, 'device_type': 'sensor', 'firmware_version': self.FIRMWARE_VERSION,
+            'capabilities': 'temperature,humidity,wifi_status', 'mac_address': self.mac_address,
+            'ip_address': self.ip_address, 'registration_time': self.millis(),
+        })
+
+    def telemetry(self) -> tuple:
+        """sendTelemetry()"""
+        millis = self.millis()
+        return f'devices/{self.device_id}/telemetry', json.dumps({
+            'device_id': self.device_id, 'timestamp': millis,
+            'temperature': round(20 + random.random() * 5, 1), 'humidity': round(40 + random.random() * 10, 1),
+            'wifi_rssi': random.randint(-80, -40), 'free_heap': random.randint(150000, 250000),
+            'uptime': millis // 1000, 'firmware_version': self.FIRMWARE_VERSION,
+        })
+
+    def heartbeat(self) -> tuple:
+        """sendHeartbeat()"""
+        millis = self.millis()
+        return f'devices/{self.device_id}/status', json.dumps({
+            'device_id': self.device_id, 'timestamp': millis, 'status': 'alive', 'uptime': millis // 1000,
+        })
+
+
+class FakeMessage:
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeMQTTClient:
+    """In-process stand-in for paho's client: publishes to subscribed topics go straight to on_message"""
+
+    def __init__(self):
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.subscriptions = gateway.TopicRouter()
+        self.connected = threading.Event()
+        self.commands = 0
+
+    def connect(self, host, port=1883, keepalive=60):
+        pass
+
+    def loop_start(self):
+        self.on_connect(self, None, {}, 0)
+        self.connected.set()
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topics: List[tuple]):
+        for topic, qos in topics:
+            self.subscriptions.add(topic, topic)
+
+    def publish(self, topic: str, payload):
+        # Gateway -> device traffic (commands) is counted, not delivered
+        self.commands += 1
+        return gateway.mqtt.MQTTMessageInfo(self.commands)
+
+    def deliver(self, topic: str, payload: str):
+        """Device -> gateway publish, called from the load generator thread like paho's network thread"""
+        if self.subscriptions.match(topic):
+            self.on_message(self, None, FakeMessage(topic, payload.encode()))
+
+
+class BrokerPublisher:
+    """Publishes the virtual fleet's traffic to a real MQTT broker"""
+
+    def __init__(self, host: str, port: int):
+        self.client = gateway.mqtt.Client()
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+
+    def deliver(self, topic: str, payload: str):
+        self.client.publish(topic, payload)
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def run_fleet(devices: List[VirtualDevice], deliver, args, stop: threading.Event, sent: List[int],
+              cpu: List[float]):
+    """Boot every device, then pace telemetry and heartbeats at the configured intervals.
+    cpu[0] follows this thread's CPU time, which is load generation rather than gateway work."""
+    for device in devices:
+        deliver(*device.status('online'))
+        deliver(*device.registration())
+        sent[0] += 2
+
+    # Each device sends telemetry every interval and a heartbeat every heartbeat interval
+    telemetry_rate = len(devices) / args.telemetry_interval
+    heartbeat_every = max(1, round(args.heartbeat_interval / args.telemetry_interval))
+    started = time.perf_counter()
+    emitted = 0
+    while not stop.is_set():
+        due = int((time.perf_counter() - started) * telemetry_rate)
+        while emitted < due and not stop.is_set():
+            device = devices[emitted % len(devices)]
+            deliver(*device.telemetry())
+            sent[0] += 1
+            if (emitted // len(devices)) % heartbeat_every == heartbeat_every - 1:
+                deliver(*device.heartbeat())
+                sent[0] += 1
+            emitted += 1
+        cpu[0] = time.thread_time()
+        time.sleep(0.001)
+
+
+def process_usage() -> Dict:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with open('/proc/self/statm') as f:
+        rss_pages = int(f.read().split()[1])
+    return {
+        'cpu_s': usage.ru_utime + usage.ru_stime,
+        'rss_mb': rss_pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20,
+        'max_rss_mb': usage.ru_maxrss / 1024,
+    }
+
+
+def fleet_shard(args, shard: int) -> Dict:
+    """One gateway shard of a sharded fleet run, in its own process"""
+    random.seed(args.seed)
+    return bench_fleet(args, shard)
+
+
+def bench_fleet_sharded(args) -> Dict:
+    """Run one gateway shard per process, each fed its own devices' traffic, and add up what they handled"""
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(args.shards, mp_context=context) as pool:
+        shards = list(pool.map(fleet_shard, [args] * args.shards, range(args.shards)))
+    return {
+        'environment': shards[0]['environment'],
+        'parameters': shards[0]['parameters'],
+        # In-process, every shard generates its own devices' share; through a broker shard 0 publishes it all
+        'offered_msgs_per_s': sum(result['offered_msgs_per_s'] for result in shards),
+        'sustained_msgs_per_s': sum(result['sustained_msgs_per_s'] for result in shards),
+        'dropped_in_window': sum(result['dropped_in_window'] for result in shards),
+        'cpu_percent': sum(result['cpu_percent'] for result in shards),
+        'gateway_cpu_percent': sum(result['gateway_cpu_percent'] for result in shards),
+        # What the shards would sustain with a core each, from the gateway CPU time per handled message
+        'capacity_msgs_per_s': sum(result['capacity_msgs_per_s'] for result in shards),
+        'shards': [
+            {key: result[key] for key in ('sustained_msgs_per_s', 'dropped_in_window', 'latency', 'cpu_percent',
+                                          'gateway_cpu_percent', 'capacity_msgs_per_s', 'rss_mb')}
+            for result in shards
+        ],
+    }
+
+
+def bench_fleet(args, shard: Optional[int] = None) -> Dict:
+    """Sustained ingest of a virtual ESP32 fleet through EdgeGateway"""
+    if args.shards > 1 and shard is None:
+        return bench_fleet_sharded(args)
+    workdir = tempfile.mkdtemp(prefix='gateway-bench-', dir=args.dir)
+    host, _, port = (args.broker or 'localhost:1883').partition(':')
+    config = write_config(
+        workdir,
+        database={'file': os.path.join(workdir, 'fleet.db')},
+        mqtt={'host': host, 'port': port or 1883, 'use_tls': 'false'},
+        ingest={'queue_size': args.queue_size, 'backpressure': args.backpressure},
+        cloud={'enabled': 'false'},
+        api={'enabled': 'false'},
+    )
+    gw = gateway.EdgeGateway(config, shard=shard or 0, shard_count=args.shards)
+    devices = [VirtualDevice(i, time.time()) for i in range(args.devices)]
+
+    # End-to-end latency: from the gateway receiving a message to its handler returning
+    latencies: List[float] = []
+    process_message = gw.process_message
+
+    def timed_process_message(topic, raw_payload, receive_time):
+        process_message(topic, raw_payload, receive_time)
+        latencies.append((time.time() - receive_time) * 1000)
+    gw.process_message = timed_process_message
+
+    fake = None
+    if not args.broker:
+        fake = FakeMQTTClient()
+
+        def setup_fake_mqtt():
+            gw.mqtt_client = fake
+            fake.on_connect = gw.on_mqtt_connect
+            fake.on_message = gw.on_mqtt_message
+            fake.on_disconnect = gw.on_mqtt_disconnect
+        gw.setup_mqtt = setup_fake_mqtt
+        if args.shards > 1:
+            # The broker would only send a shard its own devices' topics, so generate just those
+            devices = [device for device in devices if gw.owns(device.device_id)]
+
+    async def drive() -> Dict:
+        gateway_task = asyncio.create_task(gw.start())
+        if fake:
+            await asyncio.to_thread(fake.connected.wait, 10)
+            publisher = fake
+        else:
+            await asyncio.sleep(2)  # let the gateway subscribe
+            publisher = BrokerPublisher(host, int(port or 1883))
+
+        stop = threading.Event()
+        sent = [0]
+        fleet_cpu = [0.0]
+        fleet = threading.Thread(target=run_fleet, args=(devices, publisher.deliver, args, stop, sent, fleet_cpu),
+                                 daemon=True)
+        # With a real broker one publisher feeds every shard
+        if fake or not shard:
+            fleet.start()
+
+        # Discard the boot burst and warm-up, then measure a steady window
+        await asyncio.sleep(args.warmup)
+        latencies.clear()
+        before = process_usage()
+        fleet_cpu_before = fleet_cpu[0]
+        sent_before = sent[0]
+        dropped_before = gw.ingest_queue.dropped
+        window_started = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        window = time.perf_counter() - window_started
+        after = process_usage()
+        gateway_cpu = after['cpu_s'] - before['cpu_s'] - (fleet_cpu[0] - fleet_cpu_before)
+        window_latencies = list(latencies)
+        window_sent = sent[0] - sent_before
+        window_dropped = gw.ingest_queue.dropped - dropped_before
+
+        stop.set()
+        if fleet.is_alive():
+            fleet.join()
+        if not fake:
+            publisher.close()
+        gw.running = False
+        await gateway_task
+
+        return {
+            'offered_msgs_per_s': window_sent / window,
+            'sustained_msgs_per_s': len(window_latencies) / window,
+            'dropped_in_window': window_dropped,
+            'latency': summarize(window_latencies),
+            'cpu_percent': (after['cpu_s'] - before['cpu_s']) / window * 100,
+            'gateway_cpu_percent': gateway_cpu / window * 100,
+            'capacity_msgs_per_s': len(window_latencies) / gateway_cpu if gateway_cpu > 0 else 0.0,
+            'rss_mb': after['rss_mb'],
+            'max_rss_mb': after['max_rss_mb'],
+            'ingest': gw.ingest_queue.get_stats(),
+            'storage': gw.telemetry_writer.get_stats(),
+        }
+
+    results = asyncio.run(drive())
+    shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'decoder': gw.decoder.backend,
+        },
+        'parameters': {
+            'transport': f'broker {args.broker}' if args.broker else 'in-process',
+            'devices': args.devices,
+            'telemetry_interval': args.telemetry_interval,
+            'heartbeat_interval': args.heartbeat_interval,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'queue_size': args.queue_size,
+            'backpressure': args.backpressure,
+            'shards': args.shards,
+        },
+        **results,
+    }
+
+
+def bench_metrics(args) -> Dict:
+    """Per-event cost of recording a counter and a histogram sample, and of a /metrics scrape"""
+    metrics = gateway.GatewayMetrics()
+    counter = metrics.counter('bench_total', 'bench')
+    histogram = metrics.histogram('bench_seconds', 'bench')
+    samples = [10 ** random.uniform(-6, 1) for _ in range(args.events)]
+    noop = lambda value: None
+
+    def best(func) -> float:
+        runs = []
+        for _ in range(args.repeat):
+            started = time.process_time_ns()
+            for value in samples:
+                func(value)
+            runs.append((time.process_time_ns() - started) / len(samples))
+        return min(runs)
+
+    baseline = best(noop)
+    inc = counter.inc
+    results = {
+        'events': len(samples),
+        'call_baseline_ns': baseline,
+        'counter_inc_ns': best(lambda value: inc()) - baseline,
+        'histogram_observe_ns': best(histogram.observe) - baseline,
+    }
+    started = time.perf_counter()
+    body = metrics.render()
+    results['render_ms'] = (time.perf_counter() - started) * 1000
+    results['render_bytes'] = len(body)
+    return results
+
+
+def bench_aggregate(args) -> Dict:
+    """Streaming window cost per reading and cloud uplink volume of summaries vs raw readings"""
+    windows = gateway.WindowAggregator.parse_windows(args.windows)
+    started = time.time() - args.period
+    aggregator = gateway.WindowAggregator(windows, now=started)
+    devices = [VirtualDevice(i, started) for i in range(args.devices)]
+
+    raw_records: List[bytes] = []
+    window_records: List[bytes] = []
+    add_ns = 0
+    steps = int(args.period / args.telemetry_interval)
+    for step in range(steps):
+        now = started + step * args.telemetry_interval
+        for device in devices:
+            _, payload = device.telemetry()
+            reading = json.loads(payload)
+            telemetry = gateway.TelemetryData(
+                device_id=device.device_id, timestamp=datetime.fromtimestamp(now),
+                temperature=reading['temperature'], humidity=reading['humidity'],
+                wifi_rssi=reading['wifi_rssi'], free_heap=reading['free_heap'], uptime=reading['uptime']
+            )
+            # Same record forward_raw_to_cloud builds around the device payload
+            raw_records.append(b'{"message_type":"telemetry","timestamp":"' + telemetry.timestamp.isoformat().encode()
+                               + b'","data":' + payload.encode() + b'}')
+            t0 = time.process_time_ns()
+            aggregator.add(telemetry)
+            add_ns += time.process_time_ns() - t0
+        for summary in aggregator.emit(now):
+            window_records.append(json.dumps({
+                'message_type': 'telemetry_window', 'timestamp': datetime.fromtimestamp(now).isoformat(),
+                'data': summary,
+            }).encode())
+
+    raw = b'\n'.join(raw_records)
+    summaries = b'\n'.join(window_records)
+    raw_gzip = len(gzip.compress(raw, 6))
+    summaries_gzip = len(gzip.compress(summaries, 6)) if summaries else 0
+    return {
+        'parameters': {
+            'devices': args.devices,
+            'telemetry_interval': args.telemetry_interval,
+            'period': args.period,
+            'windows': args.windows,
+            'fields': list(aggregator.fields),
+        },
+        'readings': len(raw_records),
+        'add_ns_per_reading': add_ns / len(raw_records) if raw_records else 0.0,
+        'summaries': len(window_records),
+        'raw_bytes': len(raw),
+        'summary_bytes': len(summaries),
+        'reduction': len(raw) / len(summaries) if summaries else 0.0,
+        'raw_gzip_bytes': raw_gzip,
+        'summary_gzip_bytes': summaries_gzip,
+        'gzip_reduction': raw_gzip / summaries_gzip if summaries_gzip else 0.0,
+    }
+
+
+def main():
+    """Run the selected benchmark and print a JSON report"""
+    parser = argparse.ArgumentParser(description='IoT Edge Gateway benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    schema = subparsers.add_parser('schema', help='legacy vs compact telemetry layout')
+    schema.add_argument('--rows', type=int, default=500000)
+    schema.add_argument('--devices', type=int, default=100)
+    schema.add_argument('--days', type=int, default=7)
+    schema.add_argument('--queries', type=int, default=500)
+    schema.set_defaults(func=bench_schema)
+
+    sync = subparsers.add_parser('sync', help='WAL throughput per synchronous level')
+    sync.add_argument('--rows', type=int, default=200000)
+    sync.add_argument('--devices', type=int, default=100)
+    sync.add_argument('--batch-size', type=int, default=100)
+    sync.add_argument('--commits', type=int, default=1000)
+    sync.add_argument('--levels', nargs='+', default=list(gateway.GatewayDatabase.SYNCHRONOUS_LEVELS),
+                      type=str.upper, choices=gateway.GatewayDatabase.SYNCHRONOUS_LEVELS)
+    sync.add_argument('--dir', help='directory on the storage device under test (default: system temp)')
+    sync.set_defaults(func=bench_sync)
+
+    registry = subparsers.add_parser('registry', help='device registry memory and startup time')
+    registry.add_argument('--devices', type=int, nargs='+', default=[10000, 100000])
+    registry.set_defaults(func=bench_registry)
+
+    decode = subparsers.add_parser('decode', help='MQTT payload decoding cost per backend')
+    decode.add_argument('--messages', type=int, default=100000)
+    decode.add_argument('--repeat', type=int, default=5)
+    decode.set_defaults(func=bench_decode)
+
+    route = subparsers.add_parser('route', help='MQTT topic dispatch cost vs handler count')
+    route.add_argument('--messages', type=int, default=200000)
+    route.add_argument('--handlers', type=int, nargs='+', default=[0, 10, 100, 1000])
+    route.set_defaults(func=bench_route)
+
+    fleet = subparsers.add_parser('fleet', help='sustained ingest from a virtual ESP32 fleet')
+    fleet.add_argument('--devices', type=int, default=1000)
+    fleet.add_argument('--telemetry-interval', type=float, default=1.0, help='seconds between readings per device')
+    fleet.add_argument('--heartbeat-interval', type=float, default=60.0)
+    fleet.add_argument('--duration', type=float, default=30.0, help='measured window in seconds')
+    fleet.add_argument('--warmup', type=float, default=5.0)
+    fleet.add_argument('--broker', help='host:port of a local MQTT broker (default: in-process fake client)')
+    fleet.add_argument('--queue-size', type=int, default=10000)
+    fleet.add_argument('--backpressure', default='drop_oldest', choices=gateway.IngestQueue.POLICIES)
+    fleet.add_argument('--shards', type=int, default=1, help='gateway shard processes, as [cluster] workers')
+    fleet.add_argument('--dir', help='directory for the benchmark database (default: system temp)')
+    fleet.set_defaults(func=bench_fleet)
+
+    aggregate = subparsers.add_parser('aggregate', help='streaming window cost and uplink reduction')
+    aggregate.add_argument('--devices', type=int, default=100)
+    aggregate.add_argument('--telemetry-interval', type=float, default=1.0)
+    aggregate.add_argument('--period', type=float, default=3600.0, help='simulated seconds of telemetry')
+    aggregate.add_argument('--windows', default='60, 300/60', help='as [aggregation] windows')
+    aggregate.set_defaults(func=bench_aggregate)
+
+    metrics = subparsers.add_parser('metrics', help='instrumentation cost per recorded event')
+    metrics.add_argument('--events', type=int, default=1000000)
+    metrics.add_argument('--repeat', type=int, default=5)
+    metrics.set_defaults(func=bench_metrics)
+
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the report to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = {
+        'benchmark': args.benchmark,
+        'timestamp': datetime.now().isoformat(),
+        'results': args.func(args),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
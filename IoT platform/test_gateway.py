@@ -0,0 +1,947 @@
+import asyncio
+import configparser
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import paho.mqtt.client as mqtt
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from Gateway_Rasp import (CloudForwarder, CloudOutbox, DeviceDeadlines, DeviceInfo, DeviceRegistry, EdgeGateway,
+                          GatewayMetrics, Histogram, IngestQueue, RateLimitFilter, ShardRing, ShardSupervisor,
+                          TelemetryData, TopicRouter, WindowAggregator, setup_logging)
+
+
+@pytest.fixture
+def gateway(tmp_path):
+    config_file = tmp_path / 'config.ini'
+    config_file.write_text(f"[database]\nfile={tmp_path / 'gateway.db'}\n")
+    gw = EdgeGateway(str(config_file))
+    gw.telemetry_writer.start()
+    yield gw
+    gw.telemetry_writer.stop()
+    gw.db.close()
+
+
+def flush(gw):
+    """Wait until everything queued on the writer thread is committed"""
+    gw.telemetry_writer.call(lambda conn: None).result(timeout=10)
+
+
+def telemetry_rows(gw, device_id):
+    with gw.db.reader() as conn:
+        return conn.execute(
+            'SELECT t.ts, t.temperature FROM telemetry t JOIN device_keys k USING (device_key) '
+            'WHERE k.device_id = ? ORDER BY t.ts, t.temperature', (device_id,)
+        ).fetchall()
+
+
+class FakeMQTT:
+    def __init__(self):
+        self.published = []
+        self.subscribed = []
+
+    def subscribe(self, topics):
+        self.subscribed.extend(topic for topic, qos in topics)
+
+    def publish(self, topic, payload, qos=0):
+        self.published.append((topic, payload))
+        return mqtt.MQTTMessageInfo(len(self.published))
+
+    def connect(self, host, port, keepalive):
+        pass
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def register(gw, device_id, **fields):
+    gw.mqtt_client = gw.mqtt_client or FakeMQTT()
+    gw.handle_device_registration({'device_id': device_id, **fields})
+
+
+class FakeCloud:
+    def __init__(self):
+        self.records = []
+
+    def submit(self, payload):
+        self.submit_raw(json.dumps(payload).encode())
+
+    def submit_raw(self, record):
+        self.records.append(json.loads(record))
+
+def test_readings_in_the_same_millisecond_are_kept(gateway):
+    timestamp = datetime.now()
+    gateway.telemetry_writer.add_many([TelemetryData('dev1', timestamp, temperature=t) for t in (1.0, 2.0)])
+    flush(gateway)
+    gateway.telemetry_writer.add(TelemetryData('dev1', timestamp, temperature=3.0))
+    flush(gateway)
+
+    assert [temperature for _, temperature in telemetry_rows(gateway, 'dev1')] == [1.0, 2.0, 3.0]
+    assert gateway.telemetry_writer.errors == 0
+
+
+def test_readings_sharing_a_millisecond_with_stored_rows_after_a_restart(gateway):
+    base = datetime.now().replace(microsecond=0) - timedelta(minutes=5)
+    gateway.telemetry_writer.add_many([
+        TelemetryData('dev1', base, temperature=1.0),
+        TelemetryData('dev1', base + timedelta(seconds=2), temperature=2.0),
+    ])
+    flush(gateway)
+
+    # A new writer knows nothing about the stored span until it probes for it
+    gateway.telemetry_writer._spans.clear()
+    gateway.telemetry_writer.add_many([
+        TelemetryData('dev1', base + timedelta(seconds=2), temperature=3.0),
+        TelemetryData('dev1', base + timedelta(seconds=1), temperature=4.0),
+        TelemetryData('dev1', base - timedelta(seconds=1), temperature=5.0),
+        TelemetryData('dev1', base - timedelta(seconds=1), temperature=6.0),
+        TelemetryData('dev1', base + timedelta(seconds=3), temperature=7.0),
+    ])
+    flush(gateway)
+
+    assert [temperature for _, temperature in telemetry_rows(gateway, 'dev1')] == [5.0, 6.0, 1.0, 4.0, 2.0, 3.0, 7.0]
+    assert gateway.telemetry_writer.errors == 0
+
+
+def test_new_partitions_do_not_mutate_a_snapshot_being_iterated(gateway):
+    snapshot = gateway.partitions.known
+    gateway.telemetry_writer.add(TelemetryData('dev1', datetime(2020, 1, 1), temperature=1.0))
+    flush(gateway)
+
+    assert 'telemetry_20200101' in gateway.partitions.known
+    assert 'telemetry_20200101' not in snapshot
+    union, params = gateway.partitions.range_select(0, int(time.time() * 1000))
+    with gateway.db.reader() as conn:
+        assert conn.execute(f'SELECT COUNT(*) FROM ({union})', params).fetchone()[0] == 1
+
+
+def test_batch_with_duplicate_timestamps(gateway):
+    received = time.time() - 600
+    envelope = {
+        'device_id': 'dev1',
+        'timestamp': 3000,
+        'readings': [
+            {'t': 1000, 'temperature': 1.0},
+            {'t': 2000, 'temperature': 2.0},
+            {'t': 2000, 'temperature': 2.5},
+            {'t': 2000, 'temperature': 2.0},
+            {'t': 3000, 'temperature': 3.0},
+            {'t': 1000, 'temperature': 1.0},
+        ],
+    }
+    gateway.process_message('devices/dev1/telemetry/batch', json.dumps(envelope).encode(), received)
+    flush(gateway)
+
+    # Exact resends are dropped, different readings sharing a 't' are kept
+    rows = telemetry_rows(gateway, 'dev1')
+    assert [temperature for _, temperature in rows] == [1.0, 2.0, 2.5, 3.0]
+    assert len({ts for ts, _ in rows}) == 3
+    assert gateway.batch_duplicates == 2
+
+    # Rollups see exactly the stored readings
+    now_ms = int(time.time() * 1000)
+    while gateway.telemetry_writer.call(gateway.rollups.step, now_ms).result(timeout=10):
+        pass
+    with gateway.db.reader() as conn:
+        count = conn.execute('SELECT SUM(count) FROM rollup_1m').fetchone()[0]
+    assert count == len(rows)
+
+
+def test_rollups_recompute_buckets_that_receive_late_rows(gateway):
+    def catch_up():
+        now_ms = int(time.time() * 1000)
+        while gateway.telemetry_writer.call(gateway.rollups.step, now_ms).result(timeout=10):
+            pass
+
+    def rollup_counts():
+        with gateway.db.reader() as conn:
+            return [conn.execute(f'SELECT SUM(count) FROM rollup_{level}').fetchone()[0]
+                    for level in ('1m', '15m', '1h')]
+
+    received = time.time() - 3 * 3600
+    envelope = {'device_id': 'dev1', 'timestamp': 2000, 'readings': [{'t': 1000}, {'t': 2000}]}
+    gateway.process_message('devices/dev1/telemetry/batch', json.dumps(envelope).encode(), received)
+    flush(gateway)
+    catch_up()
+    assert rollup_counts() == [2, 2, 2]
+
+    # A batch uploaded late lands in buckets the watermark already passed
+    envelope['readings'] = [{'t': 1500}, {'t': 1600}, {'t': 1700}]
+    gateway.process_message('devices/dev1/telemetry/batch', json.dumps(envelope).encode(), received)
+    flush(gateway)
+    catch_up()
+    assert rollup_counts() == [5, 5, 5]
+    assert gateway.rollups.late == set()
+
+
+def test_cloud_stop_keeps_unsent_records_in_outbox(tmp_path):
+    async def hang(request):
+        await asyncio.sleep(60)
+        return web.Response()
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/api/v1/gateway/data', hang)
+        runner = web.AppRunner(app, shutdown_timeout=0.1)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        config_file = tmp_path / 'config.ini'
+        config_file.write_text(
+            f"[database]\nfile={tmp_path / 'gateway.db'}\n"
+            f"[cloud]\nenabled=true\napi_url=http://127.0.0.1:{port}\napi_token=x\n"
+            f"max_batch_records=10\nconnection_limit=2\n"
+        )
+        gw = EdgeGateway(str(config_file))
+        forwarder = gw.cloud_client
+        await forwarder.start()
+        for i in range(50):
+            forwarder.submit({'i': i})
+        await asyncio.sleep(0.2)
+        assert len(forwarder._in_flight) == 2
+
+        await forwarder.stop(timeout=0.5)
+        await runner.cleanup()
+        with gw.db.reader() as conn:
+            stored = [json.loads(row[0])['i'] for row in conn.execute('SELECT record FROM cloud_outbox')]
+        gw.db.close()
+        return forwarder, stored
+
+    forwarder, stored = asyncio.run(run())
+    assert sorted(stored) == list(range(50))
+    assert forwarder.spilled == 50
+    assert forwarder.dropped == 0
+
+
+def test_outbox_claim_skips_in_flight_and_acked_records(gateway):
+    outbox = CloudOutbox(gateway.db)
+    outbox.add([json.dumps({'i': i}).encode() for i in range(5)])
+    assert outbox.pending == 5
+
+    first = outbox.claim(2, set())
+    assert [json.loads(record)['i'] for _, record in first] == [0, 1]
+    second = outbox.claim(2, {row[0] for row in first})
+    assert [json.loads(record)['i'] for _, record in second] == [2, 3]
+
+    outbox.ack([row[0] for row in first])
+    outbox.ack([row[0] for row in first])
+    assert outbox.pending == outbox.count_pending() == 3
+    assert [json.loads(record)['i'] for _, record in outbox.claim(10, set())] == [2, 3, 4]
+    assert outbox.prune(datetime.now() + timedelta(seconds=1)) == 2
+    assert outbox.count_pending() == 3
+
+
+def test_cloud_backoff_doubles_up_to_the_cap_and_resets(monkeypatch):
+    forwarder = CloudForwarder('http://cloud', 'x', 'gw', retry_initial=1.0, retry_max=5.0)
+    monkeypatch.setattr(time, 'monotonic', lambda: 100.0)
+    backoffs = []
+    for _ in range(5):
+        forwarder._on_upload_failure()
+        backoffs.append(forwarder._backoff)
+        # Jittered to between half and all of the backoff
+        assert 100.0 + forwarder._backoff / 2 <= forwarder._retry_at <= 100.0 + forwarder._backoff
+    assert backoffs == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+    forwarder._on_upload_success()
+    assert forwarder._backoff == 0.0
+    assert forwarder._retry_at == 0.0
+    forwarder._on_upload_failure()
+    assert forwarder._backoff == 1.0
+
+
+def test_cloud_outbox_drains_once_the_uplink_recovers(tmp_path):
+    received = []
+    state = {'up': False, 'rejected': 0}
+
+    async def ingest(request):
+        if not state['up']:
+            state['rejected'] += 1
+            return web.Response(status=503)
+        received.append([record['i'] for record in (await request.json())['data']])
+        return web.Response()
+
+    async def wait_for(condition, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline
+            await asyncio.sleep(0.02)
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/api/v1/gateway/data', ingest)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        config_file = tmp_path / 'config.ini'
+        config_file.write_text(
+            f"[database]\nfile={tmp_path / 'gateway.db'}\n"
+            f"[cloud]\nenabled=true\napi_url=http://127.0.0.1:{port}\napi_token=x\ncompression=none\n"
+            f"max_batch_records=10\ndrain_batch_records=15\ndrain_rate=1000\n"
+            f"retry_initial=0.1\nretry_max=0.2\n"
+        )
+        gw = EdgeGateway(str(config_file))
+        forwarder = gw.cloud_client
+        await forwarder.start()
+        for i in range(30):
+            forwarder.submit({'i': i})
+        await forwarder.flush()
+
+        # Failed uploads land in the outbox and the drain keeps retrying at the capped backoff
+        await wait_for(lambda: forwarder.spilled == 30 and state['rejected'] >= 5)
+        assert forwarder.outbox.pending == 30
+        assert forwarder._backoff == 0.2
+        assert received == []
+
+        state['up'] = True
+        await wait_for(lambda: forwarder.outbox.pending == 0)
+        stats = forwarder.get_stats()
+        await forwarder.stop()
+        await runner.cleanup()
+        assert forwarder.outbox.count_pending() == 0
+        gw.db.close()
+        return stats
+
+    stats = asyncio.run(run())
+    assert sorted(i for batch in received for i in batch) == list(range(30))
+    assert all(len(batch) <= 15 for batch in received)
+    assert stats['drained'] == 30
+    assert stats['backoff_seconds'] == 0.0
+    assert stats['dropped'] == 0
+
+
+def test_heartbeats_do_not_rewrite_status(gateway, monkeypatch):
+    register(gateway, 'dev1')
+    writes = []
+    monkeypatch.setattr(gateway, 'update_device_status', lambda device_id, status: writes.append(status))
+
+    gateway.handle_status_update({'device_id': 'dev1', 'status': 'alive'})
+    gateway.handle_status_update({'device_id': 'dev1', 'uptime': 10})
+    assert writes == []
+    assert gateway.devices.get('dev1').status == 'online'
+    assert 'dev1' in gateway.dirty_devices
+
+    gateway.handle_status_update({'device_id': 'dev1', 'status': 'maintenance'})
+    gateway.handle_status_update({'device_id': 'dev1'})
+    assert writes == ['maintenance']
+    assert gateway.devices.get('dev1').status == 'maintenance'
+
+
+def test_late_reading_still_reaches_open_sliding_windows():
+    aggregator = WindowAggregator([(60, 60), (300, 60)], fields=('temperature',), lateness=0, now=6000)
+    assert aggregator.emit(6120) == []
+
+    # Its one-minute window closed at 6060, but the five-minute windows through 6300 are still open
+    aggregator.add(TelemetryData('dev1', datetime.fromtimestamp(6030), temperature=1.0))
+    aggregator.add(TelemetryData('dev1', datetime.fromtimestamp(6150), temperature=2.0))
+    assert aggregator.late == 1
+
+    summaries = aggregator.emit(6300)
+    counts = {(s['window'], s['end'] // 1000): s['temperature']['count'] for s in summaries}
+    assert counts == {(60, 6180): 1, (300, 6180): 2, (300, 6240): 2, (300, 6300): 2}
+
+
+def make_router(*patterns):
+    router = TopicRouter()
+    for pattern in patterns:
+        router.add(pattern, pattern)
+    return router
+
+
+@pytest.mark.parametrize('topic, route', [
+    ('devices/dev1/status', ('devices/+/status', ('dev1',))),
+    ('devices/gateway/status', ('devices/gateway/status', ())),
+    ('devices/dev1/ota/progress/42', ('devices/+/ota/#', ('dev1', 'progress/42'))),
+    ('devices/dev1/ota', ('devices/+/ota/#', ('dev1', ''))),
+    ('devices/dev1', None),
+    ('devices/dev1/status/extra', None),
+    ('other/topic', None),
+])
+def test_router_wildcards(topic, route):
+    router = make_router('devices/+/status', 'devices/gateway/status', 'devices/+/ota/#')
+    assert router.match(topic) == route
+
+
+def test_router_keeps_wildcards_off_system_topics():
+    router = make_router('#', '+/broker/uptime')
+    assert router.match('$SYS/broker/uptime') is None
+    assert router.match('gw/broker/uptime') == ('+/broker/uptime', ('gw',))
+    assert router.match('gw/broker/load') == ('#', ('gw/broker/load',))
+
+    router.add('$SYS/#', 'sys')
+    assert router.match('$SYS/broker/uptime') == ('sys', ('broker/uptime',))
+
+
+def test_router_backtracks_when_the_literal_branch_dead_ends():
+    router = make_router('a/b/c', 'a/+/d', 'a/b/+/f')
+    assert router.match('a/b/d') == ('a/+/d', ('b',))
+    assert router.match('a/b/c') == ('a/b/c', ())
+    assert router.match('a/b/x/f') == ('a/b/+/f', ('x',))
+    assert router.match('a/x/c') is None
+
+
+@pytest.mark.parametrize('pattern', ['a/#/b', 'a/b+', 'a/#b'])
+def test_router_rejects_partial_wildcards(pattern):
+    with pytest.raises(ValueError):
+        TopicRouter().add(pattern, None)
+
+
+def test_router_remove_prunes_unused_levels():
+    router = make_router('devices/+/status', 'devices/+/ota/#', 'devices/registration')
+    assert router.remove('devices/+/ota/#')
+    assert router.match('devices/dev1/ota/progress') is None
+    assert 'ota' not in router.root.children['devices'].wildcard.children
+    assert router.match('devices/dev1/status') == ('devices/+/status', ('dev1',))
+
+    assert not router.remove('devices/+/ota/#')
+    assert not router.remove('devices/+')
+    assert router.remove('devices/+/status')
+    assert router.root.children['devices'].wildcard is None
+    assert router.remove('devices/registration')
+    assert router.root.children == {}
+    assert router.patterns == []
+
+
+def run_wheel(wheel, start, until, step=1.0):
+    """Advance the wheel every step seconds, returning when each device expired"""
+    expired = {}
+    now = start
+    while now < until:
+        now += step
+        for device_id in wheel.advance(now):
+            expired[device_id] = now - start
+    return expired
+
+
+def test_deadlines_more_than_one_lap_out():
+    wheel = DeviceDeadlines(timeout=10, tolerance=2)
+    start = wheel.current_tick * wheel.tick
+    wheel.touch('near', start)
+    # Three laps of the wheel away
+    wheel.touch('far', start, timeout=35)
+
+    assert run_wheel(wheel, start, start + 40) == {'near': 10, 'far': 35}
+    assert len(wheel) == 0
+
+
+def test_deadlines_rearm_and_cancel():
+    wheel = DeviceDeadlines(timeout=10, tolerance=2)
+    start = wheel.current_tick * wheel.tick
+    for device_id in ('later', 'sooner', 'cancelled'):
+        wheel.touch(device_id, start)
+    wheel.touch('sooner', start, timeout=30)
+
+    assert run_wheel(wheel, start, start + 5) == {}
+    wheel.touch('later', start + 5)
+    wheel.touch('sooner', start + 5, timeout=2)
+    wheel.discard('cancelled')
+
+    assert run_wheel(wheel, start + 5, start + 60) == {'sooner': 2, 'later': 10}
+    assert 'cancelled' not in wheel.deadlines
+    assert not any(wheel.slots)
+
+
+def test_deadlines_catch_up_after_a_stalled_advance():
+    wheel = DeviceDeadlines(timeout=10, tolerance=2)
+    start = wheel.current_tick * wheel.tick
+    wheel.touch('a', start)
+    wheel.touch('b', start, timeout=30)
+    wheel.touch('c', start, timeout=100)
+
+    # One call covering several laps finds everything due, and nothing that is not
+    assert sorted(wheel.advance(start + 50)) == ['a', 'b']
+    assert wheel.advance(start + 99) == []
+    assert wheel.advance(start + 100) == ['c']
+
+
+def bucket_of(value):
+    histogram = Histogram()
+    histogram.observe(value)
+    return histogram.counts.index(1)
+
+
+def test_histogram_bounds():
+    bounds = Histogram.BOUNDS
+    assert len(bounds) == Histogram.BUCKETS
+    assert bounds[0] == pytest.approx(4.5e-6, rel=0.01)
+    assert bounds[-1] == 128.0
+    assert all(upper / lower == pytest.approx(2 ** 0.25) for lower, upper in zip(bounds, bounds[1:]))
+
+
+@pytest.mark.parametrize('index', range(Histogram.BUCKETS))
+def test_histogram_bucket_holds_values_up_to_its_bound(index):
+    upper = Histogram.BOUNDS[index]
+    lower = Histogram.BOUNDS[index - 1] if index else upper / 2
+    assert bucket_of((lower * upper) ** 0.5) == index
+    assert bucket_of(upper * (1 - 1e-9)) == index
+    assert bucket_of(upper * (1 + 1e-9)) == index + 1
+
+
+@pytest.mark.parametrize('value, index', [
+    (1.0, 71), (0.5, 67), (128.0, 99),
+    (0.0, 0), (-1.0, 0), (1e-12, 0),
+    (128.1, 100), (1e9, 100),
+])
+def test_histogram_edges_and_clamping(value, index):
+    # Powers of two are exact bounds and belong to the bucket they close (le is inclusive)
+    assert bucket_of(value) == index
+
+
+def test_metrics_render_prometheus_text():
+    metrics = GatewayMetrics()
+    metrics.counter('requests_total', 'Requests', (('path', 'a"b\\c\nd'),)).inc(3)
+    histogram = metrics.histogram('latency_seconds', 'Latency', (('op', 'write'),))
+    for value in (0.001, 0.001, 0.25, 1000.0):
+        histogram.observe(value)
+    metrics.gauge('depth', 'Queue depth', lambda: 7)
+    metrics.gauge('sent_total', 'Sent', lambda: {(('shard', '0'),): 1, (('shard', '1'),): 2}, kind='counter')
+    metrics.gauge('broken', 'Fails at scrape', lambda: 1 / 0)
+    lines = metrics.render().splitlines()
+
+    assert lines[:3] == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{path="a\\"b\\\\c\\nd"} 3',
+    ]
+    assert '# TYPE latency_seconds histogram' in lines
+    buckets = [line for line in lines if line.startswith('latency_seconds_bucket')]
+    assert len(buckets) == Histogram.BUCKETS + 1
+    assert all(line.startswith('latency_seconds_bucket{op="write",le="') for line in buckets)
+    counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+    assert counts == sorted(counts)
+    assert counts[bucket_of(0.001)] == 2
+    assert counts[bucket_of(0.25)] == 3
+    assert counts[-2] == 3
+    assert buckets[-1] == 'latency_seconds_bucket{op="write",le="+Inf"} 4'
+    assert 'latency_seconds_sum{op="write"} 1000.252' in lines
+    assert 'latency_seconds_count{op="write"} 4' in lines
+
+    assert lines[lines.index('# TYPE depth gauge') + 1] == 'depth 7'
+    assert '# TYPE sent_total counter' in lines
+    assert 'sent_total{shard="0"} 1' in lines
+    assert 'sent_total{shard="1"} 2' in lines
+    # A failing gauge keeps its header but no sample, and does not break the scrape
+    assert lines[-2:] == ['# HELP broken Fails at scrape', '# TYPE broken gauge']
+
+
+def log_record(created, msg='reading %s rejected', args=(1,), lineno=10, level=logging.WARNING):
+    record = logging.LogRecord('gateway', level, 'gateway.py', lineno, msg, args, None)
+    record.created = created
+    return record
+
+
+def test_rate_limit_windows_and_suppressed_count():
+    limiter = RateLimitFilter(burst=3, interval=10)
+    passed = [limiter.filter(log_record(t)) for t in range(6)]
+    assert passed == [True, True, True, False, False, False]
+    assert limiter.suppressed == 3
+
+    # The first record of the next window reports what the last one swallowed
+    record = log_record(10.0, args=(7,))
+    assert limiter.filter(record)
+    assert record.getMessage() == 'reading 7 rejected (3 similar messages suppressed)'
+    assert [limiter.filter(log_record(t)) for t in (11, 12, 13)] == [True, True, False]
+
+    record = log_record(25.0)
+    assert limiter.filter(record)
+    assert record.getMessage() == 'reading 1 rejected (1 similar messages suppressed)'
+    record = log_record(40.0)
+    assert limiter.filter(record)
+    assert record.getMessage() == 'reading 1 rejected'
+    assert limiter.suppressed == 4
+
+
+def test_rate_limit_is_per_call_site_and_level():
+    limiter = RateLimitFilter(burst=1, interval=10)
+    # Same line, different text: one site
+    assert limiter.filter(log_record(0, msg='device a offline', args=()))
+    assert not limiter.filter(log_record(1, msg='device b offline', args=()))
+    # Another line has its own window
+    assert limiter.filter(log_record(1, lineno=20))
+    # Below the threshold nothing is limited or counted
+    assert all(limiter.filter(log_record(t, level=logging.INFO)) for t in range(5))
+    assert limiter.suppressed == 1
+
+
+@pytest.fixture
+def root_logging():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield root
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_setup_logging_limits_and_never_blocks(root_logging):
+    config = configparser.ConfigParser()
+    config.read_string("[logging]\nrate_limit_burst=4\nrate_limit_interval=60\n")
+    log_queue = queue.Queue(maxsize=3)
+    assert setup_logging(config, log_queue=log_queue, listen=False) is None
+    handler, = root_logging.handlers
+
+    log = logging.getLogger('gateway.test')
+    for i in range(10):
+        log.warning('reading %d rejected', i)
+    log.info('still %s', 'logged')
+
+    # Four warnings get past the limiter, the queue holds three and the rest are dropped, not waited on
+    records = [log_queue.get_nowait() for _ in range(3)]
+    assert [record.msg for record in records] == [f'reading {i} rejected' for i in range(3)]
+    assert all(record.args is None for record in records)
+    assert handler.dropped == 2
+    assert handler.filters[0].suppressed == 6
+
+
+@pytest.mark.parametrize('policy, kept', [('drop_oldest', [2, 3, 4]), ('drop_newest', [0, 1, 2])])
+def test_ingest_queue_bound_holds_on_the_producer_thread(policy, kept):
+    async def run():
+        queue = IngestQueue(maxsize=3, policy=policy)
+        queue.bind(asyncio.get_running_loop())
+        # Joining the producer blocks the loop, so nothing is consumed meanwhile
+        producer = threading.Thread(target=lambda: [queue.put_threadsafe((i,)) for i in range(5)])
+        producer.start()
+        producer.join()
+        assert queue.depth() == 3
+        items = [(await queue.get())[0] for _ in range(3)]
+        for _ in items:
+            queue.task_done()
+        await queue.join()
+        return queue, items
+
+    queue, items = asyncio.run(run())
+    assert items == kept
+    assert queue.dropped == 2
+    assert queue.max_depth == 3
+
+
+def test_ingest_worker_lets_other_tasks_run_while_messages_keep_coming(gateway, monkeypatch):
+    handled = []
+    monkeypatch.setattr(gateway, 'process_message', lambda topic, payload, receive_time: handled.append(topic))
+
+    async def run():
+        gateway.ingest_queue.bind(asyncio.get_running_loop())
+        for i in range(1000):
+            gateway.ingest_queue.put_threadsafe(('devices/dev1/telemetry', b'{}', time.time()))
+        worker = asyncio.create_task(gateway.ingest_worker())
+        await asyncio.sleep(0)
+        # The rest of the loop gets a turn long before the backlog is drained
+        seen = len(handled)
+        await gateway.ingest_queue.join()
+        worker.cancel()
+        return seen
+
+    seen = asyncio.run(run())
+    assert 0 < seen <= EdgeGateway.INGEST_YIELD_EVERY
+    assert len(handled) == 1000
+
+
+def test_registry_indexes_follow_replacements_and_status_changes():
+    registry = DeviceRegistry()
+    for i in range(20):
+        registry.add(DeviceInfo(f'dev{i}', 'esp32' if i % 2 else 'esp8266', '', '', f'1.{i % 3}.0',
+                                'relay,dht22' if i % 5 == 0 else 'dht22', None))
+
+    def ids(**criteria):
+        return [device.device_id for device in registry.find(**criteria)]
+
+    assert ids(device_type='esp32', capabilities=('relay',)) == ['dev5', 'dev15']
+    assert ids(firmware_below='1.1', device_type='esp8266') == ['dev0', 'dev6', 'dev12', 'dev18']
+
+    registry.add(DeviceInfo('dev5', 'esp8266', '', '', '2.0.0', 'dht22', None))
+    registry.set_status(registry['dev15'], 'offline')
+    assert ids(device_type='esp32', capabilities=('relay',)) == ['dev15']
+    assert ids(status='online', capabilities=('relay',)) == ['dev0', 'dev10']
+    assert ids(firmware_at_least='2.0') == ['dev5']
+    assert ids(device_type='esp32', firmware='2.0.0') == []
+    assert ids(status='unknown') == []
+    assert registry.status_counts() == {'online': 19, 'offline': 1}
+    assert len(ids()) == 20
+
+
+@pytest.mark.parametrize('target, status', [
+    (None, 400),
+    ({}, 400),
+    ({'typ': 'esp32'}, 400),
+    ({'type': 'esp32', 'firmware_below': '2.0'}, 400),
+    ({'type': ''}, 400),
+    ({'capability': []}, 400),
+    ({'type': 7}, 400),
+    ({'type': 'esp32'}, 200),
+    ({'capability': ['relay']}, 200),
+])
+def test_group_command_target_validation(gateway, target, status):
+    register(gateway, 'dev1', device_type='esp32', capabilities='relay,dht22')
+    register(gateway, 'dev2', device_type='esp8266')
+
+    async def run():
+        async with TestClient(TestServer(gateway.setup_api())) as client:
+            response = await client.post('/api/v1/commands', json={'command': 'reboot', 'target': target})
+            return response.status, await response.text()
+
+    code, body = asyncio.run(run())
+    assert code == status, body
+    if status == 200:
+        assert json.loads(body)['devices'] == ['dev1']
+
+
+def api_get(gateway, path):
+    async def run():
+        async with TestClient(TestServer(gateway.setup_api())) as client:
+            response = await client.get(path)
+            return response.status, await response.text()
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('interval', ['inf', '-inf', 'nan', '0', '-60', '0.0001', 'abc'])
+def test_aggregate_rejects_unusable_intervals(gateway, interval):
+    status, _ = api_get(gateway, f'/api/v1/telemetry/aggregate?interval={interval}')
+    assert status == 400
+
+
+def test_query_errors_are_reported_before_streaming(gateway, monkeypatch):
+    # As when retention drops a partition between planning and running the query
+    monkeypatch.setattr(gateway.partitions, 'range_select',
+                        lambda *args: ('SELECT * FROM telemetry_19990101', ()))
+    status, body = api_get(gateway, '/api/v1/telemetry')
+    assert status == 500
+    assert body == 'Query failed'
+
+
+def test_devices_are_streamed_in_chunks(gateway):
+    gateway.config.read_dict({'api': {'stream_chunk_rows': '2'}})
+    status, body = api_get(gateway, '/api/v1/devices')
+    assert (status, json.loads(body)) == (200, [])
+
+    for i in range(5):
+        register(gateway, f'dev{i}', device_type='esp32')
+    status, body = api_get(gateway, '/api/v1/devices?type=esp32')
+    assert status == 200
+    devices = json.loads(body)
+    assert sorted(device['device_id'] for device in devices) == [f'dev{i}' for i in range(5)]
+    assert all(device['liveness']['samples'] == 0 for device in devices)
+
+
+@pytest.mark.parametrize('payload', [
+    b'{"temperature": 21.5}',
+    b' {} ',
+    b'{"device_id": null, "temperature": 21.5}',
+    b'{"temperature": 21.5, "custom_data": {"device_id": "other"}}',
+])
+def test_forwarded_json_telemetry_carries_the_topic_device_id(gateway, payload):
+    gateway.cloud_client = FakeCloud()
+    gateway.process_message('devices/dev7/telemetry', payload, time.time())
+
+    [record] = gateway.cloud_client.records
+    assert record['message_type'] == 'telemetry'
+    assert record['data']['device_id'] == 'dev7'
+    assert record['data'].get('temperature') == json.loads(payload).get('temperature')
+
+
+@pytest.mark.parametrize('values', [
+    [21.5, 40.0, -60, 150000, 12],
+    {'temperature': 21.5, 'humidity': 40.0},
+    {'device_id': None, 'temperature': 21.5},
+])
+def test_forwarded_binary_telemetry_carries_the_topic_device_id(gateway, values):
+    msgspec = pytest.importorskip('msgspec')
+    gateway.cloud_client = FakeCloud()
+    gateway.process_message('devices/dev7/telemetry/bin', msgspec.msgpack.encode(values), time.time())
+
+    [record] = gateway.cloud_client.records
+    assert record['data']['device_id'] == 'dev7'
+    assert record['data']['temperature'] == 21.5
+    assert gateway.latest['dev7'].temperature == 21.5
+
+
+def test_batch_with_null_device_id_uses_the_topic(gateway):
+    gateway.cloud_client = FakeCloud()
+    envelope = {'device_id': None, 'timestamp': 2000, 'readings': [{'t': 1000, 'temperature': 1.0}, {'t': 2000}]}
+    gateway.process_message('devices/dev7/telemetry/batch', json.dumps(envelope).encode(), time.time())
+    flush(gateway)
+
+    assert len(telemetry_rows(gateway, 'dev7')) == 2
+    assert [record['data']['device_id'] for record in gateway.cloud_client.records] == ['dev7', 'dev7']
+
+
+def test_start_unwinds_when_the_broker_is_unreachable(tmp_path):
+    config_file = tmp_path / 'config.ini'
+    config_file.write_text(
+        f"[database]\nfile={tmp_path / 'gateway.db'}\n"
+        "[mqtt]\nhost=127.0.0.1\nport=1\n"
+        "[api]\nport=0\n"
+    )
+    gw = EdgeGateway(str(config_file))
+
+    async def run():
+        await asyncio.wait_for(gw.start(), timeout=10)
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    leftover = asyncio.run(run())
+    assert leftover == []
+    assert gw.api_runner is None
+    assert gw.ingest_worker_task is None
+    assert not any(thread.name == 'telemetry-writer' for thread in threading.enumerate())
+
+
+def test_stop_cancels_background_tasks(tmp_path):
+    config_file = tmp_path / 'config.ini'
+    config_file.write_text(f"[database]\nfile={tmp_path / 'gateway.db'}\n[api]\nenabled=false\n")
+    gw = EdgeGateway(str(config_file))
+    gw.setup_mqtt = lambda: setattr(gw, 'mqtt_client', FakeMQTT())
+
+    async def run():
+        started = asyncio.create_task(gw.start())
+        await asyncio.sleep(0.2)
+        tasks = list(gw.background_tasks)
+        assert not tasks[0].done()
+        gw.running = False
+        await asyncio.wait_for(started, timeout=10)
+        # Finished before the loop itself shuts down
+        assert all(task.done() for task in tasks)
+
+    asyncio.run(run())
+    assert gw.background_tasks == []
+
+
+def shard_gateway(tmp_path, shard, shards):
+    config_file = tmp_path / 'config.ini'
+    config_file.write_text(f"[database]\nfile={tmp_path / 'gateway.db'}\n")
+    gw = EdgeGateway(str(config_file), shard=shard, shard_count=shards)
+    gw.mqtt_client = FakeMQTT()
+    gw.telemetry_writer.start()
+    return gw
+
+
+def close_gateway(gw):
+    flush(gw)
+    gw.telemetry_writer.stop()
+    gw.db.close()
+
+
+def test_shard_subscribes_only_to_its_own_devices(tmp_path):
+    gw = shard_gateway(tmp_path, 0, 2)
+    ring = ShardRing(2)
+    devices = [f'dev{i}' for i in range(20)]
+    owned = [device_id for device_id in devices if ring.shard_for(device_id) == 0]
+    assert 0 < len(owned) < len(devices)
+
+    for device_id in devices + owned:
+        gw.process_message('devices/registration', json.dumps({'device_id': device_id}).encode(), time.time())
+    assert sorted(gw.devices) == sorted(owned)
+    # Each owned device is subscribed once, by exact topic, when it first registers
+    assert sorted(gw.mqtt_client.subscribed) == sorted(
+        f'devices/{device_id}/{suffix}' for device_id in owned for suffix in ('telemetry', 'telemetry/batch', 'status')
+        + (('telemetry/bin',) if gw.decoder.binary else ())
+    )
+    assert gw.device_topics('a/#') == gw.device_topics('a+b') == gw.device_topics('') == []
+
+    # A reconnect subscribes the same topics plus the registration topic, and no wildcard
+    client = FakeMQTT()
+    gw.on_mqtt_connect(client, None, {}, 0)
+    assert sorted(client.subscribed) == sorted(gw.mqtt_client.subscribed + ['devices/registration'])
+    close_gateway(gw)
+
+
+def test_unsharded_gateway_subscribes_wildcards(gateway):
+    client = FakeMQTT()
+    gateway.on_mqtt_connect(client, None, {}, 0)
+    assert client.subscribed == gateway.router.patterns
+    assert 'devices/+/telemetry' in client.subscribed
+
+
+def test_rebalance_moves_devices_to_the_shard_that_owns_them(tmp_path):
+    devices = [f'dev{i}' for i in range(40)]
+    before, after = ShardRing(2), ShardRing(3)
+    for shard in range(2):
+        gw = shard_gateway(tmp_path, shard, 2)
+        for device_id in devices:
+            if before.shard_for(device_id) == shard:
+                register(gw, device_id, ip_address='10.0.0.1')
+        close_gateway(gw)
+
+    # One moved device already re-registered with its new shard, and that row is the newer one
+    moved = next(device_id for device_id in devices if before.shard_for(device_id) != after.shard_for(device_id))
+    time.sleep(0.01)
+    gw = shard_gateway(tmp_path, after.shard_for(moved), 3)
+    register(gw, moved, ip_address='10.0.0.2')
+    close_gateway(gw)
+
+    # Until the rows are moved, shards leave out the devices they do not own
+    for shard in range(3):
+        gw = shard_gateway(tmp_path, shard, 3)
+        assert all(after.shard_for(device_id) == shard for device_id in gw.devices)
+        close_gateway(gw)
+
+    config = configparser.ConfigParser()
+    config.read(tmp_path / 'config.ini')
+    supervisor = ShardSupervisor(str(tmp_path / 'config.ini'), config, 3, None, None)
+    assert supervisor.rebalance() == sum(before.shard_for(d) != after.shard_for(d) for d in devices)
+    assert supervisor.rebalance() == 0
+
+    loaded = []
+    for shard in range(3):
+        gw = shard_gateway(tmp_path, shard, 3)
+        with gw.db.reader() as conn:
+            stored = sorted(row[0] for row in conn.execute('SELECT device_id FROM devices'))
+        assert stored == sorted(gw.devices)
+        loaded.extend(gw.devices)
+        if moved in gw.devices:
+            assert gw.devices[moved].ip_address == '10.0.0.2'
+        close_gateway(gw)
+    assert sorted(loaded) == sorted(devices)
+
+
+def test_supervisor_asks_only_the_owning_shard_for_a_device(tmp_path):
+    config = configparser.ConfigParser()
+    supervisor = ShardSupervisor(str(tmp_path / 'config.ini'), config, 3, None, None)
+    hits = []
+
+    def shard_app(shard):
+        async def latest(request):
+            hits.append(shard)
+            device_id = request.match_info['device_id']
+            if supervisor.ring.shard_for(device_id) != shard:
+                return web.Response(status=404, text='Device not found')
+            return web.json_response({'device_id': device_id, 'shard': shard})
+
+        app = web.Application()
+        app.router.add_get('/api/v1/latest/{device_id}', latest)
+        return app
+
+    async def run():
+        servers = [TestServer(shard_app(shard)) for shard in range(3)]
+        for server in servers:
+            await server.start_server()
+        supervisor.shard_url = lambda shard, request: str(servers[shard].make_url(request.rel_url))
+        async with TestClient(TestServer(supervisor.setup_api())) as client:
+            supervisor.session = client.session
+            results = []
+            for device_id in ('dev1', 'dev2', 'dev3', 'dev4'):
+                response = await client.get(f'/api/v1/latest/{device_id}')
+                results.append((device_id, response.status, await response.json()))
+        for server in servers:
+            await server.close()
+        return results
+
+    results = asyncio.run(run())
+    assert len(hits) == len(results)
+    for device_id, status, body in results:
+        assert status == 200
+        assert body == {'device_id': device_id, 'shard': supervisor.ring.shard_for(device_id)}